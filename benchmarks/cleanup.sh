@@ -2,4 +2,4 @@
 
 rm -f *.dat
 rm -f *.png
-
+rm -f results/*.dat
@@ -1,5 +1,11 @@
 #!/usr/bin/env bash
 
-gnuplot requests.p
-gnuplot memory.p
+# ab runs, from the run-*.sh scripts
+[ -f baseline.dat ] && gnuplot requests.p
+[ -f apache0-mem.dat ] && gnuplot memory.p
 
+# harness.py runs, from their JSON in results/
+if ls results/*.json > /dev/null 2>&1; then
+	python harness.py dat results/*.json
+	gnuplot -e "runs='$(echo results/*-series.dat)'" harness.p
+fi
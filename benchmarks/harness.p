@@ -0,0 +1,33 @@
+# plots harness.py results, run through generate-graphs.sh which sets
+# runs to the results/*-series.dat files
+
+set terminal png size 1000,800
+set output "harness.png"
+set multiplot layout 2,1
+set grid y
+set key outside right
+
+set title "Requests per second"
+set xlabel "Second"
+set ylabel "Requests/s"
+plot for [f in runs] f using 1:2 with lines title f
+
+set title "Shellac RSS"
+set ylabel "RSS (MB)"
+plot for [f in runs] f using 1:3 with lines title f
+
+unset multiplot
+
+set terminal png size 1000,500
+set output "latency.png"
+set title "Latency percentiles"
+set xlabel ""
+set ylabel "Response time (ms)"
+set logscale y
+set style data histogram
+set style histogram clustered
+set style fill solid border -1
+plot "results/latency.dat" using 2:xtic(1) title "p50",\
+	 "" using 3 title "p90",\
+	 "" using 4 title "p99",\
+	 "" using 5 title "p999"
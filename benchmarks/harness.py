@@ -0,0 +1,538 @@
+#!/usr/bin/env python
+"""
+    Load-test harness for Shellac, self-contained
+
+    Starts a stand-in origin with a set delay and body sizes, a
+    memcached stand-in in this process and Shellac itself on
+    free ports, then drives it from a few client processes over
+    keep-alive connections, pipelining if asked. URLs are
+    picked with Zipfian popularity, so a handful are hot and
+    the long tail is cold, as on a real site.
+
+    After a warm-up it measures for a set time and writes what
+    it saw to JSON: requests per second, client-side latency
+    percentiles, Shellac's hit and miss counts and its own
+    per-phase latencies, and its RSS, with a second-by-second
+    series of RPS and RSS. generate-graphs.sh turns a directory
+    of these into plots, by way of harness.py dat.
+
+    Scenarios:
+        mixed   responses live for --ttl, what's hot is cached
+        hit     as mixed, with every URL fetched once up front
+        miss    the origin says no-store, every request goes through
+
+    Usage:
+        python benchmarks/harness.py run --label shellac-l1 --scenario hit \\
+            --connections 100 --pipeline 4 --shellac-args '-l 50000000'
+        python benchmarks/harness.py run --target 127.0.0.1:6081 --label varnish
+        python benchmarks/harness.py dat benchmarks/results/*.json
+
+    Limitations:
+        - the clients are Python too, give them enough processes
+          that they aren't what's measured
+        - Shellac's phase latencies cover the warm-up as well
+        - Linux only (epoll, /proc)
+
+"""
+
+import os
+import sys
+import json
+import shlex
+import errno
+import socket
+import select
+import random
+import urllib2
+import argparse
+import threading
+import subprocess
+import multiprocessing
+
+from bisect import bisect
+from collections import deque
+from time import time, sleep, strftime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, '..', 'src', 'python')
+sys.path.insert(0, SRC)
+
+from shellac.server.Histogram import Histogram
+from standins import MemcacheStandIn, run_origin
+
+# where run puts its JSON
+RESULTS = os.path.join(HERE, 'results')
+
+# seconds between RSS samples
+SAMPLE_INTERVAL = 0.5
+
+# bytes to read per recv() in the clients
+RECV_SIZE = 262144
+
+def free_port():
+    """ A port nothing is listening on, probably still free when it's used """
+
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def wait_for_port(port, timeout = 10):
+    """ Block until something accepts on port """
+
+    deadline = time() + timeout
+    while time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except socket.error:
+            sleep(0.1)
+    raise RuntimeError('Nothing listening on port %d' % port)
+
+def parse_size(value):
+    """ '64k' => 65536 """
+
+    value = value.strip().lower()
+    for suffix, scale in (('k', 1024), ('m', 1024 * 1024)):
+        if value.endswith(suffix):
+            return int(float(value[:-1]) * scale)
+    return int(value)
+
+def zipf_cdf(n, s):
+    """ Cumulative popularity of ranks 1..n, for bisect() on random() """
+
+    weights = [1.0 / (k ** s) for k in xrange(1, n + 1)]
+    total = sum(weights)
+    cdf = []
+    acc = 0.0
+    for w in weights:
+        acc += w / total
+        cdf.append(acc)
+    return cdf
+
+def response_end(buf):
+    """ (length, status) of the first whole response in buf, or None """
+
+    h = buf.find('\r\n\r\n')
+    if h < 0:
+        return None
+    status = int(buf[9:12])
+    head = buf[:h].lower()
+    start = h + 4
+
+    i = head.find('\r\ncontent-length:')
+    if i >= 0:
+        j = head.find('\r\n', i + 2)
+        end = start + int(head[i + 17:j if j >= 0 else len(head)])
+        return (end, status) if end <= len(buf) else None
+
+    if 'transfer-encoding: chunked' not in head:
+        return (start, status)
+
+    pos = start
+    while True:
+        e = buf.find('\r\n', pos)
+        if e < 0:
+            return None
+        size = int(buf[pos:e].split(';')[0], 16)
+        if size == 0:
+            # no trailers
+            return (e + 4, status) if e + 4 <= len(buf) else None
+        pos = e + 2 + size + 2
+        if pos > len(buf):
+            return None
+
+
+class Driver(object):
+    """ One client process: keep-alive connections, each with up to pipeline requests out """
+
+    def __init__(self, port, pick, connections, pipeline, host = 'localhost'):
+        self._port = port
+        self._pick = pick
+        self._connections = connections
+        self._pipeline = pipeline
+        self._host = host
+
+        self._epoll = select.epoll()
+
+        # fd => [socket, unsent, send times, unparsed]
+        self._conns = {}
+
+        self.latency = Histogram()
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+
+        # second since start => responses
+        self.series = {}
+
+    def _connect(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.setblocking(0)
+        s.connect_ex(('127.0.0.1', self._port))
+        self._conns[s.fileno()] = [s, '', deque(), '']
+        self._epoll.register(s.fileno(), select.EPOLLIN | select.EPOLLOUT)
+
+    def _close(self, fd, c):
+        self.errors += len(c[2])
+        self._epoll.unregister(fd)
+        c[0].close()
+        del self._conns[fd]
+
+    def _fill(self, c, now):
+        """ Queue requests until the pipeline is full """
+
+        while len(c[2]) < self._pipeline and self._budget != 0:
+            self._budget -= 1
+            c[1] += 'GET %s HTTP/1.1\r\nHost: %s\r\nAccept-Encoding: gzip\r\n\r\n' % \
+                    (self._pick(), self._host)
+            c[2].append(now)
+
+    def run(self, start, measure, end, limit = -1):
+        """ Drive load until end, counting what finishes after measure
+
+            limit caps the requests sent, and the run stops once
+            they've all been answered.
+        """
+
+        self._budget = limit
+
+        while time() < start:
+            sleep(0.01)
+        for i in xrange(self._connections):
+            self._connect()
+
+        epoll = self._epoll
+        conns = self._conns
+
+        while conns:
+            now = time()
+            if now >= end:
+                break
+
+            for fd, event in epoll.poll(0.1):
+                c = conns.get(fd, None)
+                if c is None:
+                    continue
+
+                if event & (select.EPOLLERR | select.EPOLLHUP):
+                    self._close(fd, c)
+                    if self._budget != 0:
+                        self._connect()
+                    continue
+
+                now = time()
+
+                if event & select.EPOLLIN:
+                    try:
+                        data = c[0].recv(RECV_SIZE)
+                    except socket.error as ex:
+                        if ex.errno == errno.EAGAIN:
+                            continue
+                        data = ''
+                    if not data:
+                        self._close(fd, c)
+                        if self._budget != 0:
+                            self._connect()
+                        continue
+
+                    buf = c[3] + data
+                    while c[2]:
+                        r = response_end(buf)
+                        if r is None:
+                            break
+                        (length, status) = r
+                        sent = c[2].popleft()
+                        if sent >= measure:
+                            self.requests += 1
+                            self.bytes += length
+                            self.latency.record(now - sent)
+                            if status >= 400:
+                                self.errors += 1
+                            second = int(now - start)
+                            self.series[second] = self.series.get(second, 0) + 1
+                        buf = buf[length:]
+                    c[3] = buf
+
+                    if not c[2] and self._budget == 0:
+                        # all answered, done with this one
+                        self._close(fd, c)
+                        continue
+
+                self._fill(c, now)
+
+                if c[1]:
+                    try:
+                        n = c[0].send(c[1])
+                        c[1] = c[1][n:]
+                    except socket.error as ex:
+                        if ex.errno not in (errno.EAGAIN, errno.ENOTCONN):
+                            self._close(fd, c)
+                            self._connect()
+                            continue
+
+                epoll.modify(fd, select.EPOLLIN | (select.EPOLLOUT if c[1] else 0))
+
+        for fd, c in conns.items():
+            c[0].close()
+
+    def result(self):
+        return {'requests': self.requests, 'errors': self.errors, 'bytes': self.bytes,
+                'buckets': self.latency.buckets(), 'series': self.series}
+
+
+def drive(port, paths, cdf, seed, connections, pipeline, start, measure, end, results):
+    """ Process target: run a Driver picking from paths by popularity """
+
+    rnd = random.Random(seed)
+    r = rnd.random
+    pick = lambda: paths[bisect(cdf, r())]
+
+    driver = Driver(port, pick, connections, pipeline)
+    driver.run(start, measure, end)
+    results.put(driver.result())
+
+def prewarm(port, paths):
+    """ Fetch every path once, so the hit scenario starts with a full cache """
+
+    it = iter(paths)
+    driver = Driver(port, lambda: next(it), min(16, len(paths)), 4)
+    now = time()
+    driver.run(now, now, now + 600, limit = len(paths))
+
+def shellac_stats(port):
+    """ Shellac's stats() through its stats URL, None if it doesn't answer """
+
+    try:
+        return json.load(urllib2.urlopen('http://127.0.0.1:%d/_shellac/stats' % port, timeout = 5))
+    except (IOError, ValueError):
+        return None
+
+def rss_kb(pid, field = 'VmRSS'):
+    """ Resident set of a process in KB, or None """
+
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+def run(args):
+    """ Start everything, drive load, write the JSON """
+
+    sizes = [parse_size(s) for s in args.sizes.split(',')]
+    paths = ['/obj/%d' % n for n in xrange(1, args.urls + 1)]
+    cdf = zipf_cdf(args.urls, args.zipf)
+    cdf[-1] = 1.0
+
+    cache_control = 'no-store' if args.scenario == 'miss' else 'max-age=%d' % args.ttl
+
+    children = []
+    mc = None
+    shellac = None
+
+    try:
+        if args.target:
+            port = int(args.target.split(':')[1])
+        else:
+            mc = MemcacheStandIn(free_port())
+            t = threading.Thread(target = mc.run)
+            t.daemon = True
+            t.start()
+
+            origin_port = free_port()
+            served = multiprocessing.Value('L', 0)
+            origin = multiprocessing.Process(target = run_origin,
+                        args = (origin_port, sizes, args.origin_latency / 1000.0,
+                                args.origin_jitter / 1000.0, cache_control, served))
+            origin.daemon = True
+            origin.start()
+            children.append(origin)
+
+            port = free_port()
+            env = dict(os.environ, PYTHONPATH = SRC)
+            log = open(os.path.join(RESULTS, args.label + '.log'), 'w')
+            shellac = subprocess.Popen([sys.executable, '-c',
+                        'from shellac.server.Server import main; main()',
+                        '-s', '127.0.0.1:%d' % origin_port,
+                        '-c', '127.0.0.1:%d' % mc.port(),
+                        '-p', str(port)] + shlex.split(args.shellac_args),
+                        env = env, stdout = log, stderr = subprocess.STDOUT)
+
+            wait_for_port(origin_port)
+        wait_for_port(port)
+
+        if args.scenario == 'hit':
+            print 'Fetching %d URLs to warm the cache...' % len(paths)
+            prewarm(port, paths)
+
+        print 'Driving %d connections (pipeline %d) for %ds after %ds warm-up...' % \
+              (args.connections, args.pipeline, args.duration, args.warmup)
+
+        start = time() + 0.5
+        measure = start + args.warmup
+        end = measure + args.duration
+
+        results = multiprocessing.Queue()
+        per = [args.connections / args.processes] * args.processes
+        per[0] += args.connections - sum(per)
+        for i, n in enumerate(per):
+            p = multiprocessing.Process(target = drive,
+                    args = (port, paths, cdf, args.seed + i, n, args.pipeline,
+                            start, measure, end, results))
+            p.daemon = True
+            p.start()
+            children.append(p)
+
+        # watch the server's memory while they work
+        rss = {}
+        before = None
+        origin_before = 0
+        while time() < end:
+            now = time()
+            if before is None and now >= measure:
+                before = shellac_stats(port)
+                if not args.target:
+                    origin_before = served.value
+            if shellac is not None:
+                rss[int(now - start)] = rss_kb(shellac.pid)
+            sleep(SAMPLE_INTERVAL)
+
+        after = shellac_stats(port)
+        origin_after = served.value if not args.target else None
+        peak = rss_kb(shellac.pid, 'VmHWM') if shellac is not None else None
+
+        reports = [results.get(timeout = 30) for i in per]
+    finally:
+        if shellac is not None:
+            shellac.terminate()
+            shellac.wait()
+        if mc is not None:
+            mc.stop()
+        for p in children:
+            if p.is_alive():
+                p.terminate()
+
+    latency = Histogram()
+    requests = errors = nbytes = 0
+    series = {}
+    for report in reports:
+        requests += report['requests']
+        errors += report['errors']
+        nbytes += report['bytes']
+        latency.load(report['buckets'])
+        for second, n in report['series'].iteritems():
+            series[int(second)] = series.get(int(second), 0) + n
+
+    first = int(measure - start)
+    result = {'label': args.label,
+              'started': strftime('%Y-%m-%d %H:%M:%S'),
+              'config': dict((k, v) for k, v in vars(args).iteritems() if k != 'func'),
+              'requests': requests,
+              'errors': errors,
+              'bytes': nbytes,
+              'rps': requests / float(args.duration),
+              'latency_ms': latency.stats(),
+              'rss_kb': {'peak': peak, 'end': rss.get(max(rss)) if rss else None},
+              'series': [[s - first, series.get(s, 0), rss.get(s, None)]
+                         for s in xrange(first, int(end - start))]}
+
+    if before is not None and after is not None:
+        hits = after['hits'] - before['hits']
+        misses = after['misses'] - before['misses']
+        result['cache'] = {'hits': hits, 'misses': misses, 'stale': after['stale'] - before['stale'],
+                           'hit_ratio': hits / float(hits + misses) if hits + misses else 0.0}
+        result['shellac_latency_ms'] = after.get('latency_ms', None)
+    if origin_after is not None:
+        result['origin_requests'] = origin_after - origin_before
+
+    output = args.output or os.path.join(RESULTS, args.label + '.json')
+    with open(output, 'w') as f:
+        json.dump(result, f, indent = 2, sort_keys = True)
+
+    l = result['latency_ms']
+    print '%s: %.0f req/s, %d errors, p50 %.2fms p99 %.2fms p999 %.2fms' % \
+          (args.label, result['rps'], errors, l['p50'], l['p99'], l['p999'])
+    if 'cache' in result:
+        print 'hit ratio %.3f, origin requests %s, peak RSS %s KB' % \
+              (result['cache']['hit_ratio'], result.get('origin_requests', '?'), peak)
+    print 'Wrote %s' % output
+
+def dat(args):
+    """ Turn result JSON into gnuplot .dat files next to it """
+
+    rows = []
+    for path in args.results:
+        with open(path) as f:
+            result = json.load(f)
+
+        base = os.path.splitext(path)[0]
+        with open(base + '-series.dat', 'w') as f:
+            f.write('# second rps rss_mb\n')
+            for (second, n, kb) in result['series']:
+                f.write('%d %d %s\n' % (second, n, 'NaN' if kb is None else '%.1f' % (kb / 1024.0)))
+
+        l = result['latency_ms']
+        rows.append('%s %.3f %.3f %.3f %.3f %.1f\n' % (result['label'], l['p50'], l['p90'],
+                                                       l['p99'], l['p999'], result['rps']))
+
+    directory = os.path.dirname(args.results[0]) if args.results else '.'
+    with open(os.path.join(directory, 'latency.dat'), 'w') as f:
+        f.write('# label p50 p90 p99 p999 rps\n')
+        f.writelines(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description='Shellac load-test harness')
+    commands = parser.add_subparsers()
+
+    r = commands.add_parser('run', help='Run a benchmark and write its JSON.')
+    r.set_defaults(func=run)
+    r.add_argument('--label', default='shellac',
+                            help='Name of the run, and of its JSON in results/.')
+    r.add_argument('--output',
+                            help='Where to write the JSON instead.')
+    r.add_argument('--scenario', choices=['mixed', 'hit', 'miss'], default='mixed')
+    r.add_argument('--duration', type=int, default=30,
+                            help='Seconds to measure for.')
+    r.add_argument('--warmup', type=int, default=5,
+                            help='Seconds of load before measuring.')
+    r.add_argument('--connections', type=int, default=50,
+                            help='Keep-alive client connections, across all processes.')
+    r.add_argument('--pipeline', type=int, default=1,
+                            help='Requests each connection keeps outstanding.')
+    r.add_argument('--processes', type=int, default=2,
+                            help='Client processes.')
+    r.add_argument('--urls', type=int, default=1000,
+                            help='Distinct URLs.')
+    r.add_argument('--zipf', type=float, default=1.0,
+                            help='Zipf exponent of URL popularity (0 is uniform).')
+    r.add_argument('--sizes', default='1k,8k,64k',
+                            help='Body sizes, URLs take them in turn.')
+    r.add_argument('--ttl', type=int, default=300,
+                            help='max-age the origin sends.')
+    r.add_argument('--origin-latency', type=float, default=20,
+                            help='Milliseconds the origin takes per request.')
+    r.add_argument('--origin-jitter', type=float, default=0,
+                            help='Milliseconds either side of that, uniformly.')
+    r.add_argument('--seed', type=int, default=1)
+    r.add_argument('--shellac-args', default='',
+                            help='More arguments for shellac, as one string.')
+    r.add_argument('--target',
+                            help='host:port of a server that\'s already running, nothing is started.')
+
+    d = commands.add_parser('dat', help='Write gnuplot .dat files from results.')
+    d.set_defaults(func=dat)
+    d.add_argument('results', nargs='+')
+
+    args = parser.parse_args()
+    if not os.path.isdir(RESULTS):
+        os.makedirs(RESULTS)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
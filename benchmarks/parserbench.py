@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+"""
+    HttpParser microbenchmarks, with a baseline to check against
+
+    Times parse() and __str__ over a corpus of messages like
+    the ones Shellac sees: a bare GET, a browser GET with a
+    full set of headers and cookies, chunked gzip responses
+    parsed in pass-through mode, a 1MB body, messages fed to
+    the parser in two pieces split at every byte boundary, as
+    they come off the wire, and heads trickled in a few bytes
+    at a time, as from a slow client. Messages are parsed out
+    of a bytearray with an offset, the way the server parses
+    its recv_into() buffer.
+
+    For each it reports ns of CPU per message, the best of
+    several runs, and objects per message: GC-tracked objects (dicts,
+    lists, parsers, ...) left alive per message with the
+    collector off. CPython 2 keeps no running count of every
+    allocation, so this counts what sticks around, not what
+    is thrown away.
+
+    --save writes the numbers to a baseline file; --check
+    compares against it and exits 1 if anything got slower
+    by more than --tolerance, or keeps more objects.
+
+    Usage:
+        python benchmarks/parserbench.py
+        python benchmarks/parserbench.py --save
+        python benchmarks/parserbench.py --check --tolerance 0.2
+
+    Limitations:
+        - timings only compare on the machine the baseline was
+          saved on, save one per box
+        - a busy box fails the check, run it on a quiet one
+
+"""
+
+import os
+import gc
+import sys
+import json
+import argparse
+import platform
+
+from time import clock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, '..', 'src', 'python')
+sys.path.insert(0, SRC)
+
+from shellac.server import HttpParser
+from passthrough import make_response
+
+BASELINE = os.path.join(HERE, 'parserbench-baseline.json')
+
+# seconds each timing run should take, about
+RUN_TIME = 0.2
+
+# timing runs, the best counts
+REPEATS = 7
+
+SMALL_GET = 'GET /index.html HTTP/1.1\r\n' \
+            'Host: www.example.com\r\n' \
+            '\r\n'
+
+BROWSER_GET = 'GET /news/2013/07/shellac-a-distributed-web-accelerator.html?ref=front HTTP/1.1\r\n' \
+              'Host: www.example.com\r\n' \
+              'Connection: keep-alive\r\n' \
+              'Cache-Control: max-age=0\r\n' \
+              'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8\r\n' \
+              'User-Agent: Mozilla/5.0 (Macintosh; Intel Mac OS X 10_8_4) AppleWebKit/537.36 ' \
+              '(KHTML, like Gecko) Chrome/28.0.1500.71 Safari/537.36\r\n' \
+              'Referer: http://www.example.com/\r\n' \
+              'Accept-Encoding: gzip,deflate,sdch\r\n' \
+              'Accept-Language: en-US,en;q=0.8\r\n' \
+              'Accept-Charset: ISO-8859-1,utf-8;q=0.7,*;q=0.3\r\n' \
+              'Cookie: __utma=1.1234567890.1374000000.1374000000.1374700000.5; ' \
+              '__utmz=1.1374000000.1.1.utmcsr=(direct)|utmccn=(direct)|utmcmd=(none); ' \
+              'session=9f8e7d6c5b4a39281706f5e4d3c2b1a0; prefs=compact\r\n' \
+              'If-None-Match: "5f3a-4e2d1c0b"\r\n' \
+              'If-Modified-Since: Wed, 24 Jul 2013 18:20:11 GMT\r\n' \
+              'DNT: 1\r\n' \
+              'X-Requested-With: XMLHttpRequest\r\n' \
+              'X-Forwarded-For: 10.0.0.1\r\n' \
+              '\r\n'
+
+SMALL_RESPONSE = 'HTTP/1.1 200 OK\r\n' \
+                 'Server: Apache/2.2\r\n' \
+                 'Content-Type: text/html\r\n' \
+                 'Transfer-Encoding: chunked\r\n' \
+                 'Cache-Control: max-age=300\r\n' \
+                 'Connection: keep-alive\r\n' \
+                 '\r\n' \
+                 '1a\r\n<html><p>Hello</p></html>\n\r\n' \
+                 '0\r\n\r\n'
+
+# a browser GET carrying a few KB of cookies
+BIG_COOKIE_GET = BROWSER_GET.replace('prefs=compact', 'prefs=compact; ' +
+                                     '; '.join('ab_%03d=%s' % (i, 'x' * 40) for i in xrange(80)))
+
+def big_response(size):
+    """ A plain response with a Content-Length body of size bytes """
+
+    return 'HTTP/1.1 200 OK\r\n' \
+           'Server: Apache/2.2\r\n' \
+           'Content-Type: application/octet-stream\r\n' \
+           'Content-Length: %d\r\n' \
+           'Connection: keep-alive\r\n' \
+           '\r\n%s' % (size, 'x' * size)
+
+# how messages are fed to the parser
+WHOLE = 0
+SPLIT = -1    # in two, at every byte
+              # n > 0: n bytes at a time
+
+# name => (message, parse in pass-through mode, how it's fed)
+CORPUS = [
+    ('small-get',           SMALL_GET,                  False, WHOLE),
+    ('browser-get',         BROWSER_GET,                False, WHOLE),
+    ('chunked-gzip-8k',     make_response(8 * 1024),    True,  WHOLE),
+    ('chunked-gzip-64k',    make_response(64 * 1024),   True,  WHOLE),
+    ('body-1m',             big_response(1024 * 1024),  True,  WHOLE),
+    ('browser-get-split',   BROWSER_GET,                False, SPLIT),
+    ('small-response-split', SMALL_RESPONSE,            True,  SPLIT),
+    ('browser-get-16b',     BROWSER_GET,                False, 16),
+    ('big-cookie-get-64b',  BIG_COOKIE_GET,             False, 64),
+]
+
+def pieces(message, split):
+    """ What parse() is fed for one message: [(buffer, length)] """
+
+    if split == WHOLE:
+        return [[(bytearray(message), len(message))]]
+
+    if split > 0:
+        return [[(bytearray(message[i:i + split]), len(message[i:i + split]))
+                 for i in xrange(0, len(message), split)]]
+
+    # every way of cutting it in two
+    return [[(bytearray(message[:i]), i), (bytearray(message[i:]), len(message) - i)]
+            for i in xrange(1, len(message))]
+
+def parse(feeds, raw):
+    """ Parse one message from its pieces, as _read_requests does """
+
+    p = HttpParser(raw = raw)
+    for (buf, n) in feeds:
+        off = 0
+        while off < n and not p.message_complete():
+            off += p.parse(buf, n - off, off)
+    assert p.message_complete()
+    return p
+
+def time_parse(variants, raw, n):
+    """ Seconds to parse n messages, cycling through the variants """
+
+    k = len(variants)
+    start = clock()
+    for i in xrange(n):
+        parse(variants[i % k], raw)
+    return clock() - start
+
+def time_str(parsers, n):
+    k = len(parsers)
+    start = clock()
+    for i in xrange(n):
+        str(parsers[i % k])
+    return clock() - start
+
+def objects(fn, n):
+    """ GC-tracked objects fn() leaves alive, per call """
+
+    keep = []
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        for i in xrange(n):
+            keep.append(fn(i))
+        after = gc.get_count()[0]
+    finally:
+        gc.enable()
+    # less the slot in keep
+    return float(after - before) / n
+
+def best(timer):
+    """ ns per message: size the run from a trial, then the best of REPEATS """
+
+    n = 1
+    while True:
+        t = timer(n)
+        if t >= RUN_TIME / 10:
+            break
+        n *= 4
+    n = max(1, int(n * RUN_TIME / t))
+
+    # collections land wherever they like, keep them out of it as timeit does
+    gc.collect()
+    gc.disable()
+    try:
+        return min(timer(n) / n for i in xrange(REPEATS)) * 1e9
+    finally:
+        gc.enable()
+
+def measure(name, message, raw, split):
+    variants = pieces(message, split)
+    parsers = [parse(v, raw) for v in variants]
+    for p in parsers:
+        # str() settles the headers it rewrites on the first call
+        str(p)
+
+    k = len(variants)
+    return {'parse': {'ns': best(lambda n: time_parse(variants, raw, n)),
+                      'objects': objects(lambda i: parse(variants[i % k], raw), 100)},
+            'str':   {'ns': best(lambda n: time_str(parsers, n)),
+                      'objects': objects(lambda i: str(parsers[i % k]), 100)}}
+
+def compare(results, baseline, tolerance):
+    """ Lines describing regressions against baseline, [] if none """
+
+    failures = []
+    for name, ops in sorted(results.iteritems()):
+        for op, now in sorted(ops.iteritems()):
+            was = baseline.get(name, {}).get(op, None)
+            if was is None:
+                continue
+            if now['ns'] > was['ns'] * (1 + tolerance):
+                failures.append('%s %s: %.0f ns, was %.0f (+%.0f%%)' %
+                                (name, op, now['ns'], was['ns'], (now['ns'] / was['ns'] - 1) * 100))
+            if now['objects'] > was['objects'] + 0.5:
+                failures.append('%s %s: %.1f objects, was %.1f' %
+                                (name, op, now['objects'], was['objects']))
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description='HttpParser microbenchmarks')
+    parser.add_argument('--baseline', default=BASELINE,
+                            help='Baseline file to save to or check against.')
+    parser.add_argument('--save', action='store_true',
+                            help='Write these results as the baseline.')
+    parser.add_argument('--check', action='store_true',
+                            help='Exit 1 if anything regressed against the baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                            help='Slowdown allowed before --check fails, as a fraction.')
+    parser.add_argument('cases', nargs='*',
+                            help='Only run these cases.')
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    print '%-22s %-6s %12s %10s %9s' % ('case', 'op', 'ns/msg', 'objs/msg', 'vs base')
+    for (name, message, raw, split) in CORPUS:
+        if args.cases and name not in args.cases:
+            continue
+        results[name] = measure(name, message, raw, split)
+        for op in ('parse', 'str'):
+            r = results[name][op]
+            was = baseline.get(name, {}).get(op, None)
+            delta = '%+8.1f%%' % ((r['ns'] / was['ns'] - 1) * 100) if was else ''
+            print '%-22s %-6s %12.0f %10.1f %9s' % (name, op, r['ns'], r['objects'], delta)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'machine': platform.platform(),
+                       'results': results}, f, indent = 2, sort_keys = True)
+        print 'Saved %s' % args.baseline
+
+    if args.check:
+        failures = compare(results, baseline, args.tolerance)
+        if failures:
+            print
+            print 'Regressed:'
+            for line in failures:
+                print '  ' + line
+            sys.exit(1)
+        print
+        print 'No regressions against %s' % args.baseline
+
+if __name__ == '__main__':
+    main()
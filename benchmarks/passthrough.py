@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+    CPU cost of handling a proxied gzip response, decoded vs pass-through
+
+    Parses and re-serializes the same upstream response the way
+    Server._read_responses does on a miss, once with the body
+    gunzipped and re-gzipped and once in pass-through mode.
+
+    Usage:
+        PYTHONPATH=src/python python benchmarks/passthrough.py [body KB] [misses]
+
+"""
+
+import sys
+import zlib
+import random
+
+from time import clock
+
+from shellac.server import HttpParser
+
+def make_response(size):
+    """ A chunked, gzipped HTML-ish response with a body of about size bytes """
+
+    words = ['shellac', 'varnish', 'cache', 'proxy', 'epoll', 'memcached',
+             '<div>', '</div>', '<p class="post">', '</p>', 'lorem', 'ipsum']
+    rnd = random.Random(42)
+    text = []
+    n = 0
+    while n < size:
+        w = rnd.choice(words)
+        text.append(w)
+        n += len(w) + 1
+    body = ' '.join(text)
+
+    zz = zlib.compressobj(6, zlib.DEFLATED, 31)
+    data = zz.compress(body) + zz.flush()
+
+    resp = 'HTTP/1.1 200 OK\r\n'
+    resp+= 'Server: Apache/2.2\r\n'
+    resp+= 'Content-Type: text/html\r\n'
+    resp+= 'Content-Encoding: gzip\r\n'
+    resp+= 'Transfer-Encoding: chunked\r\n'
+    resp+= '\r\n'
+    for i in xrange(0, len(data), 8192):
+        chunk = data[i:i+8192]
+        resp+= '%x\r\n%s\r\n' % (len(chunk), chunk)
+    resp+= '0\r\n\r\n'
+    return resp
+
+def miss(resp, raw):
+    """ Parse and serialize one upstream response """
+
+    p = HttpParser(raw = raw)
+    while not p.message_complete():
+        for i in xrange(0, len(resp), 4096):
+            data = resp[i:i+4096]
+            while len(data) != 0:
+                c = p.parse(data, len(data))
+                data = data[c:]
+    return str(p)
+
+def run(resp, raw, n):
+    start = clock()
+    for i in xrange(n):
+        miss(resp, raw)
+    return (clock() - start) / n
+
+def main():
+    size = int(sys.argv[1]) * 1024 if len(sys.argv) > 1 else 64 * 1024
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    resp = make_response(size)
+
+    # warm up
+    miss(resp, False)
+    miss(resp, True)
+
+    decoded = run(resp, False, n)
+    passthrough = run(resp, True, n)
+
+    print 'Body: %d KB plain, %d bytes on the wire, %d misses' % (size / 1024, len(resp), n)
+    print 'decode + re-gzip: %8.1f us CPU/miss' % (decoded * 1e6)
+    print 'pass-through:     %8.1f us CPU/miss' % (passthrough * 1e6)
+    print 'speedup:          %8.1fx' % (decoded / passthrough)
+
+if __name__ == '__main__':
+    main()
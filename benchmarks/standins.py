@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+"""
+    Local stand-ins for a web server and memcached
+
+    Just enough of each to put Shellac under load on one box,
+    with no Apache or memcached to install. run_origin() is
+    a threaded HTTP/1.1 keep-alive server that answers
+    /obj/<n> after a configurable delay with a body of one of
+    a list of sizes. MemcacheStandIn speaks the subset of the
+    memcached binary protocol MemcacheClient uses (get, getq,
+    set, setq, touch, no-op) from one epoll loop and keeps
+    everything in a dict.
+
+    Usage:
+        served = multiprocessing.Value('L', 0)
+        Process(target = run_origin, args = (8000, [1024, 65536], 0.02, 0,
+                                              'max-age=300', served)).start()
+
+        mc = MemcacheStandIn(11211)
+        Thread(target = mc.run).start()
+
+        # or on their own
+        python benchmarks/standins.py origin 8000 --latency 20
+        python benchmarks/standins.py memcached 11211
+
+    Limitations:
+        - the memcached stand-in never evicts, it grows with the
+          working set
+        - its replies are written blocking, fine for a handful of
+          Shellac connections
+        - Linux only (epoll)
+
+"""
+
+import errno
+import socket
+import select
+import struct
+import random
+import argparse
+import SocketServer
+import BaseHTTPServer
+
+from time import time, sleep
+
+# magic, opcode, key len, extras len, data type, vbucket/status,
+# body len, opaque, cas
+HEADER = struct.Struct('!BBHBBHIIQ')
+
+OP_GET   = 0x00
+OP_SET   = 0x01
+OP_GETQ  = 0x09
+OP_NOOP  = 0x0a
+OP_GETK  = 0x0c
+OP_GETKQ = 0x0d
+OP_SETQ  = 0x11
+OP_TOUCH = 0x1c
+
+STATUS_OK        = 0
+STATUS_NOT_FOUND = 1
+STATUS_TOO_LARGE = 3
+
+# memcached's default item size limit
+ITEM_SIZE = 1024 * 1024
+
+# expiry times past this are timestamps
+MAX_TTL = 2592000
+
+# filler for response bodies, compresses about as well as HTML
+TEXT = '<div class="post"><p>Shellac is a distributed web accelerator, ' \
+       'it glues together spare memory across a cluster.</p></div>\n'
+
+def body(size):
+    """ A text body of size bytes """
+    return (TEXT * (size / len(TEXT) + 1))[:size]
+
+
+class OriginHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    # set on a subclass by run_origin()
+    bodies = []
+    latency = 0
+    jitter = 0
+    cache_control = 'max-age=300'
+    served = None
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        try:
+            n = int(self.path.rsplit('/', 1)[1])
+        except (IndexError, ValueError):
+            n = 0
+
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            sleep(delay)
+
+        data = self.bodies[n % len(self.bodies)]
+
+        # one write: a header at a time would leave the body waiting on
+        # a delayed ACK for every response after the first
+        self.wfile.write('HTTP/1.1 200 OK\r\n'
+                         'Server: %s\r\n'
+                         'Date: %s\r\n'
+                         'Content-Type: text/html\r\n'
+                         'Content-Length: %d\r\n'
+                         'Cache-Control: %s\r\n'
+                         'Connection: keep-alive\r\n'
+                         'Keep-Alive: timeout=60, max=1000000\r\n'
+                         '\r\n%s' % (self.version_string(), self.date_time_string(),
+                                       len(data), self.cache_control, data))
+
+        if self.served is not None:
+            with self.served.get_lock():
+                self.served.value += 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class OriginServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # clients hanging up at the end of a run, nothing to report
+        pass
+
+
+def run_origin(port, sizes, latency = 0, jitter = 0, cache_control = 'max-age=300',
+               served = None):
+    """ Serve /obj/<n> forever, latency and jitter in seconds """
+
+    class Handler(OriginHandler):
+        pass
+
+    Handler.bodies = [body(s) for s in sizes]
+    Handler.latency = latency
+    Handler.jitter = jitter
+    Handler.cache_control = cache_control
+    Handler.served = served
+
+    OriginServer(('127.0.0.1', port), Handler).serve_forever()
+
+
+class MemcacheStandIn(object):
+
+    def __init__(self, port = 0, item_size = ITEM_SIZE):
+        """ Listen on port, 0 picks a free one """
+
+        self._item_size = item_size
+
+        # key => (value, expires or 0)
+        self._items = {}
+
+        # fd => [socket, unparsed input]
+        self._conns = {}
+
+        self._stats = {'gets': 0, 'hits': 0, 'sets': 0, 'touches': 0}
+        self._running = False
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', port))
+        self._socket.listen(128)
+
+    def port(self):
+        return self._socket.getsockname()[1]
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['items'] = len(self._items)
+        stats['bytes'] = sum(len(v) for v, e in self._items.itervalues())
+        return stats
+
+    def run(self):
+        """ Serve until stop() """
+
+        epoll = select.epoll()
+        listen_fd = self._socket.fileno()
+        epoll.register(listen_fd, select.EPOLLIN)
+        self._running = True
+
+        while self._running:
+            try:
+                events = epoll.poll(0.5)
+            except IOError as ex:
+                if ex.errno != errno.EINTR:
+                    raise
+                continue
+
+            for fd, event in events:
+                if fd == listen_fd:
+                    conn, address = self._socket.accept()
+                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self._conns[conn.fileno()] = [conn, '']
+                    epoll.register(conn.fileno(), select.EPOLLIN)
+                    continue
+
+                c = self._conns[fd]
+                try:
+                    data = c[0].recv(65536)
+                except socket.error:
+                    data = ''
+                if not data:
+                    epoll.unregister(fd)
+                    c[0].close()
+                    del self._conns[fd]
+                    continue
+
+                c[1] = self._handle(c[0], c[1] + data)
+
+        epoll.close()
+        self._socket.close()
+
+    def stop(self):
+        self._running = False
+
+    def _handle(self, conn, buf):
+        """ Answer every whole request in buf, returns what's left """
+
+        replies = []
+        offset = 0
+        while len(buf) - offset >= HEADER.size:
+            (magic, op, klen, elen, dtype, vb, blen, opaque, cas) = HEADER.unpack_from(buf, offset)
+            if len(buf) - offset < HEADER.size + blen:
+                break
+
+            start = offset + HEADER.size
+            extras = buf[start:start + elen]
+            key = buf[start + elen:start + elen + klen]
+            value = buf[start + elen + klen:start + blen]
+            offset = start + blen
+
+            reply = self._op(op, key, extras, value, opaque)
+            if reply:
+                replies.append(reply)
+
+        if replies:
+            conn.sendall(''.join(replies))
+        return buf[offset:]
+
+    def _op(self, op, key, extras, value, opaque):
+        """ The reply to one request, '' for a quiet one that has nothing to say """
+
+        stats = self._stats
+
+        if op in (OP_GET, OP_GETQ, OP_GETK, OP_GETKQ):
+            stats['gets'] += 1
+            value = self._get(key)
+            if value is None:
+                if op in (OP_GETQ, OP_GETKQ):
+                    return ''
+                return HEADER.pack(0x81, op, 0, 0, 0, STATUS_NOT_FOUND, 9, opaque, 0) + 'Not found'
+            stats['hits'] += 1
+            k = key if op in (OP_GETK, OP_GETKQ) else ''
+            return HEADER.pack(0x81, op, len(k), 4, 0, STATUS_OK, 4 + len(k) + len(value),
+                               opaque, 0) + '\0\0\0\0' + k + value
+
+        if op in (OP_SET, OP_SETQ):
+            if len(value) > self._item_size:
+                return HEADER.pack(0x81, op, 0, 0, 0, STATUS_TOO_LARGE, 0, opaque, 0)
+            stats['sets'] += 1
+            (flags, ttl) = struct.unpack('!II', extras)
+            self._items[key] = (value, self._expires(ttl))
+            if op == OP_SETQ:
+                return ''
+            return HEADER.pack(0x81, op, 0, 0, 0, STATUS_OK, 0, opaque, 0)
+
+        if op == OP_TOUCH:
+            stats['touches'] += 1
+            value = self._get(key)
+            if value is None:
+                return HEADER.pack(0x81, op, 0, 0, 0, STATUS_NOT_FOUND, 0, opaque, 0)
+            self._items[key] = (value, self._expires(struct.unpack('!I', extras)[0]))
+            return HEADER.pack(0x81, op, 0, 0, 0, STATUS_OK, 0, opaque, 0)
+
+        # no-op, and anything we don't know
+        return HEADER.pack(0x81, op, 0, 0, 0, STATUS_OK, 0, opaque, 0)
+
+    def _get(self, key):
+        item = self._items.get(key, None)
+        if item is None:
+            return None
+        if item[1] and item[1] <= time():
+            del self._items[key]
+            return None
+        return item[0]
+
+    def _expires(self, ttl):
+        if ttl == 0:
+            return 0
+        if ttl > MAX_TTL:
+            return ttl
+        return time() + ttl
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shellac benchmark stand-ins')
+    parser.add_argument('which', choices=['origin', 'memcached'])
+    parser.add_argument('port', type=int)
+    parser.add_argument('--sizes', default='1024,8192,65536',
+                            help='Body sizes in bytes, /obj/<n> gets the n-th modulo.')
+    parser.add_argument('--latency', type=float, default=0,
+                            help='Milliseconds the origin takes per request.')
+    parser.add_argument('--cache-control', default='max-age=300')
+    args = parser.parse_args()
+
+    if args.which == 'origin':
+        run_origin(args.port, [int(s) for s in args.sizes.split(',')], args.latency / 1000.0,
+                   cache_control = args.cache_control)
+    else:
+        MemcacheStandIn(args.port).run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""
+    Upstream load balancing strategies
+
+    A balancer picks which UpstreamPool a request should go
+    to. Every strategy has the same interface, choose(key)
+    with the request's cache key, so the server doesn't care
+    which one it has been given:
+
+        least-outstanding  fewest requests in flight per unit
+                           of weight, ties go round the pools
+        round-robin        smooth weighted round-robin, as in
+                           nginx: a backend of weight 3 gets
+                           three of every four requests next
+                           to one of weight 1, interleaved
+        url-hash           consistent hash of the key, so a
+                           URL's misses keep going to the same
+                           origin and its local caches stay warm
+        random             the old behaviour
+
+    Pools carry their own weight() and outstanding() counts.
+    Backends that aren't healthy() are skipped; url-hash moves
+    their keys to the next backend round the ring. choose()
+    returns None when no backend is healthy.
+
+    Usage:
+        pools = [UpstreamPool(('10.0.0.1', 80), weight = 3),
+                 UpstreamPool(('10.0.0.2', 80))]
+        balancer = make_balancer('least-outstanding', pools)
+        pool = balancer.choose('/index.html')
+
+    Limitations:
+        - url-hash ignores load entirely, a hot URL pins one origin
+        - not thread safe, designed for a reactor
+
+"""
+
+import struct
+import hashlib
+
+from bisect import bisect
+from random import choice
+
+# points per unit of weight on the url-hash ring
+RING_POINTS = 160
+
+class Balancer(object):
+
+    def __init__(self, pools):
+        """ Balance across a list of UpstreamPools """
+        self._pools = pools
+
+    def pools(self):
+        return self._pools
+
+    def choose(self, key):
+        """ The pool a request for key should go to, None if all are down """
+        raise NotImplementedError
+
+    def _healthy(self):
+        return [p for p in self._pools if p.healthy()]
+
+
+class RandomBalancer(Balancer):
+
+    def choose(self, key):
+        pools = self._healthy()
+        if not pools:
+            return None
+        return choice(pools)
+
+
+class LeastOutstandingBalancer(Balancer):
+
+    def __init__(self, pools):
+        Balancer.__init__(self, pools)
+        self._next = 0
+
+    def choose(self, key):
+        pools = self._pools
+        n = len(pools)
+
+        # start where we left off so ties are spread evenly
+        start = self._next
+        self._next = (start + 1) % n
+
+        best = None
+        best_load = None
+        for i in xrange(n):
+            pool = pools[(start + i) % n]
+            if not pool.healthy():
+                continue
+            load = float(pool.outstanding()) / pool.weight()
+            if best is None or load < best_load:
+                best = pool
+                best_load = load
+
+        return best
+
+
+class RoundRobinBalancer(Balancer):
+
+    def __init__(self, pools):
+        Balancer.__init__(self, pools)
+        self._current = [0] * len(pools)
+
+    def choose(self, key):
+        pools = self._pools
+        current = self._current
+
+        best = -1
+        total = 0
+        for i in xrange(len(pools)):
+            if not pools[i].healthy():
+                continue
+            weight = pools[i].weight()
+            current[i] += weight
+            total += weight
+            if best == -1 or current[i] > current[best]:
+                best = i
+
+        if best == -1:
+            return None
+
+        current[best] -= total
+        return pools[best]
+
+
+class UrlHashBalancer(Balancer):
+
+    def __init__(self, pools):
+        Balancer.__init__(self, pools)
+
+        ring = []
+        for idx, pool in enumerate(pools):
+            (host, port) = pool.address()
+            for i in xrange(RING_POINTS * pool.weight() / 4):
+                d = hashlib.md5('%s:%d-%d' % (host, port, i)).digest()
+                for j in xrange(4):
+                    ring.append((struct.unpack('<I', d[j*4:j*4+4])[0], idx))
+        ring.sort()
+
+        self._points = [p for p, _ in ring]
+        self._ring = [pools[i] for _, i in ring]
+
+    def choose(self, key):
+        if not any(p.healthy() for p in self._pools):
+            return None
+
+        point = struct.unpack('<I', hashlib.md5(key).digest()[:4])[0]
+        idx = bisect(self._points, point)
+
+        # walk round to the first healthy backend
+        ring = self._ring
+        n = len(ring)
+        while True:
+            if idx >= n:
+                idx = 0
+            pool = ring[idx]
+            if pool.healthy():
+                return pool
+            idx += 1
+
+
+BALANCERS = {
+    'least-outstanding': LeastOutstandingBalancer,
+    'round-robin':       RoundRobinBalancer,
+    'url-hash':          UrlHashBalancer,
+    'random':            RandomBalancer
+}
+
+def make_balancer(name, pools):
+    """ Create the balancer called name over pools """
+
+    if name not in BALANCERS:
+        raise ValueError('Unknown balancer: %s' % name)
+    return BALANCERS[name](pools)
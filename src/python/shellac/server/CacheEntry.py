@@ -0,0 +1,509 @@
+#!/usr/bin/env python
+"""
+    A cached response and what's needed to keep it
+
+    CacheEntry holds a response as it goes to clients, its
+    head (status line and headers) and body, with when it was
+    stored, how long it's fresh for and its validators (ETag
+    and Last-Modified). The validators let a stale entry be
+    revalidated with a conditional request instead of fetched
+    again, and let clients' own conditional requests be
+    answered with a 304 straight from the cache.
+
+    Past its freshness an entry may still be served for a
+    while: for stale_while_revalidate seconds while a refresh
+    goes upstream in the background, and for stale_if_error
+    seconds when the origin can't give us anything better.
+    delta is how long the response took to fetch; early()
+    uses it for probabilistic early expiry (XFetch), so that
+    a hot key is refreshed a little before it goes stale,
+    and by one request rather than by all of them at once.
+
+    pack() turns an entry into a compact binary string for
+    memcached and unpack() turns it back; len() is the
+    response's length, so entries can go straight into an
+    LruCache. A packed entry is a fixed header (format
+    version, flags, times, status, field lengths and the
+    body's offset), the entry's full key, its validators, the
+    headers and then the body. Headers are written as an
+    index into STATIC_HEADERS where they're common, whole
+    header or just its name, and literally where not. The
+    key is there because memcached only ever sees a digest
+    of it: unpack() given a different key refuses the entry
+    rather than serve the wrong object on a collision.
+
+    Bodies too big for one memcached item are split(): the
+    pieces go under segment_keys() derived from the entry's
+    key and a manifest, an entry with everything but the
+    body, goes under the key itself. The keys carry a random
+    tag so a manifest never picks up the segments of an
+    older or newer copy.
+
+    deflate() and inflate() compress the body for storage
+    and back; a deflated entry's body is zlib data until
+    it's inflated, and so are a deflated manifest's segments.
+
+    Usage:
+        entry = CacheEntry(response.head(), body, time(), 60,
+                           headers.get('etag'), headers.get('last-modified'),
+                           stale_while_revalidate = 10, delta = 0.2)
+        mc.set(digest(key), entry.pack(key), entry.lifetime(keep = 3600))
+        ...
+        entry = CacheEntry.unpack(blob, key)
+        if entry.fresh() or entry.stale_ok():
+            if entry.not_modified(request):
+                send(entry.not_modified_response())
+            else:
+                send(entry.head())
+                send(entry.body())
+            if not entry.fresh() or entry.early(beta = 1.0):
+                refresh_in_background(entry.validators())
+        else:
+            request.headers().update(entry.validators())
+
+        if len(entry) > SEGMENT_SIZE:
+            (manifest, pieces) = entry.split(SEGMENT_SIZE)
+            for k, piece in zip(manifest.segment_keys(key), pieces):
+                mc.set(digest(k), piece, ttl)
+            mc.set(digest(key), manifest.pack(key), ttl)
+
+    Limitations:
+        - a 304's headers don't update the stored response's
+        - a manifest can outlive its segments if memcached
+          evicts them, readers must expect misses
+        - header values over 64KB can't be packed
+        - weak and strong ETags are compared alike, which is
+          what If-None-Match calls for anyway
+        - not thread safe, designed for a reactor
+
+"""
+
+
+import zlib
+import struct
+
+from time import time
+from math import log
+from random import random, getrandbits
+
+from CachePolicy import http_date, MAX_TTL
+
+# first bytes of a packed entry, and the version of the format after them
+MAGIC = 'SE'
+VERSION = 2
+
+# what a packed entry holds
+KIND_ENTRY = 0
+KIND_MANIFEST = 1
+
+# flags
+FLAG_DEFLATED = 0x01
+
+# magic, version, kind, flags, stored, ttl, stale-while-revalidate,
+# stale-if-error, delta, status, key len, etag len, last-modified len, body offset
+HEADER = struct.Struct('!2sBBBdIIIfHHHHI')
+
+# a manifest's segments: count, body length, tag
+SEGMENTS = struct.Struct('!II8s')
+
+# HTTP version (10 or 11), reason phrase length
+STATUS = struct.Struct('!BB')
+
+# a header: index into STATIC_HEADERS (0 for a literal name), value length
+FIELD = struct.Struct('!BH')
+
+# headers written as an index, (name, value) for whole headers, (name, None)
+# where only the name is common. Only ever append: indexes are in the wild.
+STATIC_HEADERS = (
+    ('Server', 'Shellac/0.1.0a'),
+    ('Connection', 'keep-alive'),
+    ('Keep-Alive', 'timeout=5, max=100'),
+    ('Content-Encoding', 'gzip'),
+    ('Vary', 'Accept-Encoding'),
+    ('Content-Type', 'text/html'),
+    ('Content-Type', 'text/html; charset=utf-8'),
+    ('Content-Type', 'text/css'),
+    ('Content-Type', 'application/javascript'),
+    ('Content-Type', 'application/json'),
+    ('Content-Type', 'image/png'),
+    ('Content-Type', 'image/jpeg'),
+    ('Content-Type', 'image/gif'),
+    ('Cache-Control', None),
+    ('Content-Type', None),
+    ('Content-Length', None),
+    ('Content-Encoding', None),
+    ('Date', None),
+    ('Etag', None),
+    ('Expires', None),
+    ('Last-Modified', None),
+    ('Server', None),
+    ('Vary', None),
+    ('Age', None),
+    ('Location', None),
+    ('Content-Language', None),
+    ('Content-Disposition', None),
+    ('Access-Control-Allow-Origin', None),
+    ('X-Content-Type-Options', None),
+    ('X-Frame-Options', None),
+    ('Strict-Transport-Security', None),
+    ('Content-Security-Policy', None),
+    ('Link', None),
+    ('Via', None),
+    ('Pragma', None),
+    ('X-Powered-By', None),
+    ('Keep-Alive', None),
+    ('Connection', None),
+)
+
+# (lower case name, value) => index, and lower case name => index
+_WHOLE = dict(((n.lower(), v), i + 1) for i, (n, v) in enumerate(STATIC_HEADERS)
+              if v is not None)
+_NAMES = dict((n.lower(), i + 1) for i, (n, v) in enumerate(STATIC_HEADERS)
+              if v is None)
+
+class CacheEntry(object):
+
+    __slots__ = ('_head', '_body', '_stored', '_ttl', '_etag', '_modified',
+                 '_swr', '_sie', '_delta', '_segments', '_deflated')
+
+    def __init__(self, head, body, stored, ttl, etag = None, modified = None,
+                 stale_while_revalidate = 0, stale_if_error = 0, delta = 0,
+                 segments = None, deflated = False):
+        """ A response (as sent to clients) stored at time stored, fresh for ttl seconds
+
+            segments is (count, length, tag) for a manifest, whose body
+            is '' and lives in segments elsewhere. deflated says the body
+            (or the segments) is compressed.
+        """
+
+        self._head = head
+        self._body = body
+        self._stored = stored
+        self._ttl = ttl
+        self._etag = etag or None
+        self._modified = modified or None
+        self._swr = stale_while_revalidate
+        self._sie = stale_if_error
+        self._delta = delta
+        self._segments = segments
+        self._deflated = deflated
+
+    def __len__(self):
+        return len(self._head) + len(self._body)
+
+    def head(self):
+        return self._head
+
+    def body(self):
+        return self._body
+
+    def status(self):
+        return int(self._head[9:12])
+
+    def header(self, name):
+        """ The value of a header in the head, or None """
+
+        name = name.lower()
+        for line in self._head.split('\r\n')[1:]:
+            (key, colon, value) = line.partition(':')
+            if colon and key.strip().lower() == name:
+                return value.strip()
+        return None
+
+    def stored(self):
+        return self._stored
+
+    def ttl(self):
+        return self._ttl
+
+    def etag(self):
+        return self._etag
+
+    def last_modified(self):
+        return self._modified
+
+    def stale_while_revalidate(self):
+        return self._swr
+
+    def stale_if_error(self):
+        return self._sie
+
+    def delta(self):
+        return self._delta
+
+    def deflated(self):
+        """ Is the body (or are the segments) compressed? """
+        return self._deflated
+
+    def deflate(self, level = 6):
+        """ The same entry with its body compressed """
+
+        return CacheEntry(self._head, zlib.compress(self._body, level), self._stored,
+                          self._ttl, self._etag, self._modified, self._swr, self._sie,
+                          self._delta, self._segments, True)
+
+    def inflate(self):
+        """ The same entry with its body as it's sent, raises zlib.error if it's corrupt """
+
+        if not self._deflated:
+            return self
+        return CacheEntry(self._head, zlib.decompress(self._body), self._stored,
+                          self._ttl, self._etag, self._modified, self._swr, self._sie,
+                          self._delta, self._segments, False)
+
+    def segmented(self):
+        """ Is this a manifest, with the body stored in segments? """
+        return self._segments is not None
+
+    def length(self):
+        """ The body's length as stored, wherever it's stored """
+        if self._segments is not None:
+            return self._segments[1]
+        return len(self._body)
+
+    def segment_keys(self, key):
+        """ Keys of a manifest's segments, in order, given its own key """
+
+        (count, _, tag) = self._segments
+        return ['%s#%s.%d' % (key, tag, i) for i in xrange(count)]
+
+    def split(self, size):
+        """ (manifest, pieces): the body cut into pieces of at most size bytes """
+
+        body = self._body
+        pieces = [body[i:i + size] for i in xrange(0, len(body), size)]
+        manifest = CacheEntry(self._head, '', self._stored, self._ttl, self._etag,
+                              self._modified, self._swr, self._sie, self._delta,
+                              (len(pieces), len(body), '%08x' % getrandbits(32)),
+                              self._deflated)
+        return (manifest, pieces)
+
+    def expires(self):
+        """ When the entry goes stale """
+        return self._stored + self._ttl
+
+    def fresh(self, now = None):
+        if now is None:
+            now = time()
+        return now < self._stored + self._ttl
+
+    def stale_ok(self, now = None):
+        """ May it be served, stale, while a refresh is under way? """
+        if now is None:
+            now = time()
+        return now < self._stored + self._ttl + self._swr
+
+    def error_ok(self, now = None):
+        """ May it be served, stale, because the origin failed? """
+        if now is None:
+            now = time()
+        return now < self._stored + self._ttl + self._sie
+
+    def early(self, beta = 1.0, now = None):
+        """ XFetch: should this request refresh the entry ahead of time? """
+
+        if beta <= 0 or self._delta <= 0:
+            return False
+        if now is None:
+            now = time()
+        return now - self._delta * beta * log(1.0 - random()) >= self._stored + self._ttl
+
+    def revalidatable(self):
+        """ Can a stale copy be checked with the origin rather than refetched? """
+        return self._etag is not None or self._modified is not None
+
+    def lifetime(self, keep = 0, now = None):
+        """ Seconds a cache should hold the entry: until stale, plus as long as
+            it may be served stale, or keep if that's longer and it's revalidatable.
+            Never more than MAX_TTL, memcached reads longer times as timestamps.
+        """
+
+        if now is None:
+            now = time()
+        if not self.revalidatable():
+            keep = 0
+        left = int(self.expires() - now) + max(self._swr, self._sie, keep)
+        return min(max(left, 0), MAX_TTL)
+
+    def refreshed(self, ttl, now = None):
+        """ The same response, fresh again for ttl seconds """
+
+        if now is None:
+            now = time()
+        return CacheEntry(self._head, self._body, now, ttl, self._etag, self._modified,
+                          self._swr, self._sie, self._delta, self._segments, self._deflated)
+
+    def validators(self):
+        """ Headers for a conditional request to the origin """
+
+        headers = {}
+        if self._etag is not None:
+            headers['if-none-match'] = self._etag
+        if self._modified is not None:
+            headers['if-modified-since'] = self._modified
+        return headers
+
+    def not_modified(self, request):
+        """ Does the request's own If-None-Match/If-Modified-Since match us? """
+
+        headers = request.headers()
+
+        inm = headers.get('if-none-match', None)
+        if inm is not None:
+            if isinstance(inm, list):
+                inm = ', '.join(inm)
+            if self._etag is None:
+                return False
+            tags = [t.strip() for t in inm.split(',')]
+            return '*' in tags or weak(self._etag) in [weak(t) for t in tags]
+
+        ims = headers.get('if-modified-since', None)
+        if ims is not None and self._modified is not None:
+            since = http_date(ims)
+            modified = http_date(self._modified)
+            return since is not None and modified is not None and modified <= since
+
+        return False
+
+    def not_modified_response(self):
+        """ A 304 for this entry """
+
+        h = ['HTTP/1.1 304 Not Modified\r\nServer: Shellac/0.1.0a\r\n']
+        if self._etag is not None:
+            h.append('ETag: %s\r\n' % self._etag)
+        if self._modified is not None:
+            h.append('Last-Modified: %s\r\n' % self._modified)
+        h.append('Keep-Alive: timeout=5, max=100\r\nConnection: keep-alive\r\n\r\n')
+        return ''.join(h)
+
+    def pack(self, key):
+        """ The entry as a string, key is checked again by unpack() """
+
+        etag = self._etag or ''
+        modified = self._modified or ''
+        kind = KIND_MANIFEST
+        if self._segments is None:
+            kind = KIND_ENTRY
+        flags = 0
+        if self._deflated:
+            flags |= FLAG_DEFLATED
+
+        parts = ['', key, etag, modified]
+        if kind == KIND_MANIFEST:
+            parts.insert(1, SEGMENTS.pack(*self._segments))
+        parts.append(pack_head(self._head))
+
+        offset = HEADER.size + sum(len(p) for p in parts)
+        parts[0] = HEADER.pack(MAGIC, VERSION, kind, flags, self._stored, self._ttl, self._swr,
+                               self._sie, self._delta, self.status(), len(key),
+                               len(etag), len(modified), offset)
+        parts.append(self._body)
+        return ''.join(parts)
+
+    @staticmethod
+    def unpack(blob, key = None):
+        """ An entry (or manifest) from pack(), or None if blob isn't one or
+            (given key) belongs to another key
+        """
+
+        if len(blob) < HEADER.size or not blob.startswith(MAGIC):
+            return None
+
+        (_, version, kind, flags, stored, ttl, swr, sie, delta, status, keylen, etaglen,
+            lmlen, offset) = HEADER.unpack_from(blob)
+
+        if version != VERSION or offset > len(blob):
+            return None
+
+        pos = HEADER.size
+        segments = None
+        if kind == KIND_MANIFEST:
+            segments = SEGMENTS.unpack_from(blob, pos)
+            pos += SEGMENTS.size
+
+        if key is not None and blob[pos:pos + keylen] != key:
+            # someone else's entry under the same digest
+            return None
+        pos += keylen
+
+        etag = blob[pos:pos + etaglen]
+        pos += etaglen
+        modified = blob[pos:pos + lmlen]
+        pos += lmlen
+
+        try:
+            head = unpack_head(blob, pos, offset, status)
+        except (struct.error, IndexError):
+            return None
+
+        return CacheEntry(head, blob[offset:], stored, ttl, etag, modified,
+                          swr, sie, delta, segments, bool(flags & FLAG_DEFLATED))
+
+def pack_head(head):
+    """ A response head in the packed format """
+
+    lines = head.split('\r\n')
+    (version, _, reason) = lines[0].split(' ', 2)
+    reason = reason[:255]
+    out = [STATUS.pack(11 if version == 'HTTP/1.1' else 10, len(reason)), reason]
+
+    for line in lines[1:]:
+        if not line:
+            break
+        # origins don't all put a space after the colon
+        (name, colon, value) = line.partition(':')
+        if not colon:
+            continue
+        name = name.strip()
+        value = value.strip()
+        lname = name.lower()
+
+        index = _WHOLE.get((lname, value), 0)
+        if index != 0:
+            out.append(FIELD.pack(index, 0))
+            continue
+
+        if len(value) > 0xffff:
+            raise ValueError('Header too long to pack: %s' % name)
+
+        index = _NAMES.get(lname, 0)
+        out.append(FIELD.pack(index, len(value)))
+        if index == 0:
+            out.append(chr(len(name)) + name)
+        out.append(value)
+
+    return ''.join(out)
+
+def unpack_head(blob, pos, end, status):
+    """ A response head from the packed format in blob[pos:end] """
+
+    (version, rlen) = STATUS.unpack_from(blob, pos)
+    pos += STATUS.size
+    reason = blob[pos:pos + rlen]
+    pos += rlen
+
+    h = ['HTTP/%.1f %d %s\r\n' % (version / 10.0, status, reason)]
+
+    while pos < end:
+        (index, vlen) = FIELD.unpack_from(blob, pos)
+        pos += FIELD.size
+
+        if index == 0:
+            nlen = ord(blob[pos])
+            name = blob[pos + 1:pos + 1 + nlen]
+            pos += 1 + nlen
+        else:
+            (name, value) = STATIC_HEADERS[index - 1]
+            if value is not None:
+                h.append('%s: %s\r\n' % (name, value))
+                continue
+
+        h.append('%s: %s\r\n' % (name, blob[pos:pos + vlen]))
+        pos += vlen
+
+    h.append('\r\n')
+    return ''.join(h)
+
+def weak(tag):
+    """ An entity tag without its weak marker """
+    return tag[2:] if tag.startswith('W/') else tag
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""
+    HTTP caching rules for a shared cache
+
+    CachePolicy decides what Shellac may store and for how
+    long, following RFC 7234 for a shared cache: only GETs
+    are looked up, responses marked no-store, private or
+    no-cache, or carrying Set-Cookie or Vary: *, are never
+    stored, and the lifetime comes from s-maxage, max-age or
+    Expires (less any Age), falling back to the configured
+    TTL for statuses that are cacheable by default.
+
+    How long a response may be served stale, while it's being
+    refreshed or when the origin is failing, comes from the
+    stale-while-revalidate and stale-if-error directives
+    (RFC 5861) or the configured defaults; must-revalidate
+    and proxy-revalidate rule it out.
+
+    Cache keys are built from the method, Host and URL. When
+    a response varies, a small marker listing the Vary'd
+    headers is stored under the plain key and the response
+    itself under a variant key that adds the request's
+    values for those headers. A lookup that finds a marker
+    goes round again with the variant key.
+
+    memcached takes keys of up to 250 bytes with no spaces or
+    control characters, so what it's given is a digest() of
+    the cache key; entries carry the full key to catch the
+    odd collision.
+
+    Usage:
+        policy = CachePolicy(default_ttl = 170)
+        if policy.lookup(request):
+            key = policy.key(request)
+        ...
+        ttl = policy.ttl(request, response)
+        if ttl > 0:
+            vary = policy.vary(response)
+            if vary:
+                mc.set(key, policy.marker(vary), ttl)
+                key = policy.variant_key(key, request, vary)
+            mc.set(digest(key), str(response), ttl)
+
+    Limitations:
+        - no heuristic freshness from Last-Modified
+        - requests' own Cache-Control is ignored
+        - not thread safe, designed for a reactor
+
+"""
+
+import hashlib
+
+from time import time
+from email.utils import parsedate_tz, mktime_tz
+
+# statuses that may be stored without explicit freshness
+CACHEABLE_STATUS = frozenset([200, 203, 204, 300, 301, 404, 405, 410, 414, 501])
+
+# memcached takes expiry times past 30 days as timestamps
+MAX_TTL = 2592000
+
+# prefix of an entry that points at the variants of a key
+VARY_MARKER = 'SHELLAC-VARY:'
+
+def header(headers, name):
+    """ A header's value with repeats joined, or None """
+
+    value = headers.get(name, None)
+    if isinstance(value, list):
+        return ', '.join(value)
+    return value
+
+def directives(value):
+    """ Parse a Cache-Control value into {directive: argument or None} """
+
+    result = {}
+    if not value:
+        return result
+
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '=' in part:
+            (k, v) = part.split('=', 1)
+            result[k.strip().lower()] = v.strip().strip('"')
+        else:
+            result[part.lower()] = None
+    return result
+
+def http_date(value):
+    """ An HTTP date as a timestamp, or None """
+
+    if not value:
+        return None
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    try:
+        return mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
+
+def digest(key):
+    """ The memcached key for a cache key: short, and safe whatever the URL """
+    return hashlib.md5(key).hexdigest()
+
+def seconds(value):
+    """ A delta-seconds argument as an int, or None """
+
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class CachePolicy(object):
+
+    def __init__(self, default_ttl = 170, stale_while_revalidate = 0, stale_if_error = 0):
+        """ default_ttl applies when a response doesn't say how long it's fresh """
+        self._default_ttl = default_ttl
+        self._swr = stale_while_revalidate
+        self._sie = stale_if_error
+
+    def lookup(self, request):
+        """ May a response to this request come from the cache? """
+        return request.method() == 'GET'
+
+    def key(self, request):
+        """ The cache key for a request, before any Vary """
+
+        host = header(request.headers(), 'host') or ''
+        return '%s %s%s' % (request.method(), host.lower(), request.url())
+
+    def vary(self, response):
+        """ Sorted request header names the response varies on, [] if none """
+
+        value = header(response.headers(), 'vary')
+        if not value:
+            return []
+        return sorted(set(h.strip().lower() for h in value.split(',') if h.strip()))
+
+    def variant_key(self, key, request, vary):
+        """ The key of the variant of key that matches request """
+
+        headers = request.headers()
+        values = []
+        for h in vary:
+            value = header(headers, h) or ''
+            if h == 'accept-encoding':
+                # upstreams are always asked for gzip, all that matters
+                # is whether this client takes it
+                value = 'gzip' if 'gzip' in value.lower() else ''
+            values.append('\n%s: %s' % (h, value))
+        return key + ''.join(values)
+
+    def marker(self, vary):
+        """ The entry stored under a key that has variants """
+        return VARY_MARKER + ','.join(vary)
+
+    def parse_marker(self, blob):
+        """ The Vary'd header names if blob is a marker, else None """
+
+        if not blob.startswith(VARY_MARKER):
+            return None
+        return blob[len(VARY_MARKER):].split(',')
+
+    def ttl(self, request, response, now = None):
+        """ Seconds the response may be stored for, 0 if it mustn't be """
+
+        if not self.lookup(request):
+            return 0
+
+        headers = response.headers()
+        cc = directives(header(headers, 'cache-control'))
+
+        if 'no-store' in cc or 'private' in cc or 'no-cache' in cc:
+            return 0
+
+        if 'set-cookie' in headers or '*' in self.vary(response):
+            return 0
+
+        if 'authorization' in request.headers() and \
+           not ('public' in cc or 's-maxage' in cc or 'must-revalidate' in cc):
+            return 0
+
+        if response.status() in (206, 304):
+            # partial, or nothing to store
+            return 0
+
+        default = self._default_ttl
+        if response.status() not in CACHEABLE_STATUS:
+            default = 0
+
+        return self._lifetime(headers, cc, default, now)
+
+    def stale(self, response):
+        """ (stale-while-revalidate, stale-if-error) seconds for a response """
+
+        cc = directives(header(response.headers(), 'cache-control'))
+        if 'must-revalidate' in cc or 'proxy-revalidate' in cc:
+            return (0, 0)
+
+        swr = seconds(cc.get('stale-while-revalidate', None))
+        sie = seconds(cc.get('stale-if-error', None))
+        return (self._swr if swr is None else max(swr, 0),
+                self._sie if sie is None else max(sie, 0))
+
+    def refresh_ttl(self, response, ttl, now = None):
+        """ Seconds a revalidated entry stays fresh, given the origin's 304 """
+
+        headers = response.headers()
+        cc = directives(header(headers, 'cache-control'))
+
+        if 'no-store' in cc or 'no-cache' in cc:
+            return 0
+        return self._lifetime(headers, cc, ttl, now)
+
+    def _lifetime(self, headers, cc, default, now):
+        """ Freshness lifetime from the headers, less Age """
+
+        lifetime = seconds(cc.get('s-maxage', None))
+        if lifetime is None:
+            lifetime = seconds(cc.get('max-age', None))
+
+        if lifetime is None and 'expires' in headers:
+            expires = http_date(header(headers, 'expires'))
+            if expires is None:
+                # malformed means already expired
+                return 0
+            if now is None:
+                now = time()
+            date = http_date(header(headers, 'date')) or now
+            lifetime = int(expires - date)
+
+        if lifetime is None:
+            lifetime = default
+
+        age = seconds(header(headers, 'age')) or 0
+        lifetime -= age
+
+        if lifetime <= 0:
+            return 0
+        return min(lifetime, MAX_TTL)
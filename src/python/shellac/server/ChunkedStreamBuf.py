@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+    A segmented stream buffer
+
+    ChunkedStreamBuf has the same producer/consumer API
+    as StreamBuf but never concatenates: each write()
+    appends a segment to a deque and ack(n) drops the
+    segments that have been fully consumed. view() and
+    views() hand out memoryview slices of the pending
+    segments so a socket can send them without copying,
+    views() being suitable for a vectored sendmsg().
+
+    Usage:
+        s = ChunkedStreamBuf('Hello')
+        s.write(', world!')
+        print s.views()
+        -> [<memory at ...>, <memory at ...>]
+        sent = sock.send(s.view())
+        s.ack(sent)
+        s.close()
+
+    Limitations:
+        - no seek() or buffer(), acked data is released
+        - read() still copies, use view()/views() to send
+        - Not thread safe
+
+"""
+
+from collections import deque
+
+# small leading segments are glued together up to this
+# size so they go out in one send() instead of several
+COALESCE_SIZE = 16384
+
+# most segments handed to a single sendmsg()
+IOV_MAX = 1024
+
+class ChunkedStreamBuf(object):
+
+    def __init__(self, data = None):
+        self._segs = deque()
+        self._off = 0
+        self._len = 0
+        self._acked = 0
+        self._eof = False
+        self._ready = False
+
+        if data:
+            self.write(data)
+
+    def write(self, data):
+        self._ready = True
+        if len(data) != 0:
+            self._segs.append(data)
+            self._len += len(data)
+
+    def ack(self, bytes):
+        self._acked += bytes
+
+        segs = self._segs
+        off = self._off + bytes
+        while segs and off >= len(segs[0]):
+            off -= len(segs.popleft())
+        self._off = off
+
+    def read(self):
+        if not self._segs:
+            return ''
+        if len(self._segs) == 1:
+            return self._segs[0][self._off:]
+        return ''.join(self._segs)[self._off:]
+
+    def view(self):
+        """ The pending bytes at the head, without copying large segments """
+
+        segs = self._segs
+        if not segs:
+            return ''
+
+        if len(segs) > 1 and len(segs[0]) - self._off < COALESCE_SIZE:
+            parts = [segs.popleft()[self._off:]]
+            size = len(parts[0])
+            while segs and size + len(segs[0]) <= COALESCE_SIZE:
+                size += len(segs[0])
+                parts.append(segs.popleft())
+            segs.appendleft(''.join(parts))
+            self._off = 0
+
+        return memoryview(segs[0])[self._off:]
+
+    def views(self):
+        """ memoryviews over the pending segments, for sendmsg() """
+
+        segs = self._segs
+        if not segs:
+            return []
+
+        views = [memoryview(segs[0])[self._off:]]
+        for i in xrange(1, min(len(segs), IOV_MAX)):
+            views.append(memoryview(segs[i]))
+        return views
+
+    def pending(self):
+        return self._len - self._acked
+
+    def close(self):
+        self._eof = True
+
+    def clear(self):
+        self._segs.clear()
+        self._off = 0
+        self._len = 0
+        self._acked = 0
+        self._eof = False
+        self._ready = False
+
+    def complete(self):
+        return self._eof and self._acked >= self._len
+
+    def closed(self):
+        return self._eof
+
+    def ready(self):
+        return self._ready
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""
+    Adaptive compression of cache entries
+
+    Compressor decides which CacheEntry bodies are worth
+    storing compressed and does the work. Text-like bodies
+    (HTML, CSS, scripts, JSON, XML, SVG) over min_size bytes
+    are deflated; bodies the origin already encoded and types
+    that are compressed by nature (images, audio, video,
+    archives, web fonts) are left alone. Anything else is
+    tried. If deflating doesn't save at least min_saving of
+    a body, it is stored as it was.
+
+    It learns as it goes: once a content type has failed to
+    compress well patience times in a row, only one in retry
+    of its bodies is tried until one does well again.
+
+    The counters say what it costs and what it's worth:
+    bytes in and bytes stored against seconds of CPU spent
+    deflating and inflating, for sizing memcached against
+    the proxies' CPU.
+
+    Usage:
+        compressor = Compressor()
+        blob = compressor.deflate(entry).pack(key)
+        ...
+        entry = compressor.inflate(CacheEntry.unpack(blob, key))
+
+        # segments of a deflated manifest, in order
+        inflater = compressor.inflater()
+        for piece in pieces:
+            send(compressor.inflate_piece(inflater, piece))
+        send(compressor.inflate_piece(inflater, '', last = True))
+
+        print compressor.stats()
+        -> {'compressed': 1, 'bytes_in': 15000, 'bytes_out': 4000, ...}
+
+    Limitations:
+        - one zlib level for everything
+        - CPU time is the process's, measured around each call
+        - not thread safe, designed for a reactor
+
+"""
+
+import zlib
+
+from time import clock
+
+# smallest body worth compressing
+MIN_SIZE = 1024
+
+# least fraction of a body compressing must save
+MIN_SAVING = 0.2
+
+# zlib level, 6 is its default trade-off
+LEVEL = 6
+
+# poor results in a row before a type is only tried now and again
+PATIENCE = 8
+
+# ...and then one in how many
+RETRY = 64
+
+# text-like types, always tried
+TEXT_TYPES = frozenset(['application/json', 'application/javascript',
+                        'application/x-javascript', 'application/ecmascript',
+                        'application/xml', 'application/xhtml+xml',
+                        'application/rss+xml', 'application/atom+xml',
+                        'application/ld+json', 'application/manifest+json',
+                        'image/svg+xml', 'image/x-icon', 'font/ttf', 'font/otf'])
+
+# types that are compressed already, never tried
+PACKED_PREFIXES = ('image/', 'audio/', 'video/')
+PACKED_TYPES = frozenset(['application/zip', 'application/gzip', 'application/x-gzip',
+                          'application/x-bzip2', 'application/x-xz', 'application/x-7z-compressed',
+                          'application/x-rar-compressed', 'application/pdf',
+                          'application/wasm', 'font/woff', 'font/woff2',
+                          'application/font-woff'])
+
+def content_type(entry):
+    """ An entry's media type, lower case and without parameters """
+    return (entry.header('content-type') or '').split(';')[0].strip().lower()
+
+def compressible(ctype):
+    """ True for text-like types, False for packed ones, None if we can't tell """
+
+    if ctype.startswith('text/') or ctype in TEXT_TYPES or \
+       ctype.endswith('+xml') or ctype.endswith('+json'):
+        return True
+    if ctype in PACKED_TYPES or ctype.startswith(PACKED_PREFIXES):
+        return False
+    return None
+
+
+class Compressor(object):
+
+    def __init__(self, min_size = MIN_SIZE, min_saving = MIN_SAVING, level = LEVEL,
+                 patience = PATIENCE, retry = RETRY):
+        """ Compress bodies of at least min_size bytes that shrink by min_saving """
+
+        self._min_size = min_size
+        self._min_saving = min_saving
+        self._level = level
+        self._patience = patience
+        self._retry = retry
+
+        # content type => poor results in a row
+        self._poor = {}
+
+        self._stats = {'compressed': 0, 'uncompressible': 0, 'skipped': 0,
+                       'bytes_in': 0, 'bytes_out': 0, 'deflate_time': 0.0,
+                       'inflated': 0, 'inflate_time': 0.0}
+
+    def stats(self):
+        """ Counters, bytes_in - bytes_out is what it saved """
+        return dict(self._stats)
+
+    def deflate(self, entry):
+        """ The entry to store: deflated if that's worth it, else as it was """
+
+        stats = self._stats
+        body = entry.body()
+
+        if entry.deflated() or entry.segmented() or len(body) < self._min_size:
+            return entry
+
+        encoding = entry.header('content-encoding')
+        ctype = content_type(entry)
+        kind = compressible(ctype)
+
+        if kind is False or (encoding is not None and encoding.lower() != 'identity'):
+            stats['skipped'] += 1
+            return entry
+
+        poor = self._poor.get(ctype, 0)
+        if poor >= self._patience:
+            # hasn't been worth it lately, try only now and again
+            self._poor[ctype] = poor + 1
+            if (poor - self._patience + 1) % self._retry != 0:
+                stats['skipped'] += 1
+                return entry
+
+        start = clock()
+        deflated = entry.deflate(self._level)
+        stats['deflate_time'] += clock() - start
+
+        stats['bytes_in'] += len(body)
+
+        if len(deflated.body()) > len(body) * (1.0 - self._min_saving):
+            stats['uncompressible'] += 1
+            stats['bytes_out'] += len(body)
+            if poor < self._patience:
+                self._poor[ctype] = poor + 1
+            return entry
+
+        self._poor.pop(ctype, None)
+        stats['compressed'] += 1
+        stats['bytes_out'] += len(deflated.body())
+        return deflated
+
+    def inflate(self, entry):
+        """ The entry as it's sent, or None if its body is corrupt """
+
+        if not entry.deflated() or entry.segmented():
+            return entry
+
+        start = clock()
+        try:
+            entry = entry.inflate()
+        except zlib.error:
+            entry = None
+        self._stats['inflate_time'] += clock() - start
+        self._stats['inflated'] += 1
+
+        return entry
+
+    def inflater(self):
+        """ For inflating a deflated manifest's segments in order """
+        return zlib.decompressobj()
+
+    def inflate_piece(self, inflater, piece, last = False):
+        """ The next piece of a body, raises zlib.error if it's corrupt """
+
+        start = clock()
+        try:
+            data = inflater.decompress(piece)
+            if last:
+                data += inflater.flush()
+                self._stats['inflated'] += 1
+        finally:
+            self._stats['inflate_time'] += clock() - start
+
+        return data
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+    Active health checks for upstream web servers
+
+    HealthChecker probes each UpstreamPool's backend with a
+    small HTTP GET every interval seconds and reports the
+    outcome to the pool with succeeded() or failed(), so a
+    dead backend gets ejected before clients find out the
+    hard way. Any 2xx or 3xx status counts as healthy.
+
+    Like MemcacheClient it never blocks or polls on its own:
+    probe sockets are non-blocking, registered with the
+    caller's epoll object, and the caller hands over events
+    for the fds it owns(). Timeouts and scheduling run on
+    the caller's TimerWheel.
+
+    Backends that have been ejected are left alone until
+    they go half-open, the next probe is then their trial.
+
+    Usage:
+        health = HealthChecker(pools, epoll, timers, '/ping')
+        health.start()
+
+        for fd, event in epoll.poll(timers.timeout()):
+            if health.owns(fd):
+                if event & select.EPOLLIN:
+                    health.read(fd)
+                elif event & select.EPOLLOUT:
+                    health.write(fd)
+                else:
+                    health.close(fd)
+
+    Limitations:
+        - only the status line is checked, not the body
+        - one probe per backend in flight at a time
+        - not thread safe, designed for a reactor
+
+"""
+
+import errno
+import socket, select
+
+from HttpParser import HttpParser
+from UpstreamPool import DOWN
+
+# seconds between probes of each backend
+INTERVAL = 5
+
+# seconds a probe may take before it counts as a failure
+TIMEOUT = 2
+
+class HealthChecker(object):
+
+    def __init__(self, pools, epoll, timers, path = '/',
+                 interval = INTERVAL, timeout = TIMEOUT):
+        """ Probe GET path on every pool's backend """
+
+        self._pools = pools
+        self._epoll = epoll
+        self._timers = timers
+        self._path = path
+        self._interval = interval
+        self._timeout = timeout
+
+        # fd => [sock, pool, out, response, timer, connected]
+        self._probes = {}
+
+        # pools with a probe in flight
+        self._probing = set()
+
+    def start(self):
+        """ Probe every backend now, and every interval after """
+        for pool in self._pools:
+            self._probe(pool)
+
+    def owns(self, fd):
+        """ Is fd one of our probes? """
+        return fd in self._probes
+
+    def _probe(self, pool):
+        """ Timer: start a probe of pool's backend """
+
+        self._timers.schedule(self._interval, self._probe, pool)
+
+        if pool in self._probing or pool.state() == DOWN:
+            return
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+
+        err = sock.connect_ex(pool.address())
+        if err not in (0, errno.EINPROGRESS):
+            sock.close()
+            pool.failed()
+            return
+
+        fd = sock.fileno()
+        out = 'GET %s HTTP/1.1\r\nHost: %s:%d\r\nConnection: close\r\n' \
+              'User-Agent: Shellac\r\n\r\n' % ((self._path,) + pool.address())
+
+        # spec: sock, pool, out, response, timer, connected
+        probe = [sock, pool, out, HttpParser(raw = True), None, False]
+        probe[4] = self._timers.schedule(self._timeout, self._expire, fd, probe)
+
+        self._probes[fd] = probe
+        self._probing.add(pool)
+
+        self._epoll.register(fd, select.EPOLLOUT | select.EPOLLRDHUP)
+
+    def _expire(self, fd, probe):
+        """ Timer: a probe took too long """
+
+        if self._probes.get(fd) is probe:
+            self._finish(fd, False)
+
+    def _finish(self, fd, ok):
+        """ Tear down a probe and tell its pool how it went """
+
+        probe = self._probes.pop(fd)
+        pool = probe[1]
+
+        self._probing.discard(pool)
+        self._timers.cancel(probe[4])
+
+        try:
+            self._epoll.unregister(fd)
+        except (IOError, ValueError):
+            pass
+        probe[0].close()
+
+        if ok:
+            pool.succeeded()
+        else:
+            pool.failed()
+
+    def write(self, fd):
+        """ Handle EPOLLOUT on a probe """
+
+        probe = self._probes[fd]
+        sock = probe[0]
+
+        if not probe[5]:
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                self._finish(fd, False)
+                return
+            probe[5] = True
+
+        try:
+            sent = sock.send(probe[2])
+        except socket.error:
+            self._finish(fd, False)
+            return
+
+        probe[2] = probe[2][sent:]
+        if len(probe[2]) == 0:
+            self._epoll.modify(fd, select.EPOLLIN | select.EPOLLRDHUP)
+
+    def read(self, fd):
+        """ Handle EPOLLIN on a probe, the status line is all we need """
+
+        probe = self._probes[fd]
+
+        try:
+            data = probe[0].recv(4096)
+        except socket.error:
+            data = ''
+
+        if len(data) == 0:
+            self._finish(fd, False)
+            return
+
+        response = probe[3]
+        try:
+            response.parse(data, len(data))
+        except Exception:
+            self._finish(fd, False)
+            return
+
+        if response.headers_complete():
+            self._finish(fd, 200 <= response.status() < 400)
+
+    def close(self, fd):
+        """ Handle a hangup on a probe """
+        self._finish(fd, False)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+    Fixed-bucket log-linear latency histograms
+
+    Histogram counts durations into a fixed array of buckets:
+    each power of two is cut into 2^sub_bits equal steps, so
+    a value lands in a bucket no more than 1/2^sub_bits wider
+    than itself (about 6% with the default of 4) whether it's
+    a few microseconds or a few minutes. Recording is a couple
+    of shifts and an add, cheap enough to do on every request,
+    and percentiles are read off the counts without keeping
+    any samples.
+
+    Durations are recorded in seconds with microsecond
+    resolution; stats() reports in milliseconds. Histograms
+    from several processes add up bucket by bucket, see
+    buckets() and load().
+
+    Usage:
+        h = Histogram()
+        h.record(0.0042)
+        ...
+        print h.percentile(99)
+        -> 0.0042
+        print h.stats()
+        -> {'count': 1, 'p50': 4.2, 'p90': 4.2, 'p99': 4.2, 'max': 4.2, ...}
+
+    Limitations:
+        - percentiles are the top of their bucket (or the max),
+          never below the true value and at most a bucket above
+        - values past 2^max_bits microseconds (19 hours by
+          default) all land in the last bucket
+        - not thread safe, designed for a reactor
+
+"""
+
+import math
+
+# steps per power of two, as bits
+SUB_BITS = 4
+
+# biggest value kept apart from the rest, as bits of microseconds
+MAX_BITS = 36
+
+# reported by stats(), name => percentile
+PERCENTILES = (('p50', 50), ('p90', 90), ('p99', 99), ('p999', 99.9))
+
+class Histogram(object):
+
+    def __init__(self, sub_bits = SUB_BITS, max_bits = MAX_BITS):
+        """ An empty histogram, values in seconds """
+
+        self._bits = sub_bits
+        self._sub = 1 << sub_bits
+        self._counts = [0] * ((max_bits - sub_bits + 1) << sub_bits)
+        self._count = 0
+        self._max = 0
+
+    def record(self, seconds):
+        """ Count one duration """
+
+        v = int(seconds * 1000000)
+        if v < self._sub:
+            idx = v if v > 0 else 0
+        else:
+            shift = v.bit_length() - self._bits - 1
+            idx = (shift << self._bits) + (v >> shift)
+
+        counts = self._counts
+        if idx >= len(counts):
+            idx = len(counts) - 1
+        counts[idx] += 1
+
+        self._count += 1
+        if v > self._max:
+            self._max = v
+
+    def count(self):
+        return self._count
+
+    def _top(self, idx):
+        """ Largest value, in microseconds, that lands in bucket idx """
+
+        if idx < self._sub:
+            return idx
+        shift = (idx >> self._bits) - 1
+        top = idx - (shift << self._bits)
+        return ((top + 1) << shift) - 1
+
+    def percentiles(self, ps):
+        """ Seconds at or under which each of the sorted percentiles ps fall """
+
+        if self._count == 0:
+            return [0.0] * len(ps)
+
+        ranks = [max(1, int(math.ceil(self._count * p / 100.0))) for p in ps]
+
+        result = []
+        seen = 0
+        i = 0
+        for idx, n in enumerate(self._counts):
+            if n == 0:
+                continue
+            seen += n
+            while i < len(ranks) and seen >= ranks[i]:
+                result.append(min(self._top(idx), self._max) / 1000000.0)
+                i += 1
+            if i == len(ranks):
+                break
+        return result
+
+    def percentile(self, p):
+        """ Seconds at or under which p percent of the values fall """
+        return self.percentiles([p])[0]
+
+    def stats(self, buckets = False):
+        """ Count, max and PERCENTILES in milliseconds, with the raw buckets if asked """
+
+        names = [name for name, p in PERCENTILES]
+        values = self.percentiles([p for name, p in PERCENTILES])
+
+        stats = dict((name, v * 1000.0) for name, v in zip(names, values))
+        stats['count'] = self._count
+        stats['max'] = self._max / 1000.0
+        if buckets:
+            stats['buckets'] = self.buckets()
+        return stats
+
+    def buckets(self):
+        """ {bucket: count} for the buckets that aren't empty """
+        return dict((idx, n) for idx, n in enumerate(self._counts) if n)
+
+    def load(self, buckets):
+        """ Add counts from buckets(), maybe another histogram's """
+
+        counts = self._counts
+        for idx, n in buckets.iteritems():
+            # keys come back from JSON as strings
+            idx = min(int(idx), len(counts) - 1)
+            counts[idx] += n
+            self._count += n
+            self._max = max(self._max, self._top(idx))
+        return self
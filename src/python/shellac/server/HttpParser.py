@@ -12,16 +12,38 @@
         print p.headers()
         print p.body().read()
 
+    In place, e.g. out of a recv_into() buffer:
+        n = sock.recv_into(buf)
+        off = 0
+        while off < n:
+            off += p.parse(buf, n - off, off)
+
+    Pass-through:
+        HttpParser(raw = True) only de-chunks the body, the
+        bytes are kept in whatever content-encoding they came
+        in and str() sends them back out as is. Call decode()
+        first if the body needs to be looked at or changed.
+
+    Streaming:
+        Once headers_complete(), head() is the message up to
+        the body and take_body() hands over whatever body has
+        been parsed since the last call, so a proxy can pass
+        it on without holding the whole message:
+            while off < n:
+                off += p.parse(buf, n - off, off)
+                if p.headers_complete():
+                    send(p.take_body())
+
     Limitations:
         - poor support for chunk extensions
         - no support for chunk trailers
         - only gzip compression is supported
-        - some pythonic but unnecessary string copying
         - test coverage could be better
         - not thread safe, designed for a reactor
         - no support for constructing messages
-        - no order is maintained for headers 
-            - WWW-Authenticate and others will not work
+        - added headers go out after the rest, and a repeated
+          header that's changed is joined with commas
+            - WWW-Authenticate and others will not work if changed
 
     Credits:
         - Kalan MacRow @k16w github.com/kmacrow
@@ -39,26 +61,66 @@ import cStringIO
 CHUNK_HEADER_RX = re.compile(r'(\r\n)?[a-z0-9]+(;[a-z0-9]+="?[a-z0-9\-_]+"?)?\r\n',
                             flags = re.IGNORECASE)
 
+# header names as they're sent, by their lower case keys
+HEADER_NAMES = dict((name.lower(), intern(name)) for name in [
+    'Accept', 'Accept-Charset', 'Accept-Encoding', 'Accept-Language', 'Accept-Ranges',
+    'Age', 'Authorization', 'Cache-Control', 'Connection', 'Content-Encoding',
+    'Content-Length', 'Content-Type', 'Cookie', 'Date', 'ETag', 'Expires', 'Host',
+    'If-Modified-Since', 'If-None-Match', 'Keep-Alive', 'Last-Modified', 'Location',
+    'Pragma', 'Referer', 'Server', 'Set-Cookie', 'Transfer-Encoding', 'User-Agent',
+    'Vary', 'Via', 'WWW-Authenticate', 'X-Forwarded-For'])
+
+# most names learned on the way, beyond those
+HEADER_NAMES_MAX = 1024
+
+def header_name(key):
+    """ The canonical spelling of a lower case header key """
+
+    name = HEADER_NAMES.get(key, None)
+    if name is None:
+        name = '-'.join([part.capitalize() for part in key.split('-')])
+        if len(HEADER_NAMES) < HEADER_NAMES_MAX:
+            HEADER_NAMES[key] = name = intern(name)
+    return name
+
+def header_line(key, value):
+    """ A header as it's sent, without the CRLF; repeats are joined with commas """
+
+    if isinstance(value, list):
+        value = ', '.join(value)
+    return '%s: %s' % (header_name(key), value)
+
 
 class HttpParser(object):
 
-    def __init__(self):
+    def __init__(self, raw = False):
+        self._raw = raw
         self._method = None
         self._version = None
         self._url = None
         self._status = None
         self._message = None
         self._headers = {}
+
+        # the head as it came in: the text, its lines and their header
+        # keys, and the headers as they were parsed, so head() can send
+        # the lines nobody has changed as they are
+        self._raw_head = None
+        self._lines = None
+        self._keys = None
+        self._parsed = None
+
         self._body = cStringIO.StringIO()
         self._buf = ''
+        self._head = None
+        self._scan = 0
         self._is_request = True
         self._content_len = None
         self._chunked = False
         self._last_chunk = False
         self._gzip = zlib.decompressobj(31)
 
-        self._on_first_line = True
-        self._on_headers = False
+        self._on_head = True
         self._on_body = False
 
         self._headers_complete = False
@@ -85,6 +147,32 @@ class HttpParser(object):
     def body(self):
         return self._body
 
+    def raw(self):
+        return self._raw
+
+    def take_body(self):
+        """ The body parsed since the last take, which is then forgotten """
+
+        data = self._body.getvalue()
+        if len(data) != 0:
+            self._body = cStringIO.StringIO()
+        return data
+
+    def decode(self):
+        """ Inflate a pass-through gzip body so it can be transformed """
+
+        if not self._raw:
+            return
+
+        self._raw = False
+
+        if self._headers.get('content-encoding', 'identity') == 'gzip':
+            data = self._body.getvalue()
+            self._body = cStringIO.StringIO()
+            if len(data) != 0:
+                self._body.write(zlib.decompress(data, 31))
+            self._body.seek(0)
+
     def is_request(self):
         return self._is_request
 
@@ -98,22 +186,88 @@ class HttpParser(object):
         return self._message_complete
 
     def keep_alive(self):
-        return self._headers.get('connection', 'close').lower() == 'keep-alive'
+        value = self._connection()
+        if value is None:
+            # HTTP/1.1 connections persist unless they say otherwise
+            return self._version >= 1.1
+        return value == 'keep-alive'
+
+    def closes(self):
+        """ Did the message ask for its connection to be closed """
+        return self._connection() == 'close'
+
+    def _connection(self):
+        """ The Connection header in lower case, or None """
+
+        value = self._headers.get('connection', None)
+        if isinstance(value, list):
+            # repeated, a close in any of them wins
+            value = 'close' if any(v.lower() == 'close' for v in value) else value[-1]
+        return value.lower() if value is not None else None
 
     def keep_alive_params(self):
         if self.keep_alive():
             ka = self._headers.get('keep-alive', 'timeout=5, max=100')
+            if isinstance(ka, list):
+                ka = ka[-1]
             kp = {k:int(v) for k, v in map(lambda x: x.split('='), ka.split(', '))}
             return (kp.get('timeout', 5), kp.get('max', 100))
         else:
             return (0, 1)
 
+    def head(self):
+        """ The first line and headers as they stand, up to the body
+
+            Headers that are as they were parsed go out as they came in,
+            changed ones are written out in their place and new ones
+            after them. Header values are replaced, not changed in
+            place: a list appended to is still the list that was parsed.
+        """
+
+        headers = self._headers
+        parsed = self._parsed
+
+        if parsed is None:
+            # not parsed, build it all
+            if self.is_request():
+                first = '%s %s HTTP/%.1f' % (self.method(), self.url(), self.version())
+            else:
+                first = 'HTTP/%.1f %d %s' % (self.version(), self.status(), self.message())
+            parts = [first]
+            parts.extend([header_line(k, v) for k, v in headers.iteritems()])
+            parts.append('\r\n')
+            return '\r\n'.join(parts)
+
+        if headers == parsed:
+            # untouched, as it came in
+            return self._raw_head + '\r\n\r\n'
+
+        lines = self._lines
+        keys = self._keys
+        parts = [lines[0]]
+        done = set()
+        for i in xrange(1, len(lines)):
+            key = keys[i]
+            if key is None:
+                continue
+            value = headers.get(key, None)
+            if value is parsed[key]:
+                parts.append(lines[i])
+            elif value is not None and key not in done:
+                done.add(key)
+                parts.append(header_line(key, value))
+
+        for key in headers.viewkeys() - parsed.viewkeys():
+            parts.append(header_line(key, headers[key]))
+
+        parts.append('\r\n')
+        return '\r\n'.join(parts)
+
     def __str__(self):
+        return '%s%s' % self.split()
 
-        if self.is_request():
-            s = '%s %s HTTP/%.1f\r\n' % (self.method(), self.url(), self.version())
-        else:
-            s = 'HTTP/%.1f %d %s\r\n' % (self.version(), self.status(), self.message())
+    def split(self):
+        """ (head, body) as they'd be sent, with Content-Length set to suit """
 
         self._headers.pop('transfer-encoding', None)
         self._headers.pop('content-length', None)
@@ -121,7 +275,8 @@ class HttpParser(object):
         self._body.seek(0)
         b = self._body.read()
         
-        if self._headers.get('content-encoding', 'identity') == 'gzip':
+        if len(b) != 0 and not self._raw and \
+           self._headers.get('content-encoding', 'identity') == 'gzip':
             zz = zlib.compressobj(6, zlib.DEFLATED, 31)
             b  = zz.compress(b)
             b += zz.flush()
@@ -129,107 +284,95 @@ class HttpParser(object):
         if len(b) != 0:
             self._headers['content-length'] = len(b)
 
-        # fast header build
-        h = ''.join(['%s: %s\r\n' % \
-                    ('-'.join(map(lambda x: x.capitalize(), k.split('-'))), 
-                     ', '.join(v) if isinstance(v, list) else v) \
-                    for k, v in self._headers.viewitems()])
-                 
-        return '%s%s\r\n%s' % (s, h, b)
+        return (self.head(), b)
+
+    def parse(self, data, length, offset = 0):
+        """ Parse data[offset:offset + length], return number of bytes consumed.
 
-    def parse(self, data, length):
-        """ Parse data, return number of bytes consumed. """
+            data may be a str or a bytearray (e.g. a recv_into() buffer),
+            only the bytes that have to outlive this call are copied.
+        """
         
         if length == 0:
-            return
-
-        nb_parsed = 0
+            return 0
 
-        while True:
+        if self._on_head:
 
-            if self._on_first_line:
-
-                buf_len = len(self._buf)
-                self._buf += data
-
-                idx = self._buf.find('\r\n')
-                if idx < 0:
-                    return length
-                
-                self._buf = self._buf[:idx + 2]
-
-                self._parse_first_line()
-
-                nb_parsed = len(self._buf) - buf_len
+            end = self._find_head(data, offset, length)
+            if end < 0:
+                return length
 
-                self._buf = ''
-                self._on_first_line = False
-                self._on_headers = True
-                
-                return nb_parsed
-                    
-            elif self._on_headers:
+            self._headers_complete = True
+            self._on_head = False
+            self._on_body = True
 
-                buf_len = len(self._buf)
-                self._buf += data
+            if self._method in ['GET','HEAD']:
+                self._message_complete = True
 
-                idx = self._buf.find('\r\n\r\n')
-                if idx < 0:
-                    return length
+            self._chunked = self._headers.get('transfer-encoding', 'none') == 'chunked'
+            
+            if not self._chunked:
+                self._content_len = int(self._headers.get('content-length', 0))
+                if self._content_len == 0:
+                    self._on_body = False
+                    self._message_complete = True
 
-                self._buf = self._buf[:idx + 4]
+            return end - offset
 
-                self._parse_headers()
+        elif self._on_body:
 
-                nb_parsed = len(self._buf) - buf_len
+            if not self._chunked:
 
-                self._buf = ''
-                self._headers_complete = True
-                self._on_headers = False
-                self._on_body = True
+                nb_parsed = min(length, self._content_len)
+                self._parse_body(data, offset, nb_parsed)
+                self._content_len -= nb_parsed
 
-                if self._method in ['GET','HEAD']:
+                if self._content_len == 0:
+                    self._flush_body()
+                    self._on_body = False
                     self._message_complete = True
 
-                self._chunked = self._headers.get('transfer-encoding', 'none') == 'chunked'
-                
-                if not self._chunked:
-                    self._content_len = int(self._headers.get('content-length', 0))
-                    if self._content_len == 0:
-                        self._on_body = False
-                        self._message_complete = True
-
                 return nb_parsed
 
-            elif self._on_body:
+            else:
 
-                if not self._chunked:
+                # read chunked message body
+                return self._parse_chunked(data, length, offset)
 
-                    if length < self._content_len:
-                        self._buf += data
-                        self._content_len -= length
-                        return length
-                    else:
-                        self._buf += data[:self._content_len]
-                        self._parse_body()
-                        self._flush_body()
-                        self._buf = ''
+        else:
+            return 0
 
-                        nb_parsed = self._content_len
+    def _find_head(self, data, offset, length):
+        """ Index in data just past the head, parsed, or -1 with data kept for later
 
-                        self._content_len = 0
-                        self._on_body = False
-                        self._message_complete = True
-                        return nb_parsed
+            A head that comes in pieces is gathered in a bytearray and each
+            piece is scanned once, picking up where the last scan left off.
+        """
 
-                else:
+        head = self._head
+        if head is None:
+            # the common case, all of it here
+            end = data.find('\r\n\r\n', offset, offset + length)
+            if end >= 0:
+                self._parse_head(str(data[offset:end]))
+                return end + 4
 
-                    # read chunked message body
-                    return self._parse_chunked(data, length)
+            self._head = bytearray(buffer(data, offset, length))
+            self._scan = max(0, length - 3)
+            return -1
 
+        start = len(head)
+        head += buffer(data, offset, length)
 
-            else:
-                return 0
+        end = head.find('\r\n\r\n', self._scan)
+        if end < 0:
+            # the end may straddle this piece and the next
+            self._scan = len(head) - 3
+            return -1
+
+        self._head = None
+        self._parse_head(str(head[:end]))
+        return offset + end + 4 - start
 
     def _parse_chunk_size(self, line):
         """ Parse chunk header size """
@@ -240,71 +383,86 @@ class HttpParser(object):
         else:
             return int(size, 16)
 
-    def _parse_chunked(self, data, length):
+    def _parse_chunked(self, data, length, offset):
         """ Parse a chunked response """
 
-        buf_len = len(self._buf)
-        self._buf += data
-        
-        nb_parsed = 0
-
         if self._content_len is None:
 
-            match = CHUNK_HEADER_RX.match(self._buf)
+            # chunk header, glue on any piece of it we already have
+            buf_len = len(self._buf)
+            if buf_len != 0:
+                buf = self._buf + str(data[offset:offset + length])
+                start = 0
+            else:
+                buf = data
+                start = offset
+
+            limit = start + buf_len + length
+            match = CHUNK_HEADER_RX.match(buf, start, limit)
 
             if match is None:
+                self._buf += str(data[offset:offset + length])
                 return length
 
-            idx = len(match.group())
-
-            line = self._buf[:idx]
-            self._content_len = self._parse_chunk_size(line)
-            
-            nb_parsed = idx - buf_len
-            self._buf = self._buf[idx:]
+            self._content_len = self._parse_chunk_size(str(match.group()))
+            self._buf = ''
 
-            left = len(self._buf)
+            nb_parsed = match.end() - start - buf_len
 
             if self._content_len == 0:
-                if self._buf.startswith('\r\n'):
+                # only look at what we were given, past it is someone else's
+                if match.end() + 2 <= limit and buf[match.end():match.end() + 2] == '\r\n':
                     nb_parsed += 2
                     self._flush_body()
                     self._on_body = False
                     self._message_complete = True
 
-                self._buf = ''
-                return nb_parsed
+            return nb_parsed
         
         elif self._content_len == 0:
-            if self._buf.startswith('\r\n'):
-                nb_parsed = 2 - buf_len
-                self._flush_body()
+
+            # the blank line after the last chunk
+            buf_len = len(self._buf)
+            buf = self._buf + str(data[offset:offset + min(length, 2 - buf_len)])
+
+            if buf == '\r\n':
                 self._buf = ''
+                self._flush_body()
                 self._on_body = False
                 self._message_complete = True
-                return nb_parsed
-            else:
-                return length
-        else:
-            left = length
+                return 2 - buf_len
+
+            # trailers are not supported, swallow the rest
+            self._buf = buf
+            return length
 
-        if left < self._content_len:
-            self._content_len -= left
-            nb_parsed += left
-            return nb_parsed
         else:
-            self._buf = self._buf[:buf_len + self._content_len]
-            self._parse_body()
-            self._buf = ''
-            nb_parsed += self._content_len
-            self._content_len = None
+
+            nb_parsed = min(length, self._content_len)
+            self._parse_body(data, offset, nb_parsed)
+            self._content_len -= nb_parsed
+
+            if self._content_len == 0:
+                self._content_len = None
+
             return nb_parsed
 
 
-    def _parse_first_line(self):
+    def _parse_head(self, head):
+        """ Parse the first line and headers, up to the blank line """
+
+        lines = head.split('\r\n')
+        self._parse_first_line(lines[0])
+        self._keys = self._parse_headers(lines, 1)
+
+        self._raw_head = head
+        self._lines = lines
+        self._parsed = dict(self._headers)
+
+    def _parse_first_line(self, line):
         """ Parse a request/response line """
 
-        (a, b, c) = self._buf.rstrip().split(' ', 2)
+        (a, b, c) = line.rstrip().split(' ', 2)
         if a.startswith('HT'):
             # response...
             self._is_request = False
@@ -320,34 +478,41 @@ class HttpParser(object):
             self._method = a
             self._url = b
 
-    def _parse_headers(self):
-        """ Parse raw headers into a dict of scalars/lists """
+    def _parse_headers(self, lines, start = 0):
+        """ Parse header lines into a dict of scalars/lists, returns each line's key """
 
-        headers = self._buf.strip().split('\r\n')
-        for header in headers:
-            (key, value) = header.split(': ')
+        headers = self._headers
+        keys = [None] * len(lines)
+        for i in xrange(start, len(lines)):
+            (key, colon, value) = lines[i].partition(':')
+            if not colon:
+                # not a header, nothing to keep
+                continue
             value = value.strip()
-            key = key.lower()
-            if key in self._headers:
-                if isinstance(self._headers[key], list):
-                    self._headers[key].append(value)
+            key = keys[i] = key.lower()
+            if key in headers:
+                if isinstance(headers[key], list):
+                    headers[key].append(value)
                 else:
-                    self._headers[key] = [self._headers[key], value]
+                    headers[key] = [headers[key], value]
             else:
-                self._headers[key] = value
+                headers[key] = value
+
+        return keys
 
 
-    def _parse_body(self):
+    def _parse_body(self, data, offset, length):
+        piece = buffer(data, offset, length)
         pos = self._body.tell()
         self._body.seek(0, os.SEEK_END)
-        if self._headers.get('content-encoding', 'identity') == 'gzip':
-            self._body.write(self._gzip.decompress(self._buf))
+        if not self._raw and self._headers.get('content-encoding', 'identity') == 'gzip':
+            self._body.write(self._gzip.decompress(piece))
         else:
-            self._body.write(self._buf)
+            self._body.write(piece)
         self._body.seek(pos)
 
     def _flush_body(self):
-        if self._headers.get('content-encoding', 'identity') == 'gzip':
+        if not self._raw and self._headers.get('content-encoding', 'identity') == 'gzip':
             self._body.write(self._gzip.flush())
 
 
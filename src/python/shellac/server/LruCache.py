@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+    A small in-process LRU object cache
+
+    LruCache keeps string values in memory up to a byte
+    budget. Entries expire after their TTL and the least
+    recently used entries are evicted when a set() would
+    go over the budget. Hit, miss and eviction counters
+    are kept so the budget can be sized from live traffic.
+
+    Usage:
+        c = LruCache(64 * 1024 * 1024)
+        c.set('/index.html', '...', 170)
+        print c.get('/index.html')
+        -> '...'
+        print c.stats()
+        -> {'hits': 1, 'misses': 0, ...}
+
+    Limitations:
+        - size accounting is len(key) + len(value), object
+          overheads are not counted
+        - expired entries are only dropped when touched or evicted
+        - not thread safe, designed for a reactor
+
+"""
+
+from time import time
+from collections import OrderedDict
+
+class LruCache(object):
+
+    def __init__(self, limit):
+        """ Create a cache holding at most limit bytes """
+
+        # key => (value, expires), oldest first
+        self._entries = OrderedDict()
+        self._limit = limit
+        self._size = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key, now = None):
+        """ Return the value for key, or None """
+
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self._misses += 1
+            return None
+
+        if now is None:
+            now = time()
+
+        if entry[1] <= now:
+            self._size -= len(key) + len(entry[0])
+            self._misses += 1
+            return None
+
+        # re-insert to mark as most recently used
+        self._entries[key] = entry
+        self._hits += 1
+        return entry[0]
+
+    def set(self, key, value, ttl, now = None):
+        """ Store value under key for ttl seconds """
+
+        self.delete(key)
+
+        size = len(key) + len(value)
+        if size > self._limit or ttl <= 0:
+            return
+
+        if now is None:
+            now = time()
+
+        entries = self._entries
+        while self._size + size > self._limit:
+            (k, v) = entries.popitem(last = False)
+            self._size -= len(k) + len(v[0])
+            self._evictions += 1
+
+        entries[key] = (value, now + ttl)
+        self._size += size
+
+    def delete(self, key):
+        """ Drop key if present """
+
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(key) + len(entry[0])
+
+    def size(self):
+        return self._size
+
+    def limit(self):
+        return self._limit
+
+    def hits(self):
+        return self._hits
+
+    def misses(self):
+        return self._misses
+
+    def evictions(self):
+        return self._evictions
+
+    def stats(self):
+        return {'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'limit': self._limit}
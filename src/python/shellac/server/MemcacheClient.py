@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+"""
+    A non-blocking memcached client for the reactor
+
+    MemcacheClient speaks the memcached binary protocol over
+    non-blocking sockets. It never polls or blocks on its own:
+    its sockets are registered with the caller's epoll object
+    and the caller hands it read/write/close events for the
+    fds it owns(). get() takes a callback that fires with the
+    value, or None on a miss or error, once the reply is in.
+
+    get_multi() looks up a batch of keys with one write per
+    node: a quiet get for each key, then a no-op whose reply
+    tells us the misses. Its callback fires once per key, as
+    each value arrives.
+
+    Usage:
+        mc = MemcacheClient([('127.0.0.1', 11211)], epoll)
+        mc.get('/index.html', lambda value: ...)
+        mc.set('/index.html', '...', 170)
+        mc.get_multi(['/a', '/b'], lambda key, value: ...)
+        mc.touch('/a', 300)
+        print mc.pending()
+        -> 3
+
+        for fd, event in epoll.poll(1):
+            if mc.owns(fd):
+                if event & select.EPOLLIN:
+                    mc.read(fd)
+                elif event & select.EPOLLOUT:
+                    mc.write(fd)
+                else:
+                    mc.close(fd)
+
+    Limitations:
+        - get, set and touch only, no cas/delete/incr
+        - pending callbacks on a failed node fire as misses
+        - keys are not checked against memcached's rules
+        - not thread safe, designed for a reactor
+
+"""
+
+import errno
+import socket, select
+import struct
+import hashlib
+
+from time import time
+from bisect import bisect
+from functools import partial
+
+from ChunkedStreamBuf import ChunkedStreamBuf
+
+# missing constants
+select.EPOLLRDHUP = 0x2000
+
+# binary protocol constants
+REQ_MAGIC = 0x80
+RES_MAGIC = 0x81
+
+OP_GET   = 0x00
+OP_GETQ  = 0x09
+OP_NOOP  = 0x0a
+OP_SETQ  = 0x11
+OP_TOUCH = 0x1c
+
+# magic, opcode, key len, extras len, data type, vbucket/status,
+# body len, opaque, cas
+HEADER = struct.Struct('!BBHBBHIIQ')
+HEADER_LEN = HEADER.size
+
+# flags, expiry
+SET_EXTRAS = struct.Struct('!II')
+
+# expiry
+TOUCH_EXTRAS = struct.Struct('!I')
+
+# points per server on the hash ring (ketama uses 160)
+RING_POINTS = 160
+
+# seconds to wait before reconnecting to a failed node
+RETRY_TIMEOUT = 2
+
+# bytes to read per recv()
+RECV_SIZE = 65536
+
+
+class MemcacheClient(object):
+
+    def __init__(self, servers, epoll):
+        """ Create a client for a list of (host, port) memcached servers """
+
+        self._servers = servers
+        self._epoll = epoll
+
+        # fd => [sock, server, out StreamBuf, in buf, {opaque: callback}, connected]
+        self._nodes = {}
+
+        # server => fd
+        self._fds = {}
+
+        # server => time before which we won't reconnect
+        self._dead = {}
+
+        self._opaque = 0
+
+        self._points, self._ring = self._build_ring(servers)
+
+    def _build_ring(self, servers):
+        """ Build a ketama-style consistent hash ring """
+
+        ring = []
+        for server in servers:
+            for i in xrange(RING_POINTS / 4):
+                d = hashlib.md5('%s:%d-%d' % (server[0], server[1], i)).digest()
+                for j in xrange(4):
+                    ring.append((struct.unpack('<I', d[j*4:j*4+4])[0], server))
+        ring.sort()
+        return [p for p, _ in ring], [s for _, s in ring]
+
+    def _server_for(self, key):
+        """ Map a key onto a server """
+
+        if len(self._ring) == 0:
+            return None
+
+        point = struct.unpack('<I', hashlib.md5(key).digest()[:4])[0]
+        idx = bisect(self._points, point)
+        if idx == len(self._points):
+            idx = 0
+        return self._ring[idx]
+
+    def _node_for(self, key):
+        """ Get (connecting if needed) the node for a key, or None """
+
+        server = self._server_for(key)
+        if server is None:
+            return None
+
+        fd = self._fds.get(server, None)
+        if fd is not None:
+            return self._nodes[fd]
+
+        if self._dead.get(server, 0) > time():
+            return None
+
+        return self._connect(server)
+
+    def _connect(self, server):
+        """ Start a non-blocking connect to a memcached server """
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(0)
+
+        err = sock.connect_ex(server)
+        if err not in (0, errno.EINPROGRESS):
+            sock.close()
+            self._dead[server] = time() + RETRY_TIMEOUT
+            return None
+
+        fd = sock.fileno()
+
+        # spec: sock, server, out, in, pending, connected
+        node = [sock, server, ChunkedStreamBuf(), bytearray(), {}, False]
+        self._nodes[fd] = node
+        self._fds[server] = fd
+
+        self._epoll.register(fd, select.EPOLLIN | select.EPOLLOUT | select.EPOLLRDHUP)
+
+        return node
+
+    def _send(self, node, data):
+        """ Queue data for a node, the write happens on EPOLLOUT """
+
+        node[2].write(data)
+        if node[5]:
+            self._epoll.modify(node[0].fileno(),
+                        select.EPOLLIN | select.EPOLLOUT | select.EPOLLRDHUP)
+
+    def _next_opaque(self):
+        # never 0, that's for replies nobody waits on
+        self._opaque = self._opaque % 0xffffffff + 1
+        return self._opaque
+
+    def owns(self, fd):
+        """ Is fd one of our memcached connections? """
+        return fd in self._nodes
+
+    def get(self, key, callback):
+        """ Look up key, callback(value) fires with None on a miss """
+
+        node = self._node_for(key)
+        if node is None:
+            callback(None)
+            return
+
+        opaque = self._next_opaque()
+        node[4][opaque] = callback
+
+        self._send(node, HEADER.pack(REQ_MAGIC, OP_GET, len(key), 0, 0, 0,
+                                     len(key), opaque, 0) + key)
+
+    def get_multi(self, keys, callback):
+        """ Look up several keys, callback(key, value) fires for each as it arrives """
+
+        batches = {}
+        for key in keys:
+            node = self._node_for(key)
+            if node is None:
+                callback(key, None)
+            else:
+                batches.setdefault(node[1], (node, []))[1].append(key)
+
+        for (node, batch) in batches.itervalues():
+            pending = node[4]
+            opaques = []
+            out = []
+
+            for key in batch:
+                opaque = self._next_opaque()
+                pending[opaque] = partial(callback, key)
+                opaques.append(opaque)
+                out.append(HEADER.pack(REQ_MAGIC, OP_GETQ, len(key), 0, 0, 0,
+                                       len(key), opaque, 0) + key)
+
+            # quiet gets don't answer misses, the no-op's reply says we've
+            # heard everything that's coming
+            opaque = self._next_opaque()
+            pending[opaque] = partial(self._missed, pending, opaques)
+            out.append(HEADER.pack(REQ_MAGIC, OP_NOOP, 0, 0, 0, 0, 0, opaque, 0))
+
+            self._send(node, ''.join(out))
+
+    def _missed(self, pending, opaques, value):
+        """ A multi-get's no-op is back, quiet gets still pending were misses """
+
+        for opaque in opaques:
+            callback = pending.pop(opaque, None)
+            if callback is not None:
+                callback(None)
+
+    def pending(self):
+        """ Replies we're still waiting on, across all nodes """
+        return sum(len(node[4]) for node in self._nodes.itervalues())
+
+    def touch(self, key, ttl):
+        """ Give key a new expiry without resending it """
+
+        node = self._node_for(key)
+        if node is None:
+            return
+
+        # opaque 0: nobody waits on the reply
+        self._send(node, HEADER.pack(REQ_MAGIC, OP_TOUCH, len(key), 4, 0, 0,
+                                     4 + len(key), 0, 0) +
+                         TOUCH_EXTRAS.pack(ttl) + key)
+
+    def set(self, key, value, ttl):
+        """ Store value under key for ttl seconds, fire and forget """
+
+        node = self._node_for(key)
+        if node is None:
+            return
+
+        # quiet set: memcached only replies on failure, which we ignore
+        self._send(node, HEADER.pack(REQ_MAGIC, OP_SETQ, len(key), 8, 0, 0,
+                                     8 + len(key) + len(value), 0, 0) +
+                         SET_EXTRAS.pack(0, ttl) + key + value)
+
+    def write(self, fd):
+        """ Handle EPOLLOUT on a memcached connection """
+
+        node = self._nodes[fd]
+        sock = node[0]
+
+        if not node[5]:
+            # non-blocking connect finished, did it work?
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                self.close(fd)
+                return
+            node[5] = True
+
+        out = node[2]
+
+        if out.pending() != 0:
+            try:
+                sent = sock.send(out.view())
+            except socket.error:
+                self.close(fd)
+                return
+            out.ack(sent)
+            if out.pending() != 0:
+                return
+
+        out.clear()
+        self._epoll.modify(fd, select.EPOLLIN | select.EPOLLRDHUP)
+
+    def read(self, fd):
+        """ Handle EPOLLIN on a memcached connection """
+
+        node = self._nodes[fd]
+
+        try:
+            data = node[0].recv(RECV_SIZE)
+        except socket.error:
+            self.close(fd)
+            return
+
+        if len(data) == 0:
+            self.close(fd)
+            return
+
+        # replies usually come whole, parse them straight out of data;
+        # the rest of a big one is gathered up without copying what came before
+        buf = node[3]
+        if len(buf) != 0:
+            buf += data
+        else:
+            buf = data
+
+        pending = node[4]
+        pos = 0
+        end = len(buf)
+
+        while end - pos >= HEADER_LEN:
+            (magic, op, keylen, extlen, _, status, bodylen, opaque, _) = \
+                HEADER.unpack_from(buf, pos)
+
+            if magic != RES_MAGIC:
+                self.close(fd)
+                return
+
+            if end - pos - HEADER_LEN < bodylen:
+                break
+
+            start = pos + HEADER_LEN
+            pos = start + bodylen
+
+            callback = pending.pop(opaque, None)
+            if callback is not None:
+                if status == 0:
+                    start += extlen + keylen
+                    callback(str(buffer(buf, start, pos - start)))
+                else:
+                    callback(None)
+
+        # a callback may have closed us
+        if fd not in self._nodes:
+            return
+
+        if buf is data:
+            if pos != end:
+                node[3] += buffer(data, pos)
+        elif pos != 0:
+            del buf[:pos]
+
+    def close(self, fd):
+        """ Tear down a memcached connection, failing anything pending """
+
+        node = self._nodes.pop(fd, None)
+        if node is None:
+            return
+
+        server = node[1]
+        del self._fds[server]
+        self._dead[server] = time() + RETRY_TIMEOUT
+
+        try:
+            self._epoll.unregister(fd)
+        except (IOError, ValueError):
+            pass
+        node[0].close()
+
+        # callbacks may pop each other (see _missed), so take them one at a time
+        pending = node[4]
+        while pending:
+            (_, callback) = pending.popitem()
+            callback(None)
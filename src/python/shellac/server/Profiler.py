@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+    On-demand cProfile windows for a running reactor
+
+    Profiler turns cProfile on and off around a window of a
+    live server's work, so a node can be profiled under its
+    real traffic without a restart. Each window starts a
+    fresh profile and is written out when it stops, as
+    shellac-<pid>-<date>-<time>.prof in the profile
+    directory, ready for prof.py or pstats.
+
+    The reactor owns the window: Server.toggle_profile() is
+    safe to call from a signal handler (SIGUSR2) and the
+    reactor starts or stops the profiler on its next pass,
+    stopping it on a timer if nobody does.
+
+    Usage:
+        profiler = Profiler('/var/tmp')
+        profiler.start()
+        ...
+        print profiler.stop()
+        -> /var/tmp/shellac-4242-20140301-120000.prof
+
+    Limitations:
+        - profiles the calling thread only, the reactor's
+        - cProfile slows the reactor down while it's on, more
+          so the more calls it makes
+
+"""
+
+import os
+import cProfile
+
+from time import strftime, localtime
+
+class Profiler(object):
+
+    def __init__(self, directory = '.', prefix = 'shellac'):
+        """ Write profiles to directory, named after prefix and our pid """
+
+        self._dir = directory
+        self._prefix = prefix
+
+        # profile of the window in progress, if any
+        self._profile = None
+
+        # when it started
+        self._started = None
+
+    def active(self):
+        return self._profile is not None
+
+    def start(self):
+        """ Start a window, does nothing if one is running """
+
+        if self._profile is not None:
+            return
+        self._started = localtime()
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def stop(self):
+        """ End the window and write it out, returns the file's path or None """
+
+        if self._profile is None:
+            return None
+
+        profile = self._profile
+        profile.disable()
+        self._profile = None
+
+        path = os.path.join(self._dir, '%s-%d-%s.prof' %
+                            (self._prefix, os.getpid(), strftime('%Y%m%d-%H%M%S', self._started)))
+        profile.dump_stats(path)
+        return path
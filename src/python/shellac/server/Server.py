@@ -2,32 +2,113 @@
 
 import os
 import sys
+import json
+import zlib
+import errno
+import fcntl
 import signal
 import random
 import argparse
 import logging
 import socket, select
-import pylibmc
 from collections import deque
+from functools import partial
 
 from time import time
-from random import randint, choice
 
 from HttpParser import HttpParser
 from StreamBuf import StreamBuf
-
-# missing constant
+from ChunkedStreamBuf import ChunkedStreamBuf
+from MemcacheClient import MemcacheClient
+from LruCache import LruCache
+from Supervisor import Supervisor
+from UpstreamPool import UpstreamPool, RETRY_TIMEOUT
+from Balancer import make_balancer, BALANCERS
+from HealthChecker import HealthChecker
+from CachePolicy import CachePolicy, digest
+from CacheEntry import CacheEntry
+from Compressor import Compressor
+from TimerWheel import TimerWheel
+from Histogram import Histogram
+from Profiler import Profiler
+
+# missing constants
 select.EPOLLRDHUP = 0x2000
+if not hasattr(socket, 'SO_REUSEPORT'):
+    socket.SO_REUSEPORT = 15
+
+# vectored writes where the platform has them (Python 3.3+)
+SENDMSG = hasattr(socket.socket, 'sendmsg')
 
 # keep-alive params for clients
 CLIENT_TIMEOUT = 30
 CLIENT_MAX_REQS = 1000
 
+# seconds an idle upstream connection is kept when the
+# server didn't tell us its keep-alive timeout
+UPSTREAM_TIMEOUT = 30
+
+# seconds an upstream may go quiet with requests outstanding
+# before it counts as failed
+RESPONSE_TIMEOUT = 30
+
+# seconds between stats reports to a supervisor
+STATS_INTERVAL = 5
+
+# reserved URL that answers with stats() as JSON, or as text with .txt on the end
+STATS_URL = '/_shellac/stats'
+
+# clients that may read it
+STATS_ALLOW = ('127.0.0.1',)
+
+# seconds of history requests per second is averaged over
+RATE_WINDOW = 10
+
+# phases of a request timed for stats(), hits never go upstream
+HIT_PHASES = ('parse', 'cache', 'write', 'total')
+MISS_PHASES = ('parse', 'cache', 'upstream_wait', 'origin', 'write', 'total')
+
+# longest a profile window runs before it's written out (seconds)
+PROFILE_SECONDS = 30
+
+# largest piece of an object stored in one memcached item: the default
+# item size limit (1MB) less room for the key and item header
+SEGMENT_SIZE = 1000 * 1000
+
+# biggest response we'll keep a copy of for the cache
+MAX_OBJECT_SIZE = 64 * 1024 * 1024
+
+# how a response goes out to its client: whole once it's complete,
+# or as it arrives with the origin's Content-Length or re-chunked
+BUFFERED = 0
+STREAMED = 1
+CHUNKED  = 2
+
+# request headers we rewrite on the way upstream
+REWRITTEN_HEADERS = ('accept-encoding', 'if-none-match', 'if-modified-since')
+
+# sent when every backend is down
+UNAVAILABLE = 'HTTP/1.1 503 Service Unavailable\r\nServer: Shellac/0.1.0a\r\n' \
+              'Content-Length: 0\r\nConnection: keep-alive\r\n\r\n'
+
+# sent when a backend fails us part way through
+BAD_GATEWAY = 'HTTP/1.1 502 Bad Gateway\r\nServer: Shellac/0.1.0a\r\n' \
+              'Content-Length: 0\r\nConnection: keep-alive\r\n\r\n'
+
 #logging.basicConfig(filename='server.log', filemode='w+', level=logging.DEBUG)
 
 class Server(object):
 
-    def __init__(self, servers, caches, port = 8080, ttl = 170, compress = False, cache = False):
+    def __init__(self, servers, caches, port = 8080, ttl = 170, compress = False, cache = False,
+                 l1_size = 0, collapse_timeout = 5, stream_buf = ChunkedStreamBuf,
+                 recv_size = 16384, reuse_port = False, stats_fd = None,
+                 upstream_max = 0, upstream_min_idle = 0, weights = None,
+                 balance = 'least-outstanding', max_fails = 3, health_check = None,
+                 upstream_timeout = RESPONSE_TIMEOUT, keep = 3600, grace = 10,
+                 stale_if_error = 300, xfetch = 1.0, segment_size = SEGMENT_SIZE,
+                 max_object_size = MAX_OBJECT_SIZE, stats_url = STATS_URL,
+                 stats_allow = STATS_ALLOW, profile_dir = '.',
+                 profile_seconds = PROFILE_SECONDS):
         """ Create an instance of the Shellac server """
 
         # fd => socket
@@ -37,25 +118,37 @@ class Server(object):
         self._requests = {}
 
         # fd => [Response] (Queue)
+        # spec: key, response parser, stream, request, stale entry, sent at, mode, tee, times
         self._responses = {}
 
         # fd_up => [(fd_down, resp_id)] (Queue)
         self._stream_map = {}
 
-        # names of upstream servers to balance traffic on
-        self._upstream_servers = servers
-
         # names of memcached servers to build cache on
         self._cache_servers = caches
 
-        # host => [Connection, Connection, ...]
+        # fd => [Connection]
         self._upstream_connections = {}
 
+        # one connection pool per upstream server
+        if weights is None:
+            weights = [1] * len(servers)
+        self._pools = [UpstreamPool(srv, upstream_max, upstream_min_idle, w, max_fails)
+                            for srv, w in zip(servers, weights)]
+
+        # picks the pool each request goes to
+        self._balancer = make_balancer(balance, self._pools)
+
+        # [(fd, conn, request, responsev)] waiting for a pool to free up
+        self._upstream_waiting = deque()
+        self._draining = False
+
         # fd => [Request] (Queue)
         self._upstream_requests = {}
 
-        # compress cache entries?
+        # compress cache entries? they're inflated either way
         self._compress = compress
+        self._compressor = Compressor()
 
         # cache objects?
         self._cache = cache
@@ -63,12 +156,89 @@ class Server(object):
         # Memcached client
         self._mc = None
 
-        # how long should entries live?
+        # how long should entries live, when responses don't say?
         self._ttl = ttl
 
+        # what may be cached, for how long and under which key
+        self._policy = CachePolicy(ttl, grace, stale_if_error)
 
+        # XFetch beta: how eagerly hot entries are refreshed early (0 disables)
+        self._xfetch = xfetch
+
+        # how long to hold on to stale entries that can be revalidated
+        self._keep = keep
+
+        # objects bigger than this are split across several memcached items
+        self._segment_size = segment_size
+
+        # responses bigger than this are passed through but not cached
+        self._max_object_size = max_object_size
+
+        # in-process cache in front of memcached
+        self._l1 = LruCache(l1_size) if l1_size > 0 else None
+
+        # key => [leader responsev, started, [(fd, conn, request, responsev)]]
+        self._inflight = {}
+
+        # idle timeouts, collapse timeouts and the like
+        self._timers = TimerWheel()
+
+        # how long may a request wait on another's fetch?
+        self._collapse_timeout = collapse_timeout
+
+        # how long may an upstream sit on our requests?
+        self._upstream_timeout = upstream_timeout
+
+        # active health checks, if there's a path to probe
+        self._health = None
+
+        # StreamBuf backend for requests/responses in flight
+        self._stream_buf = stream_buf
+
+        # every recv lands here, parsers consume it in place before the
+        # next one so one buffer serves all connections on the reactor
+        self._recv_buf = bytearray(recv_size)
+
+        # counters, see stats()
+        self._stats = {'accepted': 0, 'requests': 0, 'hits': 0, 'misses': 0, 'sets': 0,
+                       'upstream_requests': 0, 'collapsed': 0, 'revalidated': 0,
+                       'not_modified': 0, 'stale': 0, 'refreshes': 0,
+                       'bytes_in': 0, 'bytes_out': 0,
+                       'upstream_bytes_in': 0, 'upstream_bytes_out': 0}
+
+        # (time, requests) once a second, for requests per second
+        self._rate = deque(maxlen = RATE_WINDOW + 1)
+
+        # hit/miss => phase => Histogram, fed as responses finish
+        # spec (times): hit, started, parsed, looked up, written upstream, received
+        self._latency = {'hit':  dict((p, Histogram()) for p in HIT_PHASES),
+                         'miss': dict((p, Histogram()) for p in MISS_PHASES)}
+        self._started = time()
+
+        # stats URL => format, and who may ask for it
+        self._stats_urls = {}
+        if stats_url:
+            self._stats_urls = {stats_url: 'json', stats_url + '.txt': 'text'}
+        self._stats_allow = frozenset(stats_allow)
+
+        # cProfile windows on request, see toggle_profile()
+        self._profiler = Profiler(profile_dir)
+        self._profile_seconds = profile_seconds
+        self._profile_timer = None
+        self._profile_toggle = False
+
+        # where to report stats when running under a Supervisor
+        self._stats_fd = stats_fd
+        if stats_fd is not None:
+            fcntl.fcntl(stats_fd, fcntl.F_SETFL,
+                        fcntl.fcntl(stats_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        self._running = False
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # let sibling workers bind the same port
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self._socket.bind(('0.0.0.0', port))
         self._socket.listen(1)
         self._socket.setblocking(0)
@@ -77,97 +247,361 @@ class Server(object):
         self._epoll.register(self._socket.fileno(), select.EPOLLIN)
 
         if self._cache:
-            # todo: potentially use a pool of clients
-            self._mc = pylibmc.Client(['%s:%d' % cacher for cacher in caches],
-                                        binary=True, 
-                                        behaviors={'tcp_nodelay': True, 'ketama': True})
+            # memcached sockets live in our epoll set alongside clients
+            self._mc = MemcacheClient(caches, self._epoll)
+
+        if health_check is not None:
+            self._health = HealthChecker(self._pools, self._epoll, self._timers, health_check)
+            self._health.start()
+
+        for pool in self._pools:
+            self._warm_pool(pool)
+
+    def stats(self, buckets = False):
+        """ Snapshot of the server's counters and gauges
+
+            Latencies are in milliseconds, buckets adds the histograms'
+            raw counts so reports from several workers can be merged.
+        """
+
+        now = time()
+        stats = dict(self._stats)
+        stats['uptime'] = now - self._started
+        stats['requests_per_second'] = 0.0
+        if self._rate:
+            (then, requests) = self._rate[0]
+            if now > then:
+                stats['requests_per_second'] = (stats['requests'] - requests) / (now - then)
+
+        stats['active'] = len(self._connections)
+        stats['upstream_connections'] = len(self._upstream_connections)
+
+        # queue depths, walked only when someone asks
+        stats['queued_responses'] = sum(len(q) for q in self._responses.itervalues())
+        stats['queued_upstream_requests'] = sum(len(q) for q in self._upstream_requests.itervalues())
+        stats['awaiting_upstream'] = sum(len(q) for q in self._stream_map.itervalues())
+        stats['waiting_for_pool'] = len(self._upstream_waiting)
+        stats['inflight'] = len(self._inflight)
+        stats['timers'] = len(self._timers)
+        if self._mc is not None:
+            stats['awaiting_cache'] = self._mc.pending()
+        if self._l1 is not None:
+            stats['l1'] = self._l1.stats()
+        stats['compression'] = self._compressor.stats()
+        stats['profiling'] = int(self._profiler.active())
+
+        stats['latency_ms'] = dict((label, dict((p, h.stats(buckets)) for p, h in phases.iteritems()))
+                                   for label, phases in self._latency.iteritems())
+
+        stats['upstreams'] = dict(('%s:%d' % pool.address(),
+                                   {'outstanding': pool.outstanding(),
+                                    'connections': pool.count(),
+                                    'idle': pool.idle(),
+                                    'healthy': int(pool.healthy()),
+                                    'failures': pool.failures()}) for pool in self._pools)
+        return stats
+
+    def _report_stats(self):
+        """ Timer: send a stats snapshot up the supervisor's pipe """
 
+        try:
+            os.write(self._stats_fd, json.dumps(self.stats(buckets = True)) + '\n')
+        except OSError as ex:
+            if ex.errno != errno.EAGAIN:
+                self._stats_fd = None
+                return
+
+        self._timers.schedule(STATS_INTERVAL, self._report_stats)
+
+    def _record_latency(self, times, now):
+        """ A response's last byte is out, add up where its time went """
+
+        (hit, started, parsed, looked_up, written, received) = times
+        phases = self._latency['hit' if hit else 'miss']
+
+        phases['parse'].record(parsed - started)
+        ready = parsed
+        if looked_up is not None:
+            phases['cache'].record(looked_up - ready)
+            ready = looked_up
+        if written is not None:
+            phases['upstream_wait'].record(written - ready)
+            ready = written
+        if received is not None:
+            if written is not None:
+                phases['origin'].record(received - written)
+            ready = received
+        phases['write'].record(now - ready)
+        phases['total'].record(now - started)
+
+    def _sample_rate(self):
+        """ Timer: note the request count, stats() works out the rate """
+
+        self._rate.append((time(), self._stats['requests']))
+        self._timers.schedule(1, self._sample_rate)
+
+    def _stats_request(self, conn, url):
+        """ The format if url asks for stats and this client may have them, else None """
+
+        form = self._stats_urls.get(url, None)
+        if form is None:
+            return None
+        try:
+            if conn[0].getpeername()[0] not in self._stats_allow:
+                return None
+        except socket.error:
+            return None
+        return form
+
+    def _stats_response(self, form):
+        """ A response carrying a stats() snapshot """
+
+        stats = self.stats()
+        if form == 'text':
+            (ctype, body) = ('text/plain', stats_text(stats))
+        else:
+            (ctype, body) = ('application/json', json.dumps(stats, sort_keys = True) + '\n')
+
+        return 'HTTP/1.1 200 OK\r\nServer: Shellac/0.1.0a\r\nContent-Type: %s\r\n' \
+               'Cache-Control: no-store\r\nContent-Length: %d\r\n' \
+               'Connection: keep-alive\r\n\r\n%s' % (ctype, len(body), body)
+
+    def _toggle_profile(self):
+        """ Start a profile window, or end the one that's running """
+
+        self._profile_toggle = False
+        if self._profiler.active():
+            self._timers.cancel(self._profile_timer)
+            self._stop_profile()
+            return
+
+        self._profiler.start()
+        self._profile_timer = self._timers.schedule(self._profile_seconds, self._stop_profile)
+        print >> sys.stderr, 'Profiling for up to %g seconds...' % self._profile_seconds
+
+    def _stop_profile(self):
+        """ Timer: the window is up, write the profile out """
+
+        self._profile_timer = None
+        try:
+            path = self._profiler.stop()
+        except (IOError, OSError) as ex:
+            print >> sys.stderr, 'Could not write profile: %s' % ex
+            return
+        if path is not None:
+            print >> sys.stderr, 'Wrote profile to %s' % path
 
-    def _get_upstream_fd(self, fd):
-        """ Get the current upstream fd for a given client """
+    def _upstream_usable(self, c, now):
+        """ Can another request go out on this upstream connection? """
+
+        if c[4] == -1:
+            return True
+        return now - c[3] < c[4] and c[6] < c[5]
+
+    def _get_upstream_fd(self, fd, pool):
+        """ Get an upstream fd to pool for a given client (or None for a
+            background fetch), None if we must wait
+        """
 
         now = time() 
-        dead = []
-        close = self._close_connection
         conns = self._upstream_connections
 
-        # already have a valid one?
-        conn_fd = self._connections[fd][1]
-        if conn_fd in conns and conn_fd != 0:
+        # already have a valid one to that backend? pipeline on it
+        conn_fd = self._connections[fd][1] if fd is not None else 0
+        if conn_fd != 0 and conn_fd in conns:
             c = conns[conn_fd]
-            if c[4] == -1:
-                return conn_fd
-            if now - c[3] < c[4] and c[6] < c[5]:
+            if c[7] is pool and self._upstream_usable(c, now):
                 return conn_fd
 
-        # try to (re)use an existing one...
-        for k, c in conns.viewitems():
-            conn_fd = c[0].fileno()
-            if c[4] != -1:
-                if now - c[3] >= c[4] or c[6] >= c[5]:
-                    dead.append(conn_fd)
-                    continue
-            if c[1] == 0:
-                for d_fd in dead:
-                    close(d_fd)
+        dead = []
 
-                c[1] = fd
-                self._connections[fd][1] = conn_fd
-                return conn_fd
+        # try to (re)use an idle one...
+        while True:
+            conn_fd = pool.acquire()
+            if conn_fd is None:
+                break
+            c = conns[conn_fd]
+            if self._upstream_usable(c, now):
+                break
+            dead.append(conn_fd)
 
         # close any dead upstream conns
         for d_fd in dead:
-            close(d_fd)
+            self._close_connection(d_fd)
+
+        if conn_fd is not None:
+            if fd is not None:
+                c[1] = fd
+                self._connections[fd][1] = conn_fd
+            return conn_fd
+
+        if pool.full():
+            return None
 
         # else create a new one...
-        (host, port) = choice(self._upstream_servers)
-        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn_fd = self._open_upstream(pool)
+        if conn_fd is None:
+            return None
+
+        if fd is not None:
+            conns[conn_fd][1] = fd
+            self._connections[fd][1] = conn_fd
+
+        return conn_fd
+
+    def _open_upstream(self, pool):
+        """ Start a non-blocking connect, it completes on EPOLLOUT """
+
+        conn = pool.connect()
+        if conn is None:
+            return None
+
         conn_fd = conn.fileno()
-        conn.connect((host, port))
-        conn.setblocking(0)
-        self._epoll.register(conn_fd) 
+        self._epoll.register(conn_fd, select.EPOLLOUT | select.EPOLLRDHUP)
 
-        # spec: conn, down_fd, ctime, atime, timeout, max, count 
-        self._upstream_connections[conn_fd] = [conn, fd, time(), 0, -1, 0, 0]
-        self._connections[fd][1] = conn_fd
+        # spec: conn, down_fd, ctime, atime, timeout, max, count, pool, connected,
+        #       idle timer, response timer
+        self._upstream_connections[conn_fd] = [conn, 0, time(), 0, -1, 0, 0, pool, False,
+                                               None, None]
 
         return conn_fd
-        
+
+    def _warm_pool(self, pool):
+        """ Open idle connections until the pool has its minimum """
+
+        while pool.needs_warming():
+            conn_fd = self._open_upstream(pool)
+            if conn_fd is None:
+                break
+            pool.release(conn_fd)
+            c = self._upstream_connections[conn_fd]
+            c[9] = self._timers.schedule(UPSTREAM_TIMEOUT, self._expire_upstream, conn_fd, c)
+
+    def _expire_upstream(self, fd, c):
+        """ Timer: close an upstream that has sat idle past its keep-alive """
+
+        if self._upstream_connections.get(fd) is not c:
+            return
+
+        c[9] = None
+        if c[1] != 0 or len(self._stream_map.get(fd, ())) != 0:
+            # busy again, the next release schedules a new check
+            return
+
+        timeout = c[4] if c[4] != -1 else UPSTREAM_TIMEOUT
+        idle = time() - max(c[2], c[3])
+        if idle >= timeout:
+            self._close_connection(fd)
+            return
+
+        # used since we last looked, check again when it could expire
+        c[9] = self._timers.schedule(timeout - idle, self._expire_upstream, fd, c)
+
+    def _release_upstream(self, fd):
+        """ An upstream connection has no responses outstanding, pool it """
+
+        c = self._upstream_connections[fd]
+        dn_fd = c[1]
+
+        if dn_fd != 0 and dn_fd in self._connections and self._connections[dn_fd][1] == fd:
+            self._connections[dn_fd][1] = 0
+
+        c[1] = 0
+        c[7].release(fd)
+
+        if c[9] is None:
+            # one check per connection, it re-arms itself from the last activity
+            timeout = c[4] if c[4] != -1 else UPSTREAM_TIMEOUT
+            c[9] = self._timers.schedule(timeout, self._expire_upstream, fd, c)
+
+        # just listen for the server closing it
+        self._epoll.modify(fd, select.EPOLLIN | select.EPOLLRDHUP)
+
+        if self._upstream_waiting:
+            self._drain_waiting()
+
+    def _drain_waiting(self):
+        """ Send requests that were waiting for an upstream connection """
+
+        # closing dead connections below lands us back here
+        if self._draining:
+            return
+
+        waiting = self._upstream_waiting
+        self._draining = True
+
+        try:
+            while waiting:
+                (fd, conn, request, responsev) = waiting[0]
+                if self._connections.get(fd) is not conn:
+                    waiting.popleft()
+                    continue
+
+                pool = self._balancer.choose(responsev[0])
+                if pool is None:
+                    # everything went down while it waited
+                    waiting.popleft()
+                    self._unavailable(fd, responsev)
+                    continue
+
+                ufd = self._get_upstream_fd(fd, pool)
+                if ufd is None:
+                    return
+
+                waiting.popleft()
+                self._send_upstream(fd, ufd, request, responsev)
+        finally:
+            self._draining = False
 
     def _new_connection(self):
         """ Initialize a new client connection """
 
-        conn, address = self._socket.accept()
+        try:
+            conn, address = self._socket.accept()
+        except socket.error:
+            return
+
         conn.setblocking(0)
         fd = conn.fileno()
-
-        # reap any dead clients every so often...
-        if randint(0, 100) == 1:
-            self._gc_connections()
+        self._stats['accepted'] += 1
 
         self._epoll.register(fd, select.EPOLLIN | select.EPOLLRDHUP)
 
-        # spec: conn, up_fd, ctime, atime, timeout, max, count
-        self._connections[fd] = [conn, 0, time(), 0, CLIENT_TIMEOUT, CLIENT_MAX_REQS, 0]
+        now = time()
+
+        # spec: conn, up_fd, ctime, atime, timeout, max, count, request started
+        c = [conn, 0, now, now, CLIENT_TIMEOUT, CLIENT_MAX_REQS, 0, 0]
+        self._connections[fd] = c
         self._requests[fd]    = HttpParser()
         self._responses[fd]   = deque()
 
-    def _gc_connections(self):
-        """ Clean up any idle client connections """
+        self._timers.schedule(CLIENT_TIMEOUT, self._expire_client, fd, c)
 
-        close = self._close_connection
-        conns = self._connections
-        now   = time()
+    def _expire_client(self, fd, c):
+        """ Timer: close a client that has gone idle or used up its requests """
 
-        dead = [fd for fd, c in conns.viewitems() \
-                if now - c[3] >= c[4] or c[6] >= c[5]]
+        if self._connections.get(fd) is not c:
+            return
 
-        for fd in dead:
-            close(fd)
+        idle = time() - c[3]
+        if idle >= c[4] or (c[6] >= c[5] and len(self._responses[fd]) == 0):
+            self._close_connection(fd)
+            return
+
+        # it was active since we last looked, check again when it could expire
+        self._timers.schedule(c[4] - idle, self._expire_client, fd, c)
 
     def _close_connection(self, fd):
         """ Handle EPOLLHUP: a client or upstream connection has been closed """
 
+        if self._mc is not None and self._mc.owns(fd):
+            self._mc.close(fd)
+            return
+
+        if self._health is not None and self._health.owns(fd):
+            self._health.close(fd)
+            return
+
         self._epoll.unregister(fd)
 
         if fd in self._connections:
@@ -199,28 +633,49 @@ class Server(object):
     def _close_upstream(self, fd):
         """ Clean up an upstream connection """
 
-        dn_fd = self._upstream_connections[fd][1]
+        c = self._upstream_connections.pop(fd)
+        dn_fd = c[1]
+        pool = c[7]
 
-        self._upstream_connections[fd][0].close()
-        del self._upstream_connections[fd]
+        c[0].close()
+        pool.closed(fd)
+
+        if not c[8]:
+            # never got connected, try warming it again later
+            self._timers.schedule(RETRY_TIMEOUT, self._warm_pool, pool)
 
         if dn_fd != 0:
             # indicate that this client has no upstream assigned
-            if dn_fd in self._connections:
+            if dn_fd in self._connections and self._connections[dn_fd][1] == fd:
                 self._connections[dn_fd][1] = 0
-            
-            # close client if there are outstanding responses
-            if len(self._stream_map.get(fd, [])) != 0:
-                self._close_connection(dn_fd)
 
         self._upstream_requests.pop(fd, None)
-        self._stream_map.pop(fd, None)
+        outstanding = self._stream_map.pop(fd, None)
+
+        if outstanding:
+            pool.answered(len(outstanding))
+
+            # none of these has gone out to the client yet, answer them
+            # from stale copies where we may and with a 502 where not
+            for responsev in outstanding:
+                self._fail_response(responsev, BAD_GATEWAY, dn_fd)
+            self._wake(dn_fd)
+
+        # there's room for another connection now
+        if self._upstream_waiting:
+            self._drain_waiting()
+
+        self._warm_pool(pool)
 
     def _write_event(self, fd):
         """ Handle EPOLLOUT: a client or upstream connection can be written """
 
         if fd in self._connections:
             self._write_response(fd)
+        elif self._mc is not None and self._mc.owns(fd):
+            self._mc.write(fd)
+        elif self._health is not None and self._health.owns(fd):
+            self._health.write(fd)
         else:
             self._write_request(fd)
 
@@ -233,14 +688,15 @@ class Server(object):
         if len(self._responses[fd]) == 0:
             return
 
-        # note: response is None if this is from cache
-        (key, response, stream) = self._responses[fd][0]
-        if not stream.ready():
+        stream = self._responses[fd][0][2]
+        if stream.pending() == 0 and not stream.closed():
+            # the next response isn't in yet, sleep until it's woken
+            self._epoll.modify(fd, select.EPOLLIN | select.EPOLLRDHUP)
             return
 
         conn = self._connections[fd]
         try:
-            sent = conn[0].send( stream.read() )
+            sent = send_stream( conn[0], stream )
         except:
             self._close_connection(fd)
             return
@@ -251,10 +707,13 @@ class Server(object):
 
         # update atime
         conn[3] = time()
+        self._stats['bytes_out'] += sent
         stream.ack( sent )
 
         if stream.complete():
-            self._responses[fd].popleft()
+            times = self._responses[fd].popleft()[8]
+            if times is not None:
+                self._record_latency(times, conn[3])
 
             if len(self._responses[fd]) == 0:
                 self._epoll.modify(fd, select.EPOLLIN | select.EPOLLRDHUP)
@@ -262,32 +721,52 @@ class Server(object):
     def _write_request(self, fd):
         """ Write requests to the upstream wires """
 
+        conn = self._upstream_connections.get(fd, None)
+
+        if conn is None:
+            # closed earlier in this batch of events
+            return
+
+        if not conn[8]:
+            # non-blocking connect finished, did it work?
+            if conn[0].getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                self._fail_upstream(fd)
+                return
+            conn[8] = True
+
         if len(self._upstream_requests.get(fd, [])) == 0:
+            self._epoll.modify(fd, select.EPOLLIN | select.EPOLLRDHUP)
             return
 
-        conn = self._upstream_connections[fd]
         stream = self._upstream_requests[fd][0]
 
         if not stream.ready():
             return
 
         try:
-            sent = conn[0].send( stream.read() )
+            sent = send_stream( conn[0], stream )
         except:
-            self._close_connection(fd)
+            self._fail_upstream(fd)
             return
 
         if sent == 0:
-            self._close_connection(fd)
+            self._fail_upstream(fd)
             return
 
         # update atime
         conn[3] = time()
+        self._stats['upstream_bytes_out'] += sent
         stream.ack( sent )
 
         if stream.complete():
             self._upstream_requests[fd].popleft()
 
+            # the responses behind the unwritten requests are theirs, this is ours
+            outstanding = self._stream_map.get(fd, ())
+            i = len(outstanding) - len(self._upstream_requests[fd]) - 1
+            if i >= 0 and outstanding[i][8] is not None:
+                outstanding[i][8][4] = conn[3]
+
             if len(self._upstream_requests[fd]) == 0:
                 self._epoll.modify(fd, select.EPOLLIN | select.EPOLLRDHUP)
 
@@ -296,6 +775,10 @@ class Server(object):
 
         if fd in self._connections:
             self._read_requests(fd)
+        elif self._mc is not None and self._mc.owns(fd):
+            self._mc.read(fd)
+        elif self._health is not None and self._health.owns(fd):
+            self._health.read(fd)
         else:
             self._read_responses(fd)
 
@@ -307,75 +790,481 @@ class Server(object):
         
         conn = self._connections[fd]
 
+        data = self._recv_buf
+
         try:
-            data = conn[0].recv(4096)
+            nbytes = conn[0].recv_into(data)
         except:
             self._close_connection(fd)
             return
 
+        if nbytes == 0:
+            # client hung up
+            self._close_connection(fd)
+            return
+
         # update atime
         conn[3] = time()
+        self._stats['bytes_in'] += nbytes
+        if conn[7] == 0:
+            # first bytes of a request
+            conn[7] = conn[3]
         request = self._requests[fd]
+        offset = 0
         
-        while len(data) != 0:
+        while offset < nbytes:
 
-            parsed = request.parse(data, len(data))
-            data = data[parsed:]
+            offset += request.parse(data, nbytes - offset, offset)
 
             if request.message_complete():                
 
-                key = request.url()
+                conn[6] += 1
 
-                # KILL SWITCH: don't ask.
-                if key == '/kill':
-                    sys.exit(0)
+                # the clock starts on the next one if it's here already
+                times = [False, conn[7], time(), None, None, None]
+                conn[7] = conn[3] if offset < nbytes else 0
+
+                form = self._stats_urls and self._stats_request(conn, request.url())
+                if form:
+                    responsev = [None, None, self._stream_buf(), request, None, 0,
+                                 BUFFERED, None, None]
+                    responsev[2].write( self._stats_response(form) )
+                    responsev[2].close()
+                    self._responses[fd].append( responsev )
+                    self._epoll.modify(fd, select.EPOLLIN | select.EPOLLOUT | select.EPOLLRDHUP)
+                    self._requests[fd] = HttpParser()
+                    request = self._requests[fd]
+                    continue
 
-                # are we caching or just proxy?
-                if self._cache:
-                    blob = self._mc.get(key)
-                    if blob != None:
-                        # this is a cache hit!
-                        conn[6] += 1
-                        stream = StreamBuf( blob )
-                        stream.close()
-                        responsev = (key, None, stream)
-                        self._responses[fd].append( responsev )
-                        self._requests[fd] = HttpParser()
-                        self._epoll.modify(fd, select.EPOLLIN | select.EPOLLOUT | select.EPOLLRDHUP)
-                        request = self._requests[fd]
-                        continue
-
-
-                # going to have to look up stream
-                ufd = self._get_upstream_fd(fd)
-                uconn = self._upstream_connections[ufd]
-                
-                # inc request counts
-                conn[6] += 1
-                uconn[6] += 1
-
-                # tweak request as needed
-                request.headers()['accept-encoding'] = 'gzip'
-
-                # wrap it in a stream buffer
-                stream = StreamBuf( str(request) )
-                stream.close()
-
-                # watch the fd for r/w
-                self._epoll.modify( fd, select.EPOLLIN | select.EPOLLOUT | select.EPOLLRDHUP)
-                self._epoll.modify(ufd, select.EPOLLIN | select.EPOLLOUT | select.EPOLLRDHUP)
-                
-                # queue the request/response
-                responsev = (key, HttpParser(), StreamBuf())
-                
+                self._stats['requests'] += 1
+
+                policy = self._policy
+                cacheable = policy.lookup(request)
+                key = base = policy.key(request)
+
+                # hot objects are served straight from process memory
+                entry = None
+                if cacheable and self._l1 is not None:
+                    entry = self._l1.get(key)
+                    if isinstance(entry, str):
+                        key = policy.variant_key(key, request, policy.parse_marker(entry))
+                        entry = self._l1.get(key)
+                    if entry is not None:
+                        times[3] = times[2]
+                        responsev = [key, None, self._stream_buf(), request, None, 0,
+                                     BUFFERED, None, times]
+                        if self._use_entry(fd, request, responsev, entry):
+                            self._responses[fd].append( responsev )
+                            self._requests[fd] = HttpParser()
+                            request = self._requests[fd]
+                            continue
+
+                # park the request until memcached answers, the response
+                # body is passed through without a gunzip/gzip round trip
+                responsev = [key, HttpParser(raw = True), self._stream_buf(), request, entry, 0,
+                             None, None, times]
                 self._responses[fd].append( responsev )
-                
-                self._upstream_requests.setdefault(ufd, deque()).append( stream )
-                self._stream_map.setdefault(ufd, deque()).append( responsev )
+
+                # are we caching or just proxy?
+                if self._cache and cacheable:
+                    self._mc.get(digest(key), partial(self._cache_lookup, fd, conn, request, responsev,
+                                              key is not base))
+                else:
+                    self._forward_request(fd, request, responsev)
 
                 self._requests[fd] = HttpParser()
                 request = self._requests[fd]
 
+    def _cache_lookup(self, fd, conn, request, responsev, variant, blob):
+        """ Resume a parked request once its cache lookup completes """
+
+        # client went away (and maybe the fd was reused) while we waited
+        if self._connections.get(fd) is not conn:
+            return
+
+        responsev[8][3] = time()
+
+        vary = None
+        if blob is not None:
+            vary = self._policy.parse_marker(blob)
+
+        if vary is not None:
+            if variant:
+                # a marker where a variant should be, treat it as a miss
+                blob = None
+            else:
+                # the object varies, look up the variant for this request
+                if self._l1 is not None:
+                    self._l1.set(responsev[0], blob, self._ttl)
+                responsev[0] = self._policy.variant_key(responsev[0], request, vary)
+                self._mc.get(digest(responsev[0]), partial(self._cache_lookup, fd, conn, request,
+                                                   responsev, True))
+                return
+
+        entry = None
+        if blob is not None:
+            entry = CacheEntry.unpack(blob, responsev[0])
+            if entry is not None:
+                entry = self._compressor.inflate(entry)
+
+        if entry is not None:
+            if self._l1 is not None:
+                self._l1.set(responsev[0], entry, entry.lifetime(self._keep))
+
+            if self._use_entry(fd, request, responsev, entry):
+                return
+
+        self._stats['misses'] += 1
+        self._collapse_request(fd, conn, request, responsev)
+
+    def _use_entry(self, fd, request, responsev, entry):
+        """ Answer a request from a cached entry if we may, True if it was """
+
+        now = time()
+
+        if entry.fresh(now):
+            # this is a cache hit!
+            self._stats['hits'] += 1
+            responsev[8][0] = True
+            self._serve(fd, responsev, entry)
+
+            # hot and nearly stale? refresh it before everyone notices
+            if self._xfetch > 0 and entry.early(self._xfetch, now):
+                self._refresh(responsev[0], request, entry)
+            return True
+
+        if entry.stale_ok(now):
+            # serve it stale, someone's getting a fresh one
+            self._stats['stale'] += 1
+            responsev[8][0] = True
+            self._serve(fd, responsev, entry)
+            self._refresh(responsev[0], request, entry)
+            return True
+
+        # too stale, but maybe the origin will say it's still good
+        responsev[4] = entry
+        return False
+
+    def _refresh(self, key, request, entry):
+        """ Fetch a fresh copy of an entry in the background, once """
+
+        if key in self._inflight:
+            return
+
+        self._stats['refreshes'] += 1
+
+        # no client waits on this one, but requests that can't take the
+        # stale copy will wait on it like on any other fetch
+        responsev = [key, HttpParser(raw = True), self._stream_buf(), request, entry, 0,
+                     None, None, None]
+        flight = [responsev, time(), []]
+        self._inflight[key] = flight
+        self._timers.schedule(self._upstream_timeout, self._expire_flight, key, flight)
+
+        self._forward_request(None, request, responsev)
+
+    def _serve(self, fd, responsev, entry):
+        """ Answer a client's request from a cache entry and start writing """
+
+        self._answer(responsev, entry, fd)
+        self._epoll.modify(fd, select.EPOLLIN | select.EPOLLOUT | select.EPOLLRDHUP)
+
+    def _answer(self, responsev, entry, fd):
+        """ Fill in a response from an entry, a 304 if the request's conditionals match
+
+            fd is the client's, an entry stored in segments is streamed to it
+            as they arrive (background fetches have no client, and get nothing).
+        """
+
+        stream = responsev[2]
+        if entry.not_modified(responsev[3]):
+            self._stats['not_modified'] += 1
+            stream.write( entry.not_modified_response() )
+        elif entry.segmented():
+            if fd in self._connections:
+                self._stream_segments(fd, responsev, entry)
+            return
+        else:
+            stream.write( entry.head() )
+            stream.write( entry.body() )
+        stream.close()
+
+    def _stream_segments(self, fd, responsev, entry):
+        """ Fetch a big object's segments in one go, they're written out in order """
+
+        keys = [digest(k) for k in entry.segment_keys(responsev[0])]
+        index = dict((k, i) for i, k in enumerate(keys))
+
+        # spec: next segment to write, segments that came in ahead of it, inflater
+        state = [0, {}, None]
+        if entry.deflated():
+            state[2] = self._compressor.inflater()
+
+        self._mc.get_multi(keys, partial(self._write_segment, fd, self._connections[fd],
+                                         responsev, entry.head(), index, state))
+
+    def _write_segment(self, fd, conn, responsev, head, index, state, key, value):
+        """ A segment is in: write it, and any it was holding up, to the client """
+
+        if state[0] < 0 or self._connections.get(fd) is not conn:
+            return
+
+        stream = responsev[2]
+
+        if value is None:
+            # evicted from under its manifest
+            state[0] = -1
+            if stream.ready():
+                # too late to take back what's gone out
+                self._close_connection(fd)
+                return
+            self._stats['misses'] += 1
+            responsev[1] = HttpParser(raw = True)
+            responsev[4] = None
+            responsev[6] = None
+            responsev[8][0] = False
+            self._collapse_request(fd, conn, responsev[3], responsev)
+            return
+
+        early = state[1]
+        early[index[key]] = value
+
+        if state[0] == 0 and 0 in early:
+            stream.write( head )
+
+        inflater = state[2]
+        count = len(index)
+
+        try:
+            while state[0] in early:
+                piece = early.pop(state[0])
+                state[0] += 1
+                if inflater is not None:
+                    piece = self._compressor.inflate_piece(inflater, piece, state[0] == count)
+                stream.write( piece )
+        except zlib.error:
+            state[0] = -1
+            self._close_connection(fd)
+            return
+
+        if state[0] == count:
+            stream.close()
+
+        self._wake(fd)
+
+    def _collapse_request(self, fd, conn, request, responsev):
+        """ Send a miss upstream, or wait on a fetch of the same key """
+
+        if self._collapse_timeout <= 0 or not self._policy.lookup(request):
+            self._forward_request(fd, request, responsev)
+            return
+
+        key = responsev[0]
+        flight = self._inflight.get(key, None)
+
+        if flight is not None:
+            flight[2].append( (fd, conn, request, responsev) )
+            self._stats['collapsed'] += 1
+            return
+
+        flight = [responsev, time(), []]
+        self._inflight[key] = flight
+        self._timers.schedule(self._collapse_timeout, self._expire_flight, key, flight)
+
+        self._forward_request(fd, request, responsev)
+
+    def _land_flight(self, responsev, entry, vary):
+        """ Fan a completed response out to requests waiting on it """
+
+        flight = self._inflight.get(responsev[0], None)
+        if flight is None or flight[0] is not responsev:
+            return
+
+        del self._inflight[responsev[0]]
+
+        if entry is None or entry.ttl() <= 0:
+            # not for sharing, everyone fetches their own
+            self._release_waiters(flight)
+            return
+
+        if vary:
+            policy = self._policy
+            variant = policy.variant_key('', responsev[3], vary)
+
+        for (fd, conn, request, waiter) in flight[2]:
+            if self._connections.get(fd) is not conn:
+                continue
+            if vary and policy.variant_key('', request, vary) != variant:
+                # wants a different variant
+                self._forward_request(fd, request, waiter)
+                continue
+            waiter[8][5] = time()
+            self._serve(fd, waiter, entry)
+
+    def _abort_flight(self, responsev):
+        """ The leader's fetch failed, waiters fetch on their own """
+
+        flight = self._inflight.get(responsev[0], None)
+        if flight is None or flight[0] is not responsev:
+            return
+
+        del self._inflight[responsev[0]]
+        self._release_waiters(flight)
+
+    def _release_waiters(self, flight):
+        """ Send each waiter of a flight upstream separately """
+
+        for (fd, conn, request, waiter) in flight[2]:
+            if self._connections.get(fd) is conn:
+                self._forward_request(fd, request, waiter)
+
+    def _expire_flight(self, key, flight):
+        """ Timer: stop waiting on a fetch that has taken too long """
+
+        if self._inflight.get(key) is not flight:
+            return
+
+        # the leader carries on as a plain request
+        del self._inflight[key]
+        self._release_waiters(flight)
+
+    def _forward_request(self, fd, request, responsev):
+        """ Send a client request upstream, its response lands in responsev
+
+            fd is None for background fetches that have no client.
+        """
+
+        pool = self._balancer.choose(responsev[0])
+        if pool is None:
+            self._unavailable(fd, responsev)
+            return
+
+        # going to have to look up stream
+        ufd = self._get_upstream_fd(fd, pool)
+
+        if ufd is None:
+            # backend is at its connection limit (or down), wait our turn
+            self._upstream_waiting.append( (fd, self._connections.get(fd, None), request, responsev) )
+            return
+
+        self._send_upstream(fd, ufd, request, responsev)
+
+    def _upstream_request(self, request, responsev):
+        """ Serialize a client request for the origin, leaving the client's headers be """
+
+        headers = request.headers()
+        saved = dict((h, headers.get(h, None)) for h in REWRITTEN_HEADERS)
+
+        # tweak request as needed
+        headers['accept-encoding'] = 'gzip'
+
+        if self._policy.lookup(request) and (self._cache or self._l1 is not None):
+            # we want the whole object to cache, clients' conditionals are
+            # answered from it; ours are to revalidate what we have
+            headers.pop('if-none-match', None)
+            headers.pop('if-modified-since', None)
+            if responsev[4] is not None:
+                headers.update(responsev[4].validators())
+
+        data = str(request)
+
+        for h, v in saved.iteritems():
+            if v is None:
+                headers.pop(h, None)
+            else:
+                headers[h] = v
+
+        return data
+
+    def _unavailable(self, fd, responsev):
+        """ No backend is healthy, answer with a 503 (or a stale copy) """
+
+        self._fail_response(responsev, UNAVAILABLE, fd)
+        self._wake(fd)
+
+    def _fail_response(self, responsev, error, fd):
+        """ A fetch fell through: serve the stale copy if it may be, else error """
+
+        if self._inflight:
+            self._abort_flight(responsev)
+
+        if responsev[2].ready():
+            # part of it has gone out already, all we can do is hang up
+            if fd in self._connections:
+                self._close_connection(fd)
+            return
+
+        stale = responsev[4]
+        if stale is not None and stale.error_ok():
+            self._stats['stale'] += 1
+            self._answer(responsev, stale, fd)
+            return
+
+        stream = responsev[2]
+        stream.write( error )
+        stream.close()
+
+    def _wake(self, fd):
+        """ Have a client written to, something may be ready for it """
+
+        if fd in self._connections:
+            self._epoll.modify(fd, select.EPOLLIN | select.EPOLLOUT | select.EPOLLRDHUP)
+
+    def _fail_upstream(self, fd):
+        """ An upstream connection failed (refused, reset, timed out), count it and close """
+
+        self._upstream_connections[fd][7].failed()
+        self._close_connection(fd)
+
+    def _expire_response(self, fd, c):
+        """ Timer: fail an upstream that has gone quiet on our requests """
+
+        if self._upstream_connections.get(fd) is not c:
+            return
+
+        c[10] = None
+        if len(self._stream_map.get(fd, ())) == 0:
+            # answered, the next request schedules a new check
+            return
+
+        quiet = time() - c[3]
+        if quiet >= self._upstream_timeout:
+            self._fail_upstream(fd)
+            return
+
+        c[10] = self._timers.schedule(self._upstream_timeout - quiet, self._expire_response, fd, c)
+
+    def _send_upstream(self, fd, ufd, request, responsev):
+        """ Queue a request on an upstream connection """
+
+        uconn = self._upstream_connections[ufd]
+
+        # inc request counts
+        uconn[6] += 1
+        uconn[7].sent()
+        self._stats['upstream_requests'] += 1
+
+        # wrap it in a stream buffer
+        stream = self._stream_buf( self._upstream_request(request, responsev) )
+        stream.close()
+
+        # watch the upstream for r/w, the client is woken when its response is in
+        self._epoll.modify(ufd, select.EPOLLIN | select.EPOLLOUT | select.EPOLLRDHUP)
+        responsev[5] = time()
+
+        # queue the request/response
+        self._upstream_requests.setdefault(ufd, deque()).append( stream )
+        outstanding = self._stream_map.setdefault(ufd, deque())
+        outstanding.append( responsev )
+
+        if len(outstanding) == 1:
+            # start the clock on its answer, a check that's still pending
+            # re-arms itself from there
+            uconn[3] = time()
+            if uconn[10] is None:
+                uconn[10] = self._timers.schedule(self._upstream_timeout, self._expire_response,
+                                                  ufd, uconn)
+
 
     def _read_responses(self, fd):
         """ Read responses from upstream servers off the wire """
@@ -385,60 +1274,327 @@ class Server(object):
         if conn is None:
             return
 
-        assert fd in self._stream_map
-        
-        if len(self._stream_map[fd]) == 0:
-            return
+        data = self._recv_buf
 
         try:
-            data = conn[0].recv(4096)
+            nbytes = conn[0].recv_into(data)
         except:
+            self._fail_upstream(fd)
+            return
+
+        if nbytes == 0 and len(self._stream_map.get(fd, ())) != 0:
+            # server hung up on our requests
+            self._fail_upstream(fd)
+            return
+
+        if nbytes == 0 or len(self._stream_map.get(fd, ())) == 0:
+            # server closed the connection, or sent what we didn't ask for
             self._close_connection(fd)
             return
 
-        (key, response, stream) = self._stream_map[fd][0]
+        responsev = self._stream_map[fd][0]
+        response = responsev[1]
 
         # update atime
         conn[3] = time()
+        self._stats['upstream_bytes_in'] += nbytes
+        offset = 0
+
+        # set when a response ends the connection: whether the origin said
+        # so, and where the response after it began
+        closing = None
+        begun = 0
 
-        while len(data) != 0:
-            parsed = response.parse(data, len(data))
-            data = data[parsed:]
+        while offset < nbytes:
+            offset += response.parse(data, nbytes - offset, offset)
+
+            if responsev[6] is None:
+                if response.headers_complete():
+                    responsev[6] = self._start_stream(conn[1], responsev)
+            elif responsev[6] != BUFFERED:
+                self._pump_stream(conn[1], responsev)
 
             if response.message_complete():
                 ka = response.keep_alive()
+                closes = response.closes()
                 (timeout, maxr) = response.keep_alive_params()
 
-                headers = response.headers()
-                headers['server'] = 'Shellac/0.1.0a'
-                headers['keep-alive'] = 'timeout=5, max=100'
-                headers['connection'] = 'keep-alive'
-                headers.pop('accept-ranges', None)
+                if responsev[8] is not None:
+                    responsev[8][5] = conn[3]
+
+                stale = responsev[4]
+                status = response.status()
+                mode = responsev[6]
+                entry = None
+                vary = None
+
+                if mode != BUFFERED:
+                    # it's all gone out already, keep the copy if we made one
+                    self._finish_stream(responsev)
+
+                    tee = responsev[7]
+                    if tee is not None:
+                        self._rewrite_response(response)
+                        headers = response.headers()
+                        headers.pop('transfer-encoding', None)
+                        headers['content-length'] = tee[0]
+                        vary = self._policy.vary(response)
+                        entry = self._new_entry(responsev, response.head(), ''.join(tee[1]),
+                                                self._policy.ttl(responsev[3], response))
+                        responsev[7] = None
+                elif stale is not None and status == 304:
+                    # what we have is still good, no need for a body
+                    self._stats['revalidated'] += 1
+                    entry = stale.refreshed(self._policy.refresh_ttl(response, stale.ttl()))
+                    self._answer(responsev, entry, conn[1])
+                elif stale is not None and status >= 500 and stale.error_ok():
+                    # the origin is in trouble, the stale copy beats an error
+                    self._stats['stale'] += 1
+                    entry = stale
+                    self._answer(responsev, entry, conn[1])
+                else:
+                    # decide on caching from the headers as the origin sent them
+                    ttl = self._policy.ttl(responsev[3], response)
+
+                    self._rewrite_response(response)
+                    (head, body) = response.split()
+
+                    if ttl > 0 and len(body) <= self._max_object_size:
+                        vary = self._policy.vary(response)
+                        entry = self._new_entry(responsev, head, body, ttl)
+                        self._answer(responsev, entry, conn[1])
+                    else:
+                        stream = responsev[2]
+                        stream.write( head )
+                        stream.write( body )
+                        stream.close()
 
-                obj = str(response)
+                if entry is not None and entry is not stale and entry.ttl() > 0:
+                    self._store(responsev, entry, vary)
 
-                stream.write( obj )
-                stream.close()
-                
-                if not ka:
-                    self._close_connection(fd)
-                    break
+                if self._inflight:
+                    self._land_flight(responsev, entry, vary)
 
-                # timeout and max requests
-                conn[4] = timeout
-                conn[5] = maxr
+                self._stream_map[fd].popleft()
+                conn[7].answered()
+                conn[7].succeeded()
 
-                if self._cache:
-                    self._mc.set(key, obj, time=self._ttl)
+                self._wake(conn[1])
 
-                self._stream_map[fd].popleft()
+                if not ka and closing is None:
+                    # the last one on this connection, but take what else came in
+                    closing = closes
+                elif closing is None:
+                    # timeout and max requests
+                    conn[4] = timeout
+                    conn[5] = maxr
 
                 if len(self._stream_map[fd]) != 0:
-                    (key, response, stream) = self._stream_map[fd][0]                        
+                    responsev = self._stream_map[fd][0]
+                    response = responsev[1]
+                    begun = offset
                 else:
-                    self._epoll.modify(fd, select.EPOLLOUT | select.EPOLLRDHUP)
+                    if closing is None:
+                        self._release_upstream(fd)
                     break
 
+        if closing is not None:
+            self._close_pipeline(fd, closing, offset > begun)
+
+    def _close_pipeline(self, fd, retry, partial):
+        """ Close an upstream after a response that ended its connection
+
+            Requests pipelined behind that response may or may not have
+            reached the origin. Only when it said Connection: close can
+            we take it they weren't acted on, so GETs and HEADs still
+            without a response are sent again, everything else gets a
+            502. partial says the first of them has part of a response.
+        """
+
+        conn = self._upstream_connections[fd]
+        dn_fd = conn[1]
+        rest = self._stream_map.pop(fd, ())
+        conn[7].answered(len(rest))
+        self._close_connection(fd)
+
+        for i, responsev in enumerate(rest):
+            if retry and not (i == 0 and partial) and responsev[3].method() in ('GET', 'HEAD'):
+                self._forward_request(dn_fd if dn_fd in self._connections else None,
+                                      responsev[3], responsev)
+            else:
+                self._fail_response(responsev, BAD_GATEWAY, dn_fd)
+        self._wake(dn_fd)
+
+    def _rewrite_response(self, response):
+        """ Our headers on an origin's response, on its way to a client """
+
+        headers = response.headers()
+        headers['server'] = 'Shellac/0.1.0a'
+        headers['keep-alive'] = 'timeout=5, max=100'
+        headers['connection'] = 'keep-alive'
+        headers.pop('accept-ranges', None)
+
+    def _new_entry(self, responsev, head, body, ttl):
+        """ A cache entry for a fetched response """
+
+        response = responsev[1]
+        headers = response.headers()
+        (swr, sie) = self._policy.stale(response)
+        now = time()
+        return CacheEntry(head, body, now, ttl, headers.get('etag', None),
+                          headers.get('last-modified', None),
+                          swr, sie, now - responsev[5])
+
+    def _start_stream(self, fd, responsev):
+        """ A response's headers are in, can the rest go to the client as it arrives?
+
+            Returns the mode it's sent in. Streamed responses have their head
+            written now, and a tee to collect the body for the cache if it's
+            cacheable.
+        """
+
+        response = responsev[1]
+        request = responsev[3]
+        stale = responsev[4]
+        status = response.status()
+
+        if response.message_complete() or fd not in self._connections:
+            # nothing left to stream, or nobody to stream it to
+            return BUFFERED
+
+        if stale is not None and (status == 304 or (status >= 500 and stale.error_ok())):
+            # we'll be answering from what we have
+            return BUFFERED
+
+        caching = self._policy.lookup(request) and (self._cache or self._l1 is not None)
+        rh = request.headers()
+        if caching and ('if-none-match' in rh or 'if-modified-since' in rh):
+            # it may turn into a 304 once we have the entry
+            return BUFFERED
+
+        headers = response.headers()
+        if 'transfer-encoding' in headers:
+            if request.version() < 1.1:
+                # can't chunk to this client, and don't know the length yet
+                return BUFFERED
+            mode = CHUNKED
+        else:
+            mode = STREAMED
+
+        if caching and self._policy.ttl(request, response) > 0:
+            length = headers.get('content-length', None)
+            if length is None or int(length) <= self._max_object_size:
+                # spec: bytes so far, pieces
+                responsev[7] = [0, []]
+
+        # the origin's keep-alive headers are needed again once it's done
+        saved = (headers.get('connection', None), headers.get('keep-alive', None))
+        self._rewrite_response(response)
+        responsev[2].write( response.head() )
+        for h, v in zip(('connection', 'keep-alive'), saved):
+            if v is None:
+                headers.pop(h, None)
+            else:
+                headers[h] = v
+
+        self._pump_stream(fd, responsev)
+
+        return mode
+
+    def _pump_stream(self, fd, responsev):
+        """ Pass the body parsed so far on to the client, and the tee """
+
+        piece = responsev[1].take_body()
+        if len(piece) == 0:
+            return
+
+        stream = responsev[2]
+        if responsev[6] == CHUNKED:
+            stream.write( '%x\r\n' % len(piece) )
+            stream.write( piece )
+            stream.write( '\r\n' )
+        else:
+            stream.write( piece )
+
+        tee = responsev[7]
+        if tee is not None:
+            tee[0] += len(piece)
+            if tee[0] > self._max_object_size:
+                # too big to keep, it just passes through
+                responsev[7] = None
+            else:
+                tee[1].append(piece)
+
+        self._wake(fd)
+
+    def _finish_stream(self, responsev):
+        """ The last of a streamed response is in, send it and end the stream """
+
+        self._pump_stream(None, responsev)
+
+        stream = responsev[2]
+        if responsev[6] == CHUNKED:
+            stream.write( '0\r\n\r\n' )
+        stream.close()
+
+    def _store(self, responsev, entry, vary):
+        """ Cache an entry, under its variant key if it varies
+
+            vary is None for a revalidated entry, which goes back
+            under the key it was found under.
+        """
+
+        key = responsev[0]
+        lifetime = entry.lifetime(self._keep)
+
+        if vary is not None:
+            request = responsev[3]
+            key = self._policy.key(request)
+
+            if vary:
+                marker = self._policy.marker(vary)
+                if self._cache:
+                    self._mc.set(digest(key), marker, lifetime)
+                if self._l1 is not None:
+                    self._l1.set(key, marker, lifetime)
+                key = self._policy.variant_key(key, request, vary)
+
+        if self._cache:
+            try:
+                self._store_remote(key, entry, lifetime)
+                self._stats['sets'] += 1
+            except ValueError:
+                # has a header we can't pack, it lives in L1 only
+                pass
+
+        if self._l1 is not None:
+            self._l1.set(key, entry, lifetime)
+
+    def _store_remote(self, key, entry, lifetime):
+        """ Store an entry in memcached, in segments if it's too big for one item """
+
+        mc = self._mc
+
+        if self._compress:
+            entry = self._compressor.deflate(entry)
+
+        if entry.segmented():
+            # revalidated, the segments it points at live as long as it does
+            blob = entry.pack(key)
+            for k in entry.segment_keys(key):
+                mc.touch(digest(k), lifetime)
+            mc.set(digest(key), blob, lifetime)
+        elif entry.length() > self._segment_size:
+            # too big for one item, the segments go first so the
+            # manifest doesn't point at what isn't there yet
+            (manifest, pieces) = entry.split(self._segment_size)
+            blob = manifest.pack(key)
+            for k, piece in zip(manifest.segment_keys(key), pieces):
+                mc.set(digest(k), piece, lifetime)
+            mc.set(digest(key), blob, lifetime)
+        else:
+            mc.set(digest(key), entry.pack(key), lifetime)
+
     def run(self):
         """ Run the server reactor """
 
@@ -447,10 +1603,28 @@ class Server(object):
         read_event       = self._read_event
         write_event      = self._write_event
         close_connection = self._close_connection 
+        timers           = self._timers
+
+        if self._stats_fd is not None:
+            self._report_stats()
+        self._sample_rate()
+
+        self._running = True
 
         try:
-            while True:
-                events = self._epoll.poll(1)
+            while self._running:
+                try:
+                    events = self._epoll.poll(timers.timeout())
+                except IOError as ex:
+                    # a signal, maybe stop() or toggle_profile() was called
+                    if ex.errno != errno.EINTR:
+                        raise
+                    events = []
+
+                if self._profile_toggle:
+                    self._toggle_profile()
+
+                timers.advance()
 
                 for fd, event in events:
                     
@@ -473,10 +1647,40 @@ class Server(object):
                         close_connection(fd)
                     
         finally:
+            if self._profiler.active():
+                self._stop_profile()
             self._epoll.unregister(self._socket.fileno())
             self._epoll.close()
             self._socket.close()
 
+    def stop(self):
+        """ Ask the reactor to exit, safe to call from a signal handler """
+        self._running = False
+
+    def toggle_profile(self):
+        """ Start or stop profiling on the reactor's next pass, safe to call from a signal handler """
+        self._profile_toggle = True
+
+
+def send_stream( sock, stream ):
+    """ Send what the socket will take of a stream, in one writev() if we can """
+    if SENDMSG:
+        return sock.sendmsg( stream.views() )
+    return sock.send( stream.view() )
+
+def stats_text( stats, prefix = '' ):
+    """ stats() as sorted 'name value' lines, nested names joined with dots """
+
+    lines = []
+    for name in sorted(stats):
+        value = stats[name]
+        if isinstance(value, dict):
+            lines.append(stats_text(value, prefix + name + '.'))
+        elif isinstance(value, float):
+            lines.append('%s%s %.3f\n' % (prefix, name, value))
+        else:
+            lines.append('%s%s %s\n' % (prefix, name, value))
+    return ''.join(lines)
 
 def cork_socket( sock ):
     """ Apply the TCP_CORK option to a socket, prevent sending packets """
@@ -490,35 +1694,84 @@ def flush_socket( sock ):
 def main():
     """ Entry point for the server CLI """
 
-    def parse_server_list(slist, default_port):
+    def parse_server_list(slist, default_port, weights = None):
         result = []
         if ',' in slist:
             raw = slist.split(',')
         else:
             raw = [slist]
         for srv in raw:
-            if ':' in srv:
-                (host, port) = srv.split(':')
-                result.append((socket.gethostbyname(host), int(port)))
+            parts = srv.split(':')
+            if len(parts) == 3 and weights is not None:
+                # host:port:weight
+                weights.append(int(parts[2]))
+            elif weights is not None:
+                weights.append(1)
+            if len(parts) > 1:
+                result.append((socket.gethostbyname(parts[0]), int(parts[1])))
             else:
                 result.append((socket.gethostbyname(srv), default_port))
         return result
 
     parser = argparse.ArgumentParser(description='Shellac Accelerator')
     parser.add_argument('-s', '--servers',
-                            help='Web servers to cache: host:port,host:port,... (port defaults to 80)')
+                            help='Web servers to cache: host:port[:weight],... (port defaults to 80, weight to 1)')
     parser.add_argument('-c', '--caches',
                             help='Cache servers to use: host:port,host:port,... (port defaults to 11211)')
     parser.add_argument('-p', '--port', type=int, default=8080, 
                             help='Port to listen for connections on.')
     parser.add_argument('-t', '--ttl', type=int, default=170,
-                            help='Lifetime of cached objects.')
+                            help='Lifetime of cached objects that don\'t set their own.')
+    parser.add_argument('-k', '--keep', type=int, default=3600,
+                            help='Seconds to keep stale objects that can be revalidated.')
+    parser.add_argument('-g', '--grace', type=int, default=10,
+                            help='Seconds a stale object is served while it\'s refreshed in the background.')
+    parser.add_argument('-o', '--stale-if-error', type=int, default=300,
+                            help='Seconds a stale object is served when its web server is failing.')
+    parser.add_argument('-x', '--xfetch-beta', type=float, default=1.0,
+                            help='How early hot objects are refreshed before they expire (0 disables).')
     parser.add_argument('-z', '--compress', action='store_true',
-                            help='Compress cached objects.')
+                            help='Compress cached objects where it\'s worth it.')
+    parser.add_argument('-l', '--l1-size', type=int, default=0,
+                            help='Bytes of in-process cache in front of memcached (0 disables).')
+    parser.add_argument('-r', '--recv-size', type=int, default=16384,
+                            help='Bytes to read from a socket at a time.')
+    parser.add_argument('-m', '--upstream-max', type=int, default=0,
+                            help='Most connections to open per web server (0 means no limit).')
+    parser.add_argument('-i', '--upstream-min-idle', type=int, default=0,
+                            help='Idle connections to keep open per web server, opened at startup.')
+    parser.add_argument('-n', '--workers', type=int, default=1,
+                            help='Worker processes to run, sharing the port.')
+    parser.add_argument('-a', '--pin-cpus', action='store_true',
+                            help='Pin each worker to its own CPU.')
+    parser.add_argument('-w', '--collapse-timeout', type=float, default=5,
+                            help='Seconds a miss may wait on a fetch of the same object (0 disables).')
+    parser.add_argument('-b', '--balance', default='least-outstanding',
+                            choices=sorted(BALANCERS.keys()),
+                            help='How to spread requests across web servers.')
+    parser.add_argument('-f', '--max-fails', type=int, default=3,
+                            help='Consecutive failures before a web server is ejected (0 disables).')
+    parser.add_argument('-e', '--health-check', metavar='PATH',
+                            help='Path to probe on each web server to check its health.')
+    parser.add_argument('-u', '--upstream-timeout', type=float, default=RESPONSE_TIMEOUT,
+                            help='Seconds a web server may keep us waiting on a response.')
+    parser.add_argument('-y', '--segment-size', type=int, default=SEGMENT_SIZE,
+                            help='Bytes per memcached item, bigger objects are split (see memcached -I).')
+    parser.add_argument('-j', '--max-object-size', type=int, default=MAX_OBJECT_SIZE,
+                            help='Bytes in the biggest object to cache, bigger ones are passed through.')
+    parser.add_argument('-S', '--stats-url', default=STATS_URL,
+                            help='URL answered with live stats, JSON or text with .txt (empty disables).')
+    parser.add_argument('-A', '--stats-allow', default=','.join(STATS_ALLOW),
+                            help='Client addresses that may read the stats URL: addr,addr,...')
+    parser.add_argument('-P', '--profile-dir', default='.',
+                            help='Where profiles go, SIGUSR2 starts and stops one.')
+    parser.add_argument('-T', '--profile-seconds', type=float, default=PROFILE_SECONDS,
+                            help='Longest a profile runs before it\'s written out.')
 
     args = parser.parse_args()
 
-    servers = parse_server_list(args.servers, 80)
+    weights = []
+    servers = parse_server_list(args.servers, 80, weights)
     caches = parse_server_list(args.caches, 11211)
 
     if len(servers) == 0:
@@ -530,24 +1783,66 @@ def main():
         sys.exit(1)
 
     # todo: check that servers are responsive
-    
-    print 'Running Shellac on port %d...' % args.port
-
-    signal.signal(signal.SIGINT, signal_handler)
 
-    try:
-        shellac = Server(servers, caches, 
+    def make_server(stats_fd = None):
+        return Server(servers, caches, 
                         port = args.port,
                         ttl = args.ttl,
                         compress = args.compress,
-                        cache = len(caches) != 0)
+                        cache = len(caches) != 0,
+                        l1_size = args.l1_size,
+                        collapse_timeout = args.collapse_timeout,
+                        recv_size = args.recv_size,
+                        reuse_port = args.workers > 1,
+                        stats_fd = stats_fd,
+                        upstream_max = args.upstream_max,
+                        upstream_min_idle = args.upstream_min_idle,
+                        weights = weights,
+                        balance = args.balance,
+                        max_fails = args.max_fails,
+                        health_check = args.health_check,
+                        upstream_timeout = args.upstream_timeout,
+                        keep = args.keep,
+                        grace = args.grace,
+                        stale_if_error = args.stale_if_error,
+                        xfetch = args.xfetch_beta,
+                        segment_size = args.segment_size,
+                        max_object_size = args.max_object_size,
+                        stats_url = args.stats_url,
+                        stats_allow = args.stats_allow.split(','),
+                        profile_dir = args.profile_dir,
+                        profile_seconds = args.profile_seconds)
+
+    if args.workers > 1:
+        print 'Running Shellac on port %d with %d workers...' % (args.port, args.workers)
+
+        supervisor = Supervisor(args.workers, make_server, pin = args.pin_cpus)
+        supervisor.run()
+
+        print
+        print 'Shutting down...'
+        supervisor.print_stats()
+        return
+
+    print 'Running Shellac on port %d...' % args.port
+
+    shellac = None
+    try:
+        shellac = make_server()
+        stop = lambda signum, frame: shellac.stop()
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGUSR2, lambda signum, frame: shellac.toggle_profile())
         shellac.run()
     except (KeyboardInterrupt, IOError) as ex:
-        print
-        print 'Shutting down...' 
+        pass
+
+    print
+    print 'Shutting down...' 
 
-def signal_handler(signal, frame):
-    pass
+    if shellac is not None and args.l1_size > 0:
+        print 'L1 cache: %(hits)d hits, %(misses)d misses, %(evictions)d evictions, ' \
+              '%(entries)d entries, %(bytes)d/%(limit)d bytes' % shellac._l1.stats()
 
 if __name__ == '__main__':
     main()
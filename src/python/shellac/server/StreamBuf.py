@@ -56,6 +56,15 @@ class StreamBuf(object):
     def read(self):   
         return self._buf[self._pos:]
 
+    def view(self):
+        return memoryview(self._buf)[self._pos:]
+
+    def views(self):
+        return [self.view()]
+
+    def pending(self):
+        return len(self._buf) - self._pos
+
     def close(self):
         self._eof = True
 
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""
+    A pre-forking supervisor for Shellac workers
+
+    Supervisor forks N worker processes, each running its
+    own Server reactor on a listening socket bound with
+    SO_REUSEPORT so the kernel spreads new connections
+    across them. Crashed workers are restarted, SIGTERM and
+    SIGINT are forwarded for a clean shutdown, SIGUSR1
+    prints the workers' counters summed together and SIGUSR2
+    is passed on to every worker to start or stop profiling.
+
+    Workers report their Server.stats() as one JSON object
+    per line over a pipe; the supervisor keeps the latest
+    report from each. Latency histograms come with their
+    buckets, which are summed and the percentiles worked
+    out again.
+
+    Usage:
+        def make_server(stats_fd):
+            return Server(servers, caches, reuse_port = True,
+                          stats_fd = stats_fd)
+
+        Supervisor(4, make_server, pin = True).run()
+
+    Limitations:
+        - Linux only (SO_REUSEPORT, sched_setaffinity)
+        - stats are only as fresh as the last report
+        - a worker that keeps crashing is restarted forever,
+          at most once a second
+
+"""
+
+import os
+import sys
+import json
+import errno
+import signal
+import select
+import ctypes
+import ctypes.util
+
+from time import time, sleep
+
+from Histogram import Histogram
+
+# don't restart a worker more often than this (seconds)
+RESTART_DELAY = 1
+
+# how long workers get to exit after SIGTERM (seconds)
+SHUTDOWN_TIMEOUT = 10
+
+def pin_to_cpu(cpu):
+    """ Bind the calling process to a single CPU, best effort """
+
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, [cpu])
+        return True
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+    except OSError:
+        return False
+
+    bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong * (cpu / bits + 1))()
+    mask[cpu / bits] = 1 << (cpu % bits)
+
+    return libc.sched_setaffinity(0, ctypes.sizeof(mask), mask) == 0
+
+def cpu_count():
+    try:
+        return os.sysconf('SC_NPROCESSORS_ONLN')
+    except (ValueError, OSError):
+        return 1
+
+def aggregate(reports):
+    """ Sum worker stats, recursing into nested dicts """
+
+    total = {}
+    for report in reports:
+        for k, v in report.iteritems():
+            if isinstance(v, dict):
+                total[k] = aggregate([total.get(k, {}), v])
+            elif isinstance(v, (int, long, float)):
+                total[k] = total.get(k, 0) + v
+    return total
+
+def summarize(stats):
+    """ Work summed histograms' percentiles out again from their buckets """
+
+    for v in stats.itervalues():
+        if isinstance(v, dict):
+            summarize(v)
+    if 'buckets' in stats:
+        # percentiles don't add up, the buckets do
+        stats.update(Histogram().load(stats.pop('buckets')).stats())
+    return stats
+
+
+class Supervisor(object):
+
+    def __init__(self, workers, make_server, pin = False):
+        """ Supervise workers running make_server(stats_fd).run() """
+
+        self._workers = workers
+        self._make_server = make_server
+        self._pin = pin
+        self._ncpus = cpu_count()
+
+        # pid => worker index
+        self._pids = {}
+
+        # stats pipe read fd => [worker index, partial line]
+        self._pipes = {}
+
+        # worker index => latest stats report
+        self._stats = {}
+
+        # worker index => last (re)start time
+        self._started = {}
+
+        self._stopping = False
+        self._dump = False
+        self._profile = False
+
+    def _spawn(self, idx):
+        """ Fork worker idx """
+
+        (rfd, wfd) = os.pipe()
+        self._started[idx] = time()
+
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            self._worker(idx, wfd)
+            # not reached
+
+        os.close(wfd)
+        self._pids[pid] = idx
+        self._pipes[rfd] = [idx, '']
+
+    def _worker(self, idx, wfd):
+        """ Body of a worker process, never returns """
+
+        for rfd in self._pipes:
+            os.close(rfd)
+
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        # until there's a server to profile
+        signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+
+        if self._pin:
+            pin_to_cpu(idx % self._ncpus)
+
+        code = 0
+        try:
+            server = self._make_server(wfd)
+            stop = lambda signum, frame: server.stop()
+            signal.signal(signal.SIGTERM, stop)
+            signal.signal(signal.SIGINT, stop)
+            signal.signal(signal.SIGUSR2, lambda signum, frame: server.toggle_profile())
+            server.run()
+        except Exception as ex:
+            print >> sys.stderr, 'Worker %d failed: %s' % (idx, ex)
+            code = 1
+        finally:
+            os._exit(code)
+
+    def _on_signal(self, signum, frame):
+        if signum == signal.SIGUSR1:
+            self._dump = True
+        elif signum == signal.SIGUSR2:
+            self._profile = True
+        else:
+            self._stopping = True
+
+    def _read_stats(self, rfd):
+        """ Take in whatever a worker has reported """
+
+        pipe = self._pipes[rfd]
+        try:
+            data = os.read(rfd, 65536)
+        except OSError:
+            data = ''
+
+        if len(data) == 0:
+            os.close(rfd)
+            del self._pipes[rfd]
+            return
+
+        lines = (pipe[1] + data).split('\n')
+        pipe[1] = lines.pop()
+        if lines:
+            try:
+                self._stats[pipe[0]] = json.loads(lines[-1])
+            except ValueError:
+                pass
+
+    def _reap(self):
+        """ Collect exited workers, restarting them unless we're stopping """
+
+        while self._pids:
+            try:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if pid == 0:
+                return
+
+            idx = self._pids.pop(pid, None)
+            if idx is None or self._stopping:
+                continue
+
+            print >> sys.stderr, 'Worker %d (pid %d) exited with status %d, restarting...' % \
+                                (idx, pid, status)
+
+            wait = self._started[idx] + RESTART_DELAY - time()
+            if wait > 0:
+                sleep(wait)
+            self._spawn(idx)
+
+    def stats(self):
+        """ All workers' latest counters, summed """
+        return summarize(aggregate(self._stats.values()))
+
+    def print_stats(self):
+        print json.dumps({'workers': len(self._stats), 'total': self.stats()},
+                         indent = 2, sort_keys = True)
+        sys.stdout.flush()
+
+    def _signal_workers(self, signum):
+        for pid in self._pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def _shutdown(self):
+        """ Forward SIGTERM and wait for the workers to exit """
+
+        self._signal_workers(signal.SIGTERM)
+
+        deadline = time() + SHUTDOWN_TIMEOUT
+        while self._pids and time() < deadline:
+            self._reap()
+            sleep(0.05)
+
+        for pid in self._pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def run(self):
+        """ Start the workers and look after them until told to stop """
+
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        signal.signal(signal.SIGUSR1, self._on_signal)
+        signal.signal(signal.SIGUSR2, self._on_signal)
+
+        for idx in xrange(self._workers):
+            self._spawn(idx)
+
+        try:
+            while not self._stopping:
+                try:
+                    (ready, _, _) = select.select(self._pipes.keys(), [], [], 1)
+                except select.error as ex:
+                    if ex.args[0] != errno.EINTR:
+                        raise
+                    ready = []
+
+                for rfd in ready:
+                    self._read_stats(rfd)
+
+                self._reap()
+
+                if self._dump:
+                    self._dump = False
+                    self.print_stats()
+
+                if self._profile:
+                    self._profile = False
+                    self._signal_workers(signal.SIGUSR2)
+        finally:
+            self._shutdown()
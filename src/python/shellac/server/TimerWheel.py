@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+    A hashed timer wheel for the reactor
+
+    TimerWheel buckets timers into a ring of slots by their
+    expiry tick, so scheduling and cancelling are O(1) and
+    advancing only looks at the slots that have come due.
+    Timers further out than one revolution simply stay in
+    their slot until their tick comes around. The reactor
+    polls with timeout() and calls advance() after each poll.
+
+    Usage:
+        timers = TimerWheel()
+        t = timers.schedule(30, close_idle_client, fd)
+        timers.cancel(t)
+        ...
+        events = epoll.poll(timers.timeout())
+        timers.advance()
+
+    Limitations:
+        - timers fire up to one resolution late, never early
+        - cancelled timers are dropped lazily, when their slot
+          comes around
+        - not thread safe, designed for a reactor
+
+"""
+
+from time import time
+
+class TimerWheel(object):
+
+    def __init__(self, resolution = 0.1, slots = 512, now = None):
+        """ A wheel of slots, each resolution seconds wide """
+
+        if now is None:
+            now = time()
+
+        self._res = resolution
+        self._nslots = slots
+        self._slots = [[] for i in xrange(slots)]
+
+        # last tick we've processed
+        self._tick = int(now / resolution)
+
+        # live (scheduled, not fired or cancelled) timers
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, delay, callback, *args):
+        """ Call callback(*args) in delay seconds, returns a timer """
+        return self.schedule_at(time() + delay, callback, *args)
+
+    def schedule_at(self, when, callback, *args):
+        """ Call callback(*args) at time when, returns a timer """
+
+        tick = int(when / self._res) + 1
+        if tick <= self._tick:
+            tick = self._tick + 1
+
+        # spec: tick, callback, args
+        timer = [tick, callback, args]
+        self._slots[tick % self._nslots].append(timer)
+        self._count += 1
+
+        return timer
+
+    def cancel(self, timer):
+        """ Stop a timer from firing, harmless if it already has """
+
+        if timer[1] is not None:
+            timer[1] = None
+            timer[2] = None
+            self._count -= 1
+
+    def timeout(self, now = None):
+        """ Seconds to the next tick worth waking for, -1 if there are no timers """
+
+        if self._count == 0:
+            return -1
+
+        if now is None:
+            now = time()
+
+        return max(0, (self._tick + 1) * self._res - now)
+
+    def advance(self, now = None):
+        """ Fire every timer that has come due, returns how many fired """
+
+        if now is None:
+            now = time()
+
+        target = int(now / self._res)
+        if target <= self._tick:
+            return 0
+
+        first = self._tick + 1
+        visits = min(target - self._tick, self._nslots)
+        self._tick = target
+
+        if self._count == 0:
+            return 0
+
+        slots = self._slots
+        nslots = self._nslots
+        fired = 0
+
+        for i in xrange(visits):
+            slot = slots[(first + i) % nslots]
+            if not slot:
+                continue
+
+            # anything in this slot at or before target is due, the next
+            # tick to land in it is a full revolution past target
+            due = [t for t in slot if t[0] <= target]
+            if not due:
+                continue
+
+            slot[:] = [t for t in slot if t[0] > target]
+
+            for timer in due:
+                callback = timer[1]
+                if callback is None:
+                    continue
+                args = timer[2]
+                timer[1] = None
+                timer[2] = None
+                self._count -= 1
+                fired += 1
+                callback(*args)
+
+        return fired
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""
+    Connection pool for one upstream web server
+
+    UpstreamPool tracks the connections Shellac has open to
+    a single backend: how many there are, which of them are
+    idle, and whether another one may be opened. Idle fds are
+    kept on a LIFO free-list so acquire() and release() are
+    O(1) and the most recently used (warmest) connection is
+    handed out first. connect() starts a non-blocking connect,
+    the caller finishes it when the socket becomes writable.
+
+    The pool also counts the requests outstanding on all of
+    its connections and carries the backend's weight, which
+    is what the balancers go on.
+
+    Health is tracked like a circuit breaker: after max_fails
+    consecutive failures (refused connects, resets, timeouts,
+    failed probes) the backend is ejected for EJECT_TIMEOUT
+    seconds. It then goes half-open and lets a single trial
+    request (or probe) through: success closes the circuit,
+    failure ejects it again.
+
+    The pool only deals in fds, the server owns the sockets
+    and their epoll registrations.
+
+    Usage:
+        pool = UpstreamPool(('10.0.0.1', 80), max_conns = 64, weight = 2)
+        fd = pool.acquire()
+        if fd is None and not pool.full():
+            sock = pool.connect()
+        ...
+        pool.sent()
+        ...
+        pool.answered()
+        pool.succeeded()   # or pool.failed()
+        pool.release(fd)   # or pool.closed(fd)
+
+    Limitations:
+        - no per-connection state, that lives in the server
+        - not thread safe, designed for a reactor
+
+"""
+
+import errno
+import socket
+
+from time import time
+from collections import deque
+
+# seconds to hold off reconnecting after a failed connect
+RETRY_TIMEOUT = 1
+
+# consecutive failures before a backend is ejected
+MAX_FAILS = 3
+
+# seconds an ejected backend sits out before a trial request
+EJECT_TIMEOUT = 10
+
+# health states
+UP        = 'up'
+DOWN      = 'down'
+HALF_OPEN = 'half-open'
+
+class UpstreamPool(object):
+
+    def __init__(self, address, max_conns = 0, min_idle = 0, weight = 1,
+                 max_fails = MAX_FAILS):
+        """ Pool connections to address = (host, port), 0 means no limit """
+
+        if weight < 1:
+            raise ValueError('Weight must be at least 1: %r' % (weight,))
+
+        self._address = address
+        self._max = max_conns
+        self._min_idle = min_idle
+        self._weight = weight
+
+        # requests sent and not yet answered, across all connections
+        self._outstanding = 0
+
+        # idle fds, newest on the right; stale entries are skipped lazily
+        self._idle = deque()
+        self._idle_set = set()
+
+        # open (or opening) connections
+        self._count = 0
+
+        self._failed_at = 0
+
+        # circuit breaker state
+        self._max_fails = max_fails
+        self._fails = 0
+        self._state = UP
+        self._ejected_at = 0
+        self._trial = False
+
+    def address(self):
+        return self._address
+
+    def weight(self):
+        return self._weight
+
+    def count(self):
+        return self._count
+
+    def outstanding(self):
+        return self._outstanding
+
+    def idle(self):
+        return len(self._idle_set)
+
+    def full(self):
+        return self._max > 0 and self._count >= self._max
+
+    def needs_warming(self):
+        """ Should another idle connection be opened? """
+        return len(self._idle_set) < self._min_idle and not self.full() and \
+               self._state == UP and time() - self._failed_at >= RETRY_TIMEOUT
+
+    def state(self):
+        """ UP, DOWN or HALF_OPEN """
+
+        if self._state == DOWN and time() - self._ejected_at >= EJECT_TIMEOUT:
+            self._state = HALF_OPEN
+            self._trial = False
+        return self._state
+
+    def healthy(self):
+        """ May a request be sent here? Half-open allows one at a time """
+
+        state = self._state
+        if state == UP:
+            return True
+        if state == DOWN:
+            state = self.state()
+        return state == HALF_OPEN and not self._trial
+
+    def failures(self):
+        return self._fails
+
+    def acquire(self):
+        """ Take an idle connection's fd, or None """
+
+        idle = self._idle
+        idle_set = self._idle_set
+
+        while idle:
+            fd = idle.pop()
+            if fd in idle_set:
+                idle_set.discard(fd)
+                return fd
+
+        return None
+
+    def release(self, fd):
+        """ Put a connection back on the free-list """
+
+        if fd not in self._idle_set:
+            self._idle_set.add(fd)
+            self._idle.append(fd)
+
+    def connect(self):
+        """ Start a non-blocking connect, returns the socket or None """
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+
+        err = sock.connect_ex(self._address)
+        if err not in (0, errno.EINPROGRESS):
+            sock.close()
+            self.failed()
+            return None
+
+        self._count += 1
+        return sock
+
+    def sent(self):
+        """ A request has gone out on one of our connections """
+
+        self._outstanding += 1
+        if self._state == HALF_OPEN:
+            # this one is the trial
+            self._trial = True
+
+    def answered(self, n = 1):
+        """ n requests have been answered, or abandoned """
+
+        self._outstanding -= n
+        if self._state == HALF_OPEN:
+            # an abandoned trial proves nothing, allow another
+            self._trial = False
+
+    def succeeded(self):
+        """ A request or probe worked, close the circuit """
+
+        self._fails = 0
+        if self._state != UP:
+            self._state = UP
+            self._trial = False
+
+    def failed(self):
+        """ A connect, request or probe failed, maybe eject the backend """
+
+        now = time()
+        self._failed_at = now
+        self._fails += 1
+
+        if self._state == HALF_OPEN or \
+           (self._state == UP and self._max_fails > 0 and self._fails >= self._max_fails):
+            self._state = DOWN
+            self._ejected_at = now
+            self._trial = False
+
+    def closed(self, fd):
+        """ A connection from this pool has gone away """
+
+        self._count -= 1
+        self._idle_set.discard(fd)
+
+        # keep the lazy free-list from growing without bound
+        if len(self._idle) > 2 * len(self._idle_set) + 16:
+            self._idle = deque(f for f in self._idle if f in self._idle_set)
@@ -4,6 +4,15 @@
 
 from HttpParser import HttpParser
 from StreamBuf import StreamBuf
-
-
-
+from ChunkedStreamBuf import ChunkedStreamBuf
+from LruCache import LruCache
+from MemcacheClient import MemcacheClient
+from UpstreamPool import UpstreamPool
+from TimerWheel import TimerWheel
+from Balancer import Balancer, make_balancer
+from HealthChecker import HealthChecker
+from CachePolicy import CachePolicy
+from CacheEntry import CacheEntry
+from Compressor import Compressor
+from Histogram import Histogram
+from Profiler import Profiler
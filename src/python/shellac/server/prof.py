@@ -1,9 +1,138 @@
 #!/usr/bin/env python
+"""
+    Read Shellac's cProfile dumps
 
+    With one dump, prints the top entries by cumulative time
+    (or --sort). --compare takes two dumps, before and after,
+    and lists the functions whose own time (tottime) changed
+    the most, with their call counts either side. --folded
+    writes one dump as folded stacks, "caller;callee;... us"
+    lines that flamegraph.pl and speedscope read.
+
+    Usage:
+        python prof.py shellac-4242-20140301-120000.prof
+        python prof.py --compare before.prof after.prof
+        python prof.py --folded shellac.prof | flamegraph.pl > shellac.svg
+
+    Limitations:
+        - cProfile keeps caller/callee pairs, not whole stacks,
+          so folded stacks share a function's time out across
+          its callers by what each edge cost; a flame graph
+          of them is a good guess, not a recording
+        - recursion is cut where a function shows up twice
+        - two windows only compare fairly if they saw similar
+          traffic for a similar time, see the totals line
+
+"""
+
+import os
 import pstats
-import sys
+import argparse
+
+# folded stacks lighter than this (us) are dropped
+MIN_WEIGHT = 1
+
+# deepest folded stack
+MAX_DEPTH = 64
+
+def label(func):
+    """ (file, line, name) as file:line(name), without the directories """
+
+    (path, line, name) = func
+    if path == '~':
+        # built-ins
+        return name
+    return '%s:%d(%s)' % (os.path.basename(path), line, name)
+
+def load(path):
+    """ pstats' table for one dump: func => (cc, nc, tt, ct, callers) """
+    return pstats.Stats(path).stats
+
+def top(path, sort, limit):
+    pstats.Stats(path).strip_dirs().sort_stats(sort).print_stats(limit)
+
+def compare(before, after, limit):
+    """ Lines for the limit functions whose tottime changed most """
+
+    a = load(before)
+    b = load(after)
+    none = (0, 0, 0.0, 0.0, {})
+
+    rows = []
+    for func in set(a) | set(b):
+        (_, ncalls_a, tt_a, _, _) = a.get(func, none)
+        (_, ncalls_b, tt_b, _, _) = b.get(func, none)
+        rows.append((tt_b - tt_a, tt_a, tt_b, ncalls_a, ncalls_b, func))
+    rows.sort(key = lambda row: abs(row[0]), reverse = True)
+
+    lines = ['total tottime %.3fs -> %.3fs, calls %d -> %d' %
+             (sum(v[2] for v in a.itervalues()), sum(v[2] for v in b.itervalues()),
+              sum(v[1] for v in a.itervalues()), sum(v[1] for v in b.itervalues())),
+             '',
+             '%10s %10s %10s %10s %10s %10s  %s' %
+             ('tottime', 'was', 'delta', 'ncalls', 'was', 'delta', 'function')]
+    for (delta, tt_a, tt_b, ncalls_a, ncalls_b, func) in rows[:limit]:
+        lines.append('%10.4f %10.4f %+10.4f %10d %10d %+10d  %s' %
+                     (tt_b, tt_a, delta, ncalls_b, ncalls_a, ncalls_b - ncalls_a, label(func)))
+    return lines
+
+def folded(path):
+    """ {stack: us} with each function's own time shared out up its callers """
+
+    stats = load(path)
+    stacks = {}
+
+    def climb(stack, weight, cost):
+        """ Credit weight to stack (callee first) through the top's callers,
+            split by what each edge cost: its tottime (2) or cumtime (3) """
+
+        callers = stats[stack[-1]][4] if stack[-1] in stats else {}
+        # edges back into the stack are recursion, stop there
+        callers = dict((c, e) for c, e in callers.iteritems() if c not in stack)
+
+        if not callers or len(stack) >= MAX_DEPTH:
+            key = ';'.join(label(f) for f in reversed(stack))
+            stacks[key] = stacks.get(key, 0) + weight
+            return
+
+        total = float(sum(e[cost] for e in callers.itervalues()))
+        for caller, edge in callers.iteritems():
+            share = weight * (edge[cost] / total if total else 1.0 / len(callers))
+            if share >= MIN_WEIGHT:
+                climb(stack + [caller], share, 3)
+
+    for func, (cc, nc, tt, ct, callers) in stats.iteritems():
+        # a function's own time came in through each call site by what
+        # that site cost it, and further up by the callers' cumulative time
+        if tt * 1000000 >= MIN_WEIGHT:
+            climb([func], tt * 1000000, 2)
+
+    return stacks
 
-p = pstats.Stats(sys.argv[1])
+def main():
+    parser = argparse.ArgumentParser(description='Read Shellac profiles')
+    parser.add_argument('dumps', nargs='+',
+                            help='cProfile dumps, two with --compare.')
+    parser.add_argument('--compare', action='store_true',
+                            help='Diff two dumps by tottime and call counts.')
+    parser.add_argument('--folded', action='store_true',
+                            help='Write folded stacks for flamegraph.pl.')
+    parser.add_argument('-s', '--sort', default='cumulative',
+                            help='pstats sort key for the top entries.')
+    parser.add_argument('-n', '--limit', type=int, default=20,
+                            help='How many entries to print.')
+    args = parser.parse_args()
 
-p.strip_dirs().sort_stats('cumulative').print_stats(20)
+    if args.compare:
+        if len(args.dumps) != 2:
+            parser.error('--compare takes two dumps, before and after')
+        print '\n'.join(compare(args.dumps[0], args.dumps[1], args.limit))
+    elif args.folded:
+        for stack, weight in sorted(folded(args.dumps[0]).iteritems()):
+            print '%s %d' % (stack, round(weight))
+    else:
+        for path in args.dumps:
+            top(path, args.sort, args.limit)
 
+if __name__ == '__main__':
+    main()
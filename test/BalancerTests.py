@@ -0,0 +1,56 @@
+from shellac.server import UpstreamPool, make_balancer
+
+def test():
+    print 'Testing Balancer...'
+
+    a = UpstreamPool(('10.0.0.1', 80), weight = 3)
+    b = UpstreamPool(('10.0.0.2', 80))
+
+    # smooth weighted round-robin interleaves by weight
+    rr = make_balancer('round-robin', [a, b])
+    picks = [rr.choose('/') for i in xrange(8)]
+    assert picks.count(a) == 6 and picks.count(b) == 2
+    assert picks[:4] == [a, a, b, a]
+
+    # fewest outstanding per unit of weight wins
+    lo = make_balancer('least-outstanding', [a, b])
+    for i in xrange(3):
+        a.sent()
+    assert lo.choose('/') is b
+    b.sent()
+    b.sent()
+    assert lo.choose('/') is a
+    a.answered(3)
+    b.answered(2)
+
+    # ties go round the pools
+    assert set([lo.choose('/'), lo.choose('/')]) == set([a, b])
+
+    # a url always lands on the same backend, and urls spread out
+    uh = make_balancer('url-hash', [a, b])
+    assert all(uh.choose('/x/1') is uh.choose('/x/1') for i in xrange(10))
+    chosen = [uh.choose('/x/%d' % i) for i in xrange(1000)]
+    assert 600 < chosen.count(a) < 900
+
+    # ejected backends are skipped, their urls move elsewhere
+    for i in xrange(3):
+        b.failed()
+    assert all(uh.choose('/x/%d' % i) is a for i in xrange(100))
+    assert all(rr.choose('/') is a for i in xrange(4))
+    assert lo.choose('/') is a
+    for i in xrange(3):
+        a.failed()
+    assert uh.choose('/') is None and rr.choose('/') is None and lo.choose('/') is None
+
+    try:
+        make_balancer('fastest', [a, b])
+        assert False
+    except ValueError:
+        pass
+
+    print
+    print 'Done.'
+    print
+
+if __name__ == '__main__':
+    test()
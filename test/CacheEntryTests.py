@@ -0,0 +1,112 @@
+from shellac.server import HttpParser, CacheEntry
+from shellac.server.CachePolicy import MAX_TTL
+
+def request(*headers):
+    s = 'GET / HTTP/1.1\r\nHost: example.com\r\n%s\r\n' % ''.join(h + '\r\n' for h in headers)
+    p = HttpParser()
+    off = 0
+    while off < len(s):
+        off += p.parse(s, len(s) - off, off)
+    return p
+
+def test():
+    print 'Testing CacheEntry...'
+
+    lm = 'Sun, 06 Nov 1994 08:49:37 GMT'
+    head = 'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nEtag: "abc"\r\n' \
+           'X-Thing: 1\r\nServer: Shellac/0.1.0a\r\n\r\n'
+    e = CacheEntry(head, 'hello', 1000, 60, '"abc"', lm)
+
+    # freshness and how long to keep it around
+    assert e.fresh(1059) and not e.fresh(1060)
+    assert e.lifetime(keep = 100, now = 1030) == 130
+    assert CacheEntry(head, 'x', 1000, 60).lifetime(keep = 100, now = 1030) == 30
+    # capped where memcached would take it for a timestamp
+    assert CacheEntry(head, 'x', 1000, MAX_TTL).lifetime(keep = 3600, now = 1000) == MAX_TTL
+    assert e.refreshed(MAX_TTL, now = 1000).lifetime(keep = 3600, now = 1030) == MAX_TTL
+    assert len(e) == len(head) + 5 and e.status() == 200
+
+    # round trip through memcached, smaller than it goes on the wire
+    blob = e.pack('GET /')
+    assert len(blob) < len(head) + 5 + len(lm) + 40
+    u = CacheEntry.unpack(blob, 'GET /')
+    assert (u.head(), u.body(), u.stored(), u.ttl(), u.etag(), u.last_modified()) == \
+           (head, 'hello', 1000, 60, '"abc"', lm)
+    assert CacheEntry.unpack(blob) is not None
+    assert CacheEntry.unpack(blob, 'GET /other') is None
+    u = CacheEntry.unpack(CacheEntry('HTTP/1.0 404 Gone Fishing\r\n\r\n', '', 5, 6).pack('k'))
+    assert u.etag() is None and u.last_modified() is None and not u.revalidatable()
+    assert u.head() == 'HTTP/1.0 404 Gone Fishing\r\n\r\n' and u.status() == 404
+    assert CacheEntry.unpack('HTTP/1.1 200 OK\r\n\r\n') is None
+    assert CacheEntry.unpack(blob[:2] + chr(99) + blob[3:]) is None
+
+    # serving stale, and refreshing early
+    s = CacheEntry(head, 'x', 1000, 60, stale_while_revalidate = 10, stale_if_error = 300,
+                   delta = 0.5)
+    assert s.stale_ok(1069) and not s.stale_ok(1070)
+    assert s.error_ok(1359) and not s.error_ok(1360)
+    assert s.lifetime(keep = 100, now = 1030) == 330
+    assert not s.early(now = 1000) and s.early(now = 1060)
+    assert not s.early(beta = 0, now = 1060)
+    assert any(s.early(beta = 10, now = 1055) for i in xrange(1000))
+    u = CacheEntry.unpack(s.pack('k'))
+    assert (u.stale_while_revalidate(), u.stale_if_error(), u.delta()) == (10, 300, 0.5)
+    assert u.refreshed(60, now = 2000).stale_if_error() == 300
+
+    # conditional requests from clients
+    assert e.not_modified(request('If-None-Match: "xyz", W/"abc"'))
+    assert e.not_modified(request('If-None-Match: *'))
+    assert not e.not_modified(request('If-None-Match: "xyz"'))
+    assert e.not_modified(request('If-Modified-Since: ' + lm))
+    assert not e.not_modified(request('If-Modified-Since: Sat, 05 Nov 1994 08:49:37 GMT'))
+    assert not e.not_modified(request('If-None-Match: "xyz"', 'If-Modified-Since: ' + lm))
+    assert not e.not_modified(request())
+    assert e.not_modified_response().startswith('HTTP/1.1 304 ')
+
+    # and to the origin
+    assert e.validators() == {'if-none-match': '"abc"', 'if-modified-since': lm}
+    r = e.refreshed(30, now = 2000)
+    assert r.fresh(2029) and r.body() is e.body()
+
+    # too big for one item: a manifest and its segments
+    big = CacheEntry(head, 'x' * 25, 1000, 60, '"abc"', lm)
+    (m, pieces) = big.split(10)
+    assert pieces == ['x' * 10, 'x' * 10, 'x' * 5]
+    assert m.segmented() and not big.segmented() and m.length() == 25 and m.body() == ''
+    keys = m.segment_keys('GET /big')
+    assert len(keys) == 3 and len(set(keys)) == 3 and keys[0].startswith('GET /big#')
+    u = CacheEntry.unpack(m.pack('GET /big'), 'GET /big')
+    assert u.segmented() and u.segment_keys('GET /big') == keys and u.head() == head
+    assert (u.length(), u.etag(), u.last_modified(), u.ttl()) == (25, '"abc"', lm, 60)
+    assert u.refreshed(30, now = 2000).segment_keys('GET /big') == keys
+    assert big.split(10)[0].segment_keys('GET /big') != keys
+
+    # compressed for storage
+    d = big.deflate()
+    assert d.deflated() and not big.deflated() and d.body() != big.body()
+    u = CacheEntry.unpack(d.pack('GET /big'), 'GET /big')
+    assert u.deflated() and u.inflate().body() == big.body() and not u.inflate().deflated()
+    assert big.inflate() is big and d.split(10)[0].deflated()
+    assert e.header('content-type') == 'text/html' and e.header('x-thing') == '1'
+    assert e.header('content-length') is None
+
+    # heads as origins send them, without a space after the colon
+    tight = 'HTTP/1.1 200 OK\r\nContent-Type:text/html\r\nCache-Control:max-age=60\r\n' \
+            'X-Tight:  a b \r\nContent-Length: 5\r\n\r\nhello'
+    p = HttpParser(raw = True)
+    off = 0
+    while off < len(tight):
+        off += p.parse(tight, len(tight) - off, off)
+    t = CacheEntry(p.head(), 'hello', 1000, 60)
+    assert t.header('content-type') == 'text/html' and t.header('x-tight') == 'a b'
+    u = CacheEntry.unpack(t.pack('GET /tight'), 'GET /tight')
+    assert u.body() == 'hello' and u.header('cache-control') == 'max-age=60'
+    assert u.header('content-type') == 'text/html' and u.header('x-tight') == 'a b'
+    assert 'Content-Type: text/html\r\n' in u.head()
+
+    print
+    print 'Done.'
+    print
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,85 @@
+from shellac.server import HttpParser, CachePolicy
+from shellac.server.CachePolicy import digest
+
+def parse(s):
+    p = HttpParser(raw = True)
+    off = 0
+    while off < len(s):
+        off += p.parse(s, len(s) - off, off)
+    assert p.message_complete()
+    return p
+
+def response(*headers):
+    return parse('HTTP/1.1 200 OK\r\n%sContent-Length: 2\r\n\r\nhi' % \
+                 ''.join(h + '\r\n' for h in headers))
+
+def test():
+    print 'Testing CachePolicy...'
+
+    policy = CachePolicy(default_ttl = 170)
+
+    get = parse('GET /a?b=1 HTTP/1.1\r\nHost: Example.COM\r\nAccept-Encoding: gzip, br\r\n' \
+                'Accept-Language: en\r\n\r\n')
+    post = parse('POST /a HTTP/1.1\r\nHost: example.com\r\nContent-Length: 0\r\n\r\n')
+
+    # keys carry method, host and url
+    assert policy.key(get) == 'GET example.com/a?b=1'
+    assert policy.key(post) == 'POST example.com/a'
+    assert policy.lookup(get) and not policy.lookup(post)
+
+    # lifetimes: s-maxage over max-age over expires over the default
+    assert policy.ttl(get, response()) == 170
+    assert policy.ttl(get, response('Cache-Control: public, max-age=60, s-maxage=30')) == 30
+    assert policy.ttl(get, response('Cache-Control: max-age=60', 'Age: 20')) == 40
+    assert policy.ttl(get, response('Date: Sun, 06 Nov 1994 08:49:37 GMT',
+                                    'Expires: Sun, 06 Nov 1994 08:59:37 GMT')) == 600
+    assert policy.ttl(get, response('Expires: 0')) == 0
+    assert policy.ttl(get, response('Cache-Control: max-age=999999999')) == 2592000
+
+    # things we must not store
+    assert policy.ttl(post, response()) == 0
+    assert policy.ttl(get, response('Cache-Control: private, max-age=60')) == 0
+    assert policy.ttl(get, response('Cache-Control: no-store')) == 0
+    assert policy.ttl(get, response('Set-Cookie: a=b')) == 0
+    assert policy.ttl(get, response('Vary: *')) == 0
+    assert policy.ttl(get, parse('HTTP/1.1 500 Oops\r\nContent-Length: 0\r\n\r\n')) == 0
+    assert policy.ttl(get, parse('HTTP/1.1 500 Oops\r\nCache-Control: max-age=5\r\n' \
+                                 'Content-Length: 0\r\n\r\n')) == 5
+
+    # partial and not-modified responses aren't stored, but a 304 refreshes
+    not_modified = parse('HTTP/1.1 304 Not Modified\r\nCache-Control: max-age=50\r\n\r\n')
+    assert policy.ttl(get, not_modified) == 0
+    assert policy.refresh_ttl(not_modified, 20) == 50
+    assert policy.refresh_ttl(parse('HTTP/1.1 304 Not Modified\r\nServer: x\r\n\r\n'), 20) == 20
+
+    # how long it may be served stale
+    stale = CachePolicy(170, stale_while_revalidate = 10, stale_if_error = 300)
+    assert stale.stale(response()) == (10, 300)
+    assert stale.stale(response('Cache-Control: max-age=5, stale-while-revalidate=30')) == (30, 300)
+    assert stale.stale(response('Cache-Control: max-age=5, must-revalidate')) == (0, 0)
+
+    # variants
+    vary = policy.vary(response('Vary: Accept-Language, accept-encoding'))
+    assert vary == ['accept-encoding', 'accept-language']
+    marker = policy.marker(vary)
+    assert policy.parse_marker(marker) == vary
+    assert policy.parse_marker('HTTP/1.1 200 OK\r\n') is None
+
+    fr = parse('GET /a?b=1 HTTP/1.1\r\nHost: example.com\r\nAccept-Encoding: gzip\r\n' \
+               'Accept-Language: fr\r\n\r\n')
+    base = policy.key(get)
+    assert policy.variant_key(base, get, vary) != policy.variant_key(base, fr, vary)
+    assert policy.variant_key(base, get, ['accept-encoding']) == \
+           policy.variant_key(base, fr, ['accept-encoding'])
+
+    # memcached keys: short and plain whatever the URL
+    long_url = 'GET example.com/search?q=' + 'x y\n' * 200
+    assert len(digest(long_url)) == 32 and ' ' not in digest(long_url)
+    assert digest(long_url) == digest(long_url) != digest(base)
+
+    print
+    print 'Done.'
+    print
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,62 @@
+from shellac.server import ChunkedStreamBuf
+
+def test():
+    print 'Testing ChunkedStreamBuf...'
+
+    s = ChunkedStreamBuf()
+    assert s.ready() == False
+    assert s.closed() == False
+    assert s.views() == []
+
+    s.write('Hello')
+    s.write(', world!')
+    assert s.ready() == True
+    assert s.pending() == 13
+
+    assert s.read() == 'Hello, world!'
+    assert [v.tobytes() for v in s.views()] == ['Hello', ', world!']
+
+    # ack across a segment boundary
+    s.ack(7)
+    assert s.read() == 'world!'
+    assert s.views()[0].tobytes() == 'world!'
+    assert s.pending() == 6
+
+    s.ack(6)
+    assert s.read() == ''
+    assert s.complete() == False
+
+    s.close()
+    assert s.closed() == True
+    assert s.complete() == True
+
+    s.clear()
+    assert s.ready() == False
+    assert s.closed() == False
+
+    # small segments are glued into one send
+    for i in xrange(10):
+        s.write('%d' % i)
+    assert s.view().tobytes() == '0123456789'
+    assert len(s.views()) == 1
+    s.ack(4)
+    assert s.view().tobytes() == '456789'
+
+    # big ones are handed out as they are
+    big = 'X' * 100000
+    s.write(big)
+    s.ack(6)
+    v = s.view()
+    assert len(v) == len(big)
+    assert v.tobytes() == big
+
+    s.ack(len(big))
+    s.close()
+    assert s.complete() == True
+
+    print
+    print 'Done.'
+    print
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,65 @@
+import os
+from shellac.server import CacheEntry, Compressor
+
+def entry(ctype, body, *headers):
+    head = 'HTTP/1.1 200 OK\r\nContent-Type: %s\r\n%s\r\n' % \
+           (ctype, ''.join(h + '\r\n' for h in headers))
+    return CacheEntry(head, body, 1000, 60)
+
+def test():
+    print 'Testing Compressor...'
+
+    c = Compressor(min_size = 100, min_saving = 0.2, patience = 2, retry = 4)
+    text = '<p>Romeo, oh Romeo.</p>' * 100
+
+    # text is deflated and comes back the same
+    e = entry('text/html; charset=utf-8', text)
+    d = c.deflate(e)
+    assert d.deflated() and len(d.body()) < len(text) / 2
+    assert d.head() == e.head()
+    u = c.inflate(CacheEntry.unpack(d.pack('k'), 'k'))
+    assert not u.deflated() and u.body() == text
+
+    # small, already encoded, and packed by nature are left alone
+    assert c.deflate(entry('text/html', 'tiny')) is not None
+    assert not c.deflate(entry('text/html', 'tiny')).deflated()
+    assert not c.deflate(entry('text/html', text, 'Content-Encoding: gzip')).deflated()
+    assert not c.deflate(entry('image/png', text)).deflated()
+    assert c.deflate(entry('application/json', text)).deflated()
+
+    # noise doesn't compress, after patience tries the type is left alone
+    noise = os.urandom(1000)
+    for i in xrange(2):
+        assert c.deflate(entry('application/octet-stream', noise)) .body() is noise
+    stats = c.stats()
+    assert stats['uncompressible'] == 2
+    tried = stats['bytes_in']
+    for i in xrange(3):
+        c.deflate(entry('application/octet-stream', noise))
+    assert c.stats()['bytes_in'] == tried
+    # ...but it gets another go now and again
+    assert c.deflate(entry('application/octet-stream', text)).deflated()
+    assert c.deflate(entry('application/octet-stream', noise)).body() is noise
+    assert c.stats()['bytes_in'] > tried
+
+    stats = c.stats()
+    assert stats['compressed'] == 3 and stats['skipped'] >= 5
+    assert stats['bytes_in'] > stats['bytes_out']
+
+    # a deflated manifest's segments inflate in order
+    (m, pieces) = c.deflate(entry('text/plain', text)).split(16)
+    assert m.deflated() and len(pieces) > 2
+    inflater = c.inflater()
+    out = [c.inflate_piece(inflater, p, i == len(pieces) - 1) for i, p in enumerate(pieces)]
+    assert ''.join(out) == text
+
+    # corrupt bodies are refused
+    bad = CacheEntry(e.head(), 'not zlib', 1000, 60, deflated = True)
+    assert c.inflate(bad) is None
+
+    print
+    print 'Done.'
+    print
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,57 @@
+import json
+from shellac.server import Histogram
+
+def test():
+    print 'Testing Histogram...'
+
+    h = Histogram()
+    assert h.count() == 0
+    assert h.percentile(99) == 0.0
+
+    # 1ms to 1s, one of each
+    for ms in xrange(1, 1001):
+        h.record(ms / 1000.0)
+    assert h.count() == 1000
+
+    # never under, never more than a bucket (1/16) over
+    for p in (50, 90, 99, 99.9):
+        value = h.percentile(p)
+        true = p * 10 / 1000.0
+        assert true <= value <= true * (1 + 1.0 / 16), (p, value)
+    assert h.percentile(100) == 1.0
+
+    stats = h.stats()
+    assert stats['count'] == 1000 and stats['max'] == 1000.0
+    assert 500.0 <= stats['p50'] <= 532.0
+    assert stats['p50'] <= stats['p90'] <= stats['p99'] <= stats['p999'] <= stats['max']
+    assert 'buckets' not in stats
+
+    # small values are exact, silly ones are clamped
+    s = Histogram()
+    s.record(0.000003)
+    s.record(-1)
+    s.record(10 ** 9)
+    assert s.count() == 3
+    assert s.percentile(10) == 0.0
+    assert s.percentile(50) == 0.000003
+
+    # buckets from several histograms add up, even through JSON
+    a = Histogram()
+    b = Histogram()
+    for ms in xrange(1, 501):
+        a.record(ms / 1000.0)
+    for ms in xrange(501, 1001):
+        b.record(ms / 1000.0)
+    merged = Histogram().load(json.loads(json.dumps(a.buckets())))
+    merged.load(json.loads(json.dumps(b.stats(buckets = True)['buckets'])))
+    assert merged.count() == 1000
+    assert merged.percentile(50) == h.percentile(50)
+    # the max is only known to the bucket once merged
+    assert h.percentile(99) <= merged.percentile(99) <= h.percentile(99) * (1 + 1.0 / 16)
+
+    print
+    print 'Done.'
+    print
+
+if __name__ == '__main__':
+    test()
@@ -291,6 +291,167 @@ def test():
 
     open('data/fish-out.jpg','w+').write(ddata)    
 
+    # pass-through keeps the gzip bytes as they came in
+    req = 'HTTP/1.1 200 OK\r\n'
+    req+= 'Transfer-Encoding: chunked\r\n'
+    req+= 'Content-Encoding: gzip\r\n'
+    req+= '\r\n'
+    req+= '%x\r\n' % len(data0)
+    req+= data0
+    req+= '\r\n'
+    req+= '%x\r\n' % len(data1 + data2)
+    req+= data1 + data2
+    req+= '\r\n'
+    req+= '0\r\n'
+    req+= '\r\n'
+
+    p = HttpParser(raw = True)
+    while not p.message_complete():
+        c = p.parse(req, len(req))
+        req = req[c:]
+
+    assert p.raw() == True
+    assert p.body().read() == data0 + data1 + data2
+    assert str(p).endswith('\r\n\r\n' + data0 + data1 + data2)
+    assert 'Content-Length: %d\r\n' % len(data0 + data1 + data2) in str(p)
+
+    p.decode()
+    assert p.raw() == False
+    assert p.body().read() == 'Romeo, oh Romeo, why are thou so fair.'
+    assert zlib.decompress(str(p).split('\r\n\r\n', 1)[1], 31) == p.body().getvalue()
+
+    # streamed: the head, then the body a piece at a time
+    msg = 'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n' \
+          '3\r\nABC\r\n4\r\nDEFG\r\n0\r\n\r\n'
+    p = HttpParser(raw = True)
+    pieces = []
+    for ch in msg:
+        p.parse(ch, 1)
+        if p.headers_complete():
+            pieces.append(p.take_body())
+    assert p.message_complete() == True
+    assert p.head() == 'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+    assert ''.join(pieces) == 'ABCDEFG' and len(pieces) > 2
+    assert p.take_body() == '' and p.body().getvalue() == ''
+    assert p.split() == ('HTTP/1.1 200 OK\r\n\r\n', '')
+
+    # split at every byte, and parsed in place out of a bytearray
+    msgs = []
+    msgs.append('GET /split.html HTTP/1.1\r\nUser-Agent: Safari\r\nHost: a.com\r\n\r\n')
+    msgs.append('POST /split.html HTTP/1.1\r\nContent-Length: 5\r\n\r\nHELLO')
+    msgs.append('HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                '3;ext=foo\r\nABC\r\n4\r\nDEFG\r\n0\r\n\r\n')
+
+    for msg in msgs:
+        whole = HttpParser()
+        data = msg
+        while not whole.message_complete():
+            c = whole.parse(data, len(data))
+            data = data[c:]
+
+        for i in xrange(1, len(msg)):
+            parts = [msg[:i], msg[i:]]
+            p = HttpParser()
+            for part in parts:
+                while len(part) != 0:
+                    c = p.parse(part, len(part))
+                    part = part[c:]
+            assert p.message_complete() == True
+            assert p.headers() == whole.headers()
+            assert p.body().read() == whole.body().getvalue()
+
+        p = HttpParser()
+        for ch in msg:
+            assert p.parse(ch, 1) == 1
+        assert p.message_complete() == True
+
+        # two messages back to back in one buffer, by offset
+        buf = bytearray(msg + msg + '\0' * 10)
+        n = len(msg) * 2
+        off = 0
+        for k in xrange(2):
+            p = HttpParser()
+            while not p.message_complete():
+                off += p.parse(buf, n - off, off)
+            assert p.body().read() in ('', 'HELLO', 'ABCDEFG')
+        assert off == n
+
+        # cut anywhere in a buffer padded with CRLFs, nothing past a cut is read
+        buf = bytearray(msg + '\r\n' * 5)
+        n = len(msg)
+        for i in xrange(n + 1):
+            p = HttpParser()
+            off = 0
+            for end in (i, n):
+                while off < end and not p.message_complete():
+                    c = p.parse(buf, end - off, off)
+                    assert c <= end - off
+                    off += c
+            assert p.message_complete() == True
+            assert off == n and p.body().read() == whole.body().getvalue()
+
+        p = HttpParser()
+        off = 0
+        while not p.message_complete():
+            assert p.parse(buf, 1, off) == 1
+            off += 1
+        assert off == n
+
+    # headers without a space after the colon, and no headers at all
+    req = 'GET /tight.html HTTP/1.1\r\nHost:a.com\r\nX-Empty:\r\nAccept:  */* \r\n\r\n'
+    p = HttpParser()
+    assert p.parse(req, len(req)) == len(req)
+    assert p.message_complete() == True
+    assert p.headers() == {'host': 'a.com', 'x-empty': '', 'accept': '*/*'}
+
+    req = 'GET / HTTP/1.0\r\n\r\n'
+    p = HttpParser()
+    assert p.parse(req, len(req)) == len(req)
+    assert p.message_complete() == True
+    assert p.url() == '/' and p.headers() == {}
+
+    # a big head trickled in, a few bytes at a time
+    cookie = '; '.join('c%d=%s' % (i, 'x' * 30) for i in xrange(200))
+    req = 'GET /cookies.html HTTP/1.1\r\nHost: a.com\r\n' \
+          'Cookie: %s\r\nAccept: */*\r\n\r\n' % cookie
+    for size in (1, 7, 64, 1000):
+        buf = bytearray(req + 'GET /next.html HTTP/1.1\r\n\r\n')
+        p = HttpParser()
+        off = 0
+        while not p.message_complete():
+            off += p.parse(buf, min(size, len(buf) - off), off)
+        assert off == len(req)
+        assert p.url() == '/cookies.html'
+        assert p.headers()['cookie'] == cookie
+        assert p.headers()['accept'] == '*/*'
+
+    # headers go back out as they came in, unless they were changed
+    head = 'HTTP/1.1 200 OK\r\nserver: Apache\r\nSet-Cookie: a=1\r\nx-custom:  Odd Spacing\r\n' \
+           'Set-Cookie: b=2\r\nConnection: close\r\nAccept-Ranges: bytes\r\n\r\n'
+    p = HttpParser(raw = True)
+    assert p.parse(head, len(head)) == len(head)
+    assert p.head() == head
+
+    headers = p.headers()
+    headers['server'] = 'Shellac'
+    headers['connection'] = 'keep-alive'
+    headers.pop('accept-ranges')
+    headers['x-cache'] = 'HIT'
+    headers['etag'] = '"abc"'
+    h = p.head().split('\r\n')
+    assert h[:6] == ['HTTP/1.1 200 OK', 'Server: Shellac', 'Set-Cookie: a=1',
+                     'x-custom:  Odd Spacing', 'Set-Cookie: b=2', 'Connection: keep-alive']
+    assert sorted(h[6:8]) == ['ETag: "abc"', 'X-Cache: HIT'] and h[8:] == ['', '']
+
+    headers['set-cookie'] = ['c=3', 'd=4']
+    assert 'Set-Cookie: c=3, d=4\r\n' in p.head() and 'a=1' not in p.head()
+
+    # an empty gzip body stays empty
+    head = 'HTTP/1.1 304 Not Modified\r\nContent-Encoding: gzip\r\n\r\n'
+    p = HttpParser()
+    p.parse(head, len(head))
+    assert p.message_complete() and str(p) == head
+
     # test __str__
     req = 'HTTP/1.1 500 Internal Server Error\r\n'
     req+= 'Server: Apache 2.2\r\n'
@@ -324,6 +485,31 @@ def test():
     print p
     print
 
+    # a repeated Connection header, close wins
+    req = 'HTTP/1.1 404 Not Found\r\n'
+    req+= 'Connection: close\r\n'
+    req+= 'Connection: keep-alive\r\n'
+    req+= 'Keep-Alive: timeout=5, max=100\r\n'
+    req+= 'Content-Length: 0\r\n'
+    req+= '\r\n'
+
+    p = HttpParser()
+    while not p.message_complete():
+        c = p.parse(req, len(req))
+        req = req[c:]
+
+    assert not p.keep_alive()
+    assert p.keep_alive_params() == (0, 1)
+    assert p.closes()
+
+    # no Connection header: HTTP/1.1 stays open, HTTP/1.0 doesn't
+    for (version, ka) in (('1.1', True), ('1.0', False)):
+        req = 'HTTP/%s 200 OK\r\nContent-Length: 0\r\n\r\n' % version
+        p = HttpParser()
+        assert p.parse(req, len(req)) == len(req)
+        assert p.keep_alive() == ka and not p.closes()
+        assert p.keep_alive_params() == ((5, 100) if ka else (0, 1))
+
     print
     print 'Done.'
     print
@@ -0,0 +1,45 @@
+from shellac.server import LruCache
+
+def test():
+    print 'Testing LruCache...'
+
+    c = LruCache(100)
+    assert c.get('a') == None
+    assert c.misses() == 1
+
+    c.set('a', 'AAAAAAAAA', 10, now = 0)
+    assert c.size() == 10
+    assert c.get('a', now = 1) == 'AAAAAAAAA'
+    assert c.hits() == 1
+
+    # expiry
+    assert c.get('a', now = 10) == None
+    assert c.size() == 0
+    assert c.misses() == 2
+
+    # least recently used goes first
+    c.set('a', 'X' * 39, 60, now = 0)
+    c.set('b', 'X' * 39, 60, now = 0)
+    assert c.get('a', now = 1) != None
+    c.set('c', 'X' * 39, 60, now = 1)
+    assert c.evictions() == 1
+    assert c.get('b', now = 2) == None
+    assert c.get('a', now = 2) != None
+    assert c.get('c', now = 2) != None
+    assert c.size() <= c.limit()
+
+    # replacing an entry does not leak bytes
+    c.set('c', 'Y', 60, now = 2)
+    assert c.size() == 40 + 2
+
+    # oversized entries are not stored
+    c.set('d', 'X' * 200, 60, now = 2)
+    assert c.get('d', now = 2) == None
+    assert c.stats()['entries'] == 2
+
+    print
+    print 'Done.'
+    print
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,129 @@
+
+import socket, select
+from shellac.server import MemcacheClient
+from shellac.server.MemcacheClient import HEADER, OP_GET, OP_GETQ, OP_NOOP
+
+def test():
+
+    def pump(mc, epoll):
+        """ Hand the client its events until it goes quiet """
+        while True:
+            events = epoll.poll(0.05)
+            if not events:
+                return
+            for fd, event in events:
+                if event & select.EPOLLIN:
+                    mc.read(fd)
+                elif event & select.EPOLLOUT:
+                    mc.write(fd)
+                else:
+                    mc.close(fd)
+
+    def recv_exactly(conn, n):
+        data = ''
+        while len(data) < n:
+            piece = conn.recv(n - len(data))
+            assert piece, 'client hung up'
+            data += piece
+        return data
+
+    def request(conn):
+        """ The next request the client sent: (opcode, key, opaque) """
+        (magic, op, keylen, extlen, _, _, bodylen, opaque, _) = \
+            HEADER.unpack(recv_exactly(conn, HEADER.size))
+        assert magic == 0x80
+        body = recv_exactly(conn, bodylen)
+        return (op, body[extlen:extlen + keylen], opaque)
+
+    def reply(op, opaque, value = None):
+        if value is None:
+            return HEADER.pack(0x81, op, 0, 0, 0, 1, 9, opaque, 0) + 'Not found'
+        return HEADER.pack(0x81, op, 0, 4, 0, 0, 4 + len(value), opaque, 0) + \
+               '\0\0\0\0' + value
+
+    print 'Testing MemcacheClient...'
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    server = listener.getsockname()
+
+    epoll = select.epoll()
+    mc = MemcacheClient([server], epoll)
+
+    # get: a hit, then a miss
+    got = []
+    mc.get('/a', got.append)
+    (conn, _) = listener.accept()
+    conn.settimeout(5)
+    pump(mc, epoll)
+    (op, key, opaque) = request(conn)
+    assert (op, key) == (OP_GET, '/a')
+    assert mc.pending() == 1
+
+    conn.sendall(reply(op, opaque, 'apple'))
+    pump(mc, epoll)
+    assert got == ['apple'] and mc.pending() == 0
+
+    mc.get('/b', got.append)
+    pump(mc, epoll)
+    (op, key, opaque) = request(conn)
+    conn.sendall(reply(op, opaque))
+    pump(mc, epoll)
+    assert got == ['apple', None]
+
+    # a big reply split across reads, with the next one hard behind it
+    big = ''.join(chr(i % 251) for i in xrange(300000))
+    got = []
+    mc.get('/big', got.append)
+    mc.get('/small', got.append)
+    pump(mc, epoll)
+    replies = [reply(op, opaque, v) for (op, key, opaque), v in
+               zip([request(conn), request(conn)], [big, 'small'])]
+    data = ''.join(replies)
+    cuts = [0, 10, HEADER.size + 100, 150000, len(replies[0]) + 3, len(data)]
+    for i in xrange(len(cuts) - 1):
+        assert got == ([] if cuts[i] < len(replies[0]) else [big])
+        conn.sendall(data[cuts[i]:cuts[i + 1]])
+        pump(mc, epoll)
+    assert got == [big, 'small']
+    assert mc.pending() == 0
+
+    # multi-get: quiet gets only answer hits, the no-op says the rest missed
+    got = []
+    mc.get_multi(['/x', '/y', '/z'], lambda key, value: got.append((key, value)))
+    pump(mc, epoll)
+    reqs = [request(conn) for i in xrange(4)]
+    assert [(op, key) for op, key, opaque in reqs] == \
+           [(OP_GETQ, '/x'), (OP_GETQ, '/y'), (OP_GETQ, '/z'), (OP_NOOP, '')]
+    conn.sendall(reply(OP_GETQ, reqs[1][2], 'yes') + reply(OP_NOOP, reqs[3][2], ''))
+    pump(mc, epoll)
+    assert sorted(got) == [('/x', None), ('/y', 'yes'), ('/z', None)]
+    assert mc.pending() == 0
+
+    # the node dies with callbacks pending: they all fire as misses
+    got = []
+    mc.get('/p', got.append)
+    mc.get_multi(['/q', '/r'], lambda key, value: got.append((key, value)))
+    pump(mc, epoll)
+    assert mc.pending() == 4
+    conn.close()
+    pump(mc, epoll)
+    assert mc.pending() == 0
+    assert sorted(got) == sorted([None, ('/q', None), ('/r', None)])
+
+    # and it isn't retried straight away
+    got = []
+    mc.get('/a', got.append)
+    assert got == [None]
+
+    listener.close()
+    epoll.close()
+
+    print
+    print 'Done.'
+    print
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,143 @@
+
+import socket, threading
+from shellac.server import HttpParser
+from shellac.server.Server import Server
+
+def test():
+
+    def free_port():
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        return port
+
+    def read_requests(conn, count):
+        """ Up to count requests off conn: [(method, url)], fewer if it hangs
+            up or goes quiet after sending some
+        """
+        got = []
+        p = HttpParser()
+        while len(got) < count:
+            try:
+                data = conn.recv(65536)
+            except socket.timeout:
+                if got:
+                    break
+                raise
+            if not data:
+                break
+            while data:
+                c = p.parse(data, len(data))
+                data = data[c:]
+                if p.message_complete():
+                    got.append((p.method(), p.url()))
+                    p = HttpParser()
+        return got
+
+    def origin(listener, seen, close_first):
+        """ Answer each connection's requests in one write, no Connection
+            header. With close_first the first connection answers only its
+            first request, with Connection: close, and hangs up.
+        """
+        first = True
+        while True:
+            try:
+                (conn, _) = listener.accept()
+            except socket.error:
+                return
+            conn.settimeout(0.5)
+            if first and close_first:
+                got = read_requests(conn, 3)
+                seen.append(got[:1])
+                conn.sendall('HTTP/1.1 200 OK\r\nConnection: close\r\n'
+                             'Content-Length: %d\r\n\r\n%s' % (len(got[0][1]), got[0][1]))
+            else:
+                got = read_requests(conn, 3)
+                seen.append(got)
+                conn.sendall(''.join('HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s' %
+                                     (len(url), url) for (method, url) in got))
+                try:
+                    # hold it open until the proxy is done with it
+                    while conn.recv(65536):
+                        pass
+                except socket.timeout:
+                    pass
+            first = False
+            conn.close()
+
+    def fetch(port, requests):
+        """ Pipeline requests to the proxy: [(status, body)] """
+        s = socket.create_connection(('127.0.0.1', port))
+        s.settimeout(5)
+        s.sendall(''.join(requests))
+        got = []
+        p = HttpParser()
+        while len(got) < len(requests):
+            data = s.recv(65536)
+            assert data, 'proxy hung up'
+            while data:
+                c = p.parse(data, len(data))
+                data = data[c:]
+                if p.message_complete():
+                    got.append((p.status(), p.body().getvalue()))
+                    p = HttpParser()
+        s.close()
+        return got
+
+    def run(requests, close_first):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+
+        seen = []
+        o = threading.Thread(target = origin, args = (listener, seen, close_first))
+        o.daemon = True
+        o.start()
+
+        port = free_port()
+        server = Server([listener.getsockname()], [], port = port)
+        t = threading.Thread(target = server.run)
+        t.daemon = True
+        t.start()
+
+        try:
+            got = fetch(port, requests)
+        finally:
+            server.stop()
+            t.join(5)
+            listener.close()
+        return (got, seen)
+
+    def post(url):
+        return 'POST %s HTTP/1.1\r\nHost: a.com\r\nContent-Length: 2\r\n\r\nhi' % url
+
+    def get(url):
+        return 'GET %s HTTP/1.1\r\nHost: a.com\r\n\r\n' % url
+
+    print 'Testing Server...'
+
+    # pipelined POSTs, HTTP/1.1 answers without a Connection header: one
+    # connection, each POST sent once
+    (got, seen) = run([post('/p1'), post('/p2'), post('/p3')], False)
+    assert got == [(200, '/p1'), (200, '/p2'), (200, '/p3')]
+    assert seen == [[('POST', '/p1'), ('POST', '/p2'), ('POST', '/p3')]]
+
+    # the origin closes after the first: the POSTs behind it aren't sent again
+    (got, seen) = run([post('/p1'), post('/p2'), post('/p3')], True)
+    assert got == [(200, '/p1'), (502, ''), (502, '')]
+    assert seen == [[('POST', '/p1')]]
+
+    # but GETs are, on a new connection
+    (got, seen) = run([get('/g1'), get('/g2'), get('/g3')], True)
+    assert got == [(200, '/g1'), (200, '/g2'), (200, '/g3')]
+    assert seen[0] == [('GET', '/g1')]
+    assert sorted(sum(seen[1:], [])) == [('GET', '/g2'), ('GET', '/g3')]
+
+    print
+    print 'Done.'
+    print
+
+if __name__ == '__main__':
+    test()
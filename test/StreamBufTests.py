@@ -16,6 +16,7 @@ def test():
 
 	s.ack(2)
 	assert s.read() == 'llo'
+	assert s.pending() == 3
 
 	s.ack(3)
 	assert s.read() == ''
@@ -0,0 +1,59 @@
+from shellac.server import TimerWheel
+
+def test():
+    print 'Testing TimerWheel...'
+
+    fired = []
+
+    w = TimerWheel(resolution = 1, slots = 8, now = 100)
+    assert len(w) == 0
+    assert w.timeout(now = 100) == -1
+
+    w.schedule_at(103, fired.append, 'a')
+    w.schedule_at(105.5, fired.append, 'b')
+    t = w.schedule_at(104, fired.append, 'c')
+    assert len(w) == 3
+    assert w.timeout(now = 100.25) == 0.75
+
+    # never early
+    assert w.advance(now = 103.9) == 0
+    assert w.advance(now = 104) == 1
+    assert fired == ['a']
+
+    w.cancel(t)
+    w.cancel(t)
+    assert len(w) == 1
+
+    assert w.advance(now = 106.5) == 1
+    assert fired == ['a', 'b']
+    assert w.timeout() == -1
+
+    # further out than one revolution
+    w.schedule_at(120, fired.append, 'd')
+    assert w.advance(now = 115) == 0
+    assert w.advance(now = 121) == 1
+    assert fired[-1] == 'd'
+
+    # a long stall still fires everything that's due
+    for i in xrange(20):
+        w.schedule_at(122 + i, fired.append, i)
+    assert w.advance(now = 1000) == 20
+    assert len(w) == 0
+
+    # timers scheduled from a callback wait for a later tick
+    def again(n):
+        fired.append(n)
+        if n < 3:
+            w.schedule_at(0, again, n + 1)
+    w.schedule_at(1000, again, 1)
+    assert w.advance(now = 1001) == 1
+    assert w.advance(now = 1002) == 1
+    assert w.advance(now = 1003) == 1
+    assert fired[-3:] == [1, 2, 3]
+
+    print
+    print 'Done.'
+    print
+
+if __name__ == '__main__':
+    test()
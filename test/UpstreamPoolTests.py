@@ -0,0 +1,66 @@
+from shellac.server import UpstreamPool
+
+def test():
+    print 'Testing UpstreamPool...'
+
+    p = UpstreamPool(('127.0.0.1', 80), max_conns = 2, min_idle = 1)
+    assert p.acquire() == None
+    assert p.full() == False
+    assert p.needs_warming() == True
+
+    # most recently released comes back first
+    p.release(5)
+    p.release(7)
+    assert p.idle() == 2
+    assert p.acquire() == 7
+    assert p.acquire() == 5
+    assert p.acquire() == None
+
+    # closed connections are never handed out
+    p.release(5)
+    p.release(7)
+    p.closed(7)
+    assert p.acquire() == 5
+    assert p.acquire() == None
+
+    # a reused fd is only handed out once
+    p.release(9)
+    p.closed(9)
+    p.release(9)
+    assert p.acquire() == 9
+    assert p.acquire() == None
+
+    # failed connects hold off warming
+    p.failed()
+    assert p.needs_warming() == False
+
+    # consecutive failures eject the backend
+    h = UpstreamPool(('127.0.0.1', 80), max_fails = 2)
+    h.failed()
+    h.succeeded()
+    h.failed()
+    assert h.state() == 'up' and h.healthy()
+    h.failed()
+    assert h.state() == 'down' and not h.healthy()
+
+    # after a while it goes half-open and takes one trial request
+    h._ejected_at -= 60
+    assert h.healthy() and h.state() == 'half-open'
+    h.sent()
+    assert not h.healthy()
+
+    # a failed trial ejects it again, a good one closes the circuit
+    h.failed()
+    assert h.state() == 'down'
+    h._ejected_at -= 60
+    h.sent()
+    h.answered()
+    h.succeeded()
+    assert h.state() == 'up' and h.failures() == 0 and h.outstanding() == 1
+
+    print
+    print 'Done.'
+    print
+
+if __name__ == '__main__':
+    test()